@@ -0,0 +1,4 @@
+"""
+Benchmarks of the spvm hot paths on synthetic projects
+Run with: python -m benchmarks run -o results.json
+"""
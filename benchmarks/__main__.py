@@ -0,0 +1,94 @@
+import sys
+import json
+import click
+from colorama import Fore
+
+from .run import CASES, run_benchmarks, compare_results, load_results
+from .generate import generate_project
+from .uploadserver import check_upload
+from .gitrelease import check_release
+
+
+@click.group()
+def bench():
+    """ Benchmarks of the spvm hot paths on synthetic projects """
+    pass
+
+
+def _project_options(f):
+    f = click.option("-p", "--packages", type=int, default=5, help="Number of packages")(f)
+    f = click.option("-f", "--files", type=int, default=20, help="Number of modules per package")(f)
+    f = click.option("-d", "--depth", type=int, default=3, help="Ignored directory levels per package")(f)
+    f = click.option("-c", "--commits", type=int, default=100, help="Number of commits in the git history")(f)
+    f = click.option("--seed", type=int, default=0)(f)
+    return f
+
+
+@bench.command()
+@_project_options
+@click.argument('location')
+def generate(packages, files, depth, commits, seed, location):
+    """ Generate a synthetic project at location """
+    print(json.dumps(generate_project(location, packages, files, depth, commits, seed)))
+
+
+@bench.command()
+@_project_options
+@click.option("-r", "--repeat", type=int, default=3, help="Runs per case, the minimum is kept")
+@click.option("-k", "--case", "cases", multiple=True, type=click.Choice(list(CASES)), help="Only run these cases")
+@click.option("-o", "--output", default='-', help="JSON results file (default: stdout)")
+@click.option("--keep", default=None, help="Generate the project there and keep it")
+def run(packages, files, depth, commits, seed, repeat, cases, output, keep):
+    """ Time the spvm hot paths on a generated project """
+    results = run_benchmarks(packages, files, depth, commits, repeat, cases or None, keep, seed)
+    content = json.dumps(results, indent=4)
+    if output == '-':
+        print(content)
+    else:
+        with open(output, 'w') as fh:
+            fh.write(content + '\n')
+
+
+@bench.command()
+@click.option("-t", "--threshold", type=float, default=1.10, help="Ratio above which a case is a regression")
+@click.argument('old')
+@click.argument('new')
+def compare(threshold, old, new):
+    """ Compare two result files, exits with 1 on a regression """
+    old, new = load_results(old), load_results(new)
+    if old['params'] != new['params']:
+        print(Fore.YELLOW + 'Warning: the results were produced with different parameters' + Fore.RESET)
+
+    regressions = 0
+    for name, before, after, ratio in compare_results(old, new):
+        color = Fore.RED if ratio > threshold else Fore.GREEN if ratio < 1 / threshold else Fore.WHITE
+        regressions += ratio > threshold
+        print(name.ljust(24) + '%10.4fs %10.4fs  ' % (before, after) + color + 'x%.2f' % ratio + Fore.RESET)
+    if regressions > 0:
+        sys.exit(1)
+
+
+@bench.command()
+def upload():
+    """ Check the uploader against a local stand-in of the legacy upload endpoint """
+    problems = check_upload()
+    for problem in problems:
+        print(Fore.RED + problem + Fore.RESET)
+    if len(problems) > 0:
+        sys.exit(1)
+    print(Fore.GREEN + 'Upload OK' + Fore.RESET)
+
+
+@bench.command()
+def release():
+    """ Check the git release against a local bare repository """
+    problems = check_release()
+    for problem in problems:
+        print(Fore.RED + problem + Fore.RESET)
+    if len(problems) > 0:
+        sys.exit(1)
+    print(Fore.GREEN + 'Release OK' + Fore.RESET)
+
+
+if __name__ == '__main__':
+    bench()
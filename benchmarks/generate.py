@@ -0,0 +1,139 @@
+import os
+import json
+import random
+import subprocess
+from os.path import join
+
+from spvm import config
+from spvm import metautils
+
+# A module body with a few pyflakes and pycodestyle problems
+MODULE_TEMPLATE = '''import os
+import sys
+from {package} import {sibling}
+
+
+def function_{index}(value, other=None):
+    """ Generated function {index} """
+    result = []
+    for i in range(value):
+        if i % 3 == 0:
+            result.append(i*2)
+        elif other is not None:
+            result.append({sibling}.function_{sibling_index}(i))
+    return result
+
+
+class Generated{index}(object):
+    def __init__(self, value):
+        self.value = value
+
+    def compute(self):
+        unused = 42
+        return function_{index}(self.value)
+'''
+
+TEST_TEMPLATE = '''from {package} import {module}
+
+
+def test_{module}():
+    assert {module}.function_{index}(3) == [0]
+'''
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fh:
+        fh.write(content)
+
+
+def generate_meta(name):
+    meta = metautils.get_default_template()
+    meta['project_info']['name'] = name
+    meta['project_info']['description'] = 'Synthetic project for the spvm benchmarks'
+    meta['project_authors'][0]['name'] = 'bench'
+    meta['project_vcs']['exclude_packages'] = ['test']
+    return meta
+
+
+def generate_gitignore(location, packages, depth, rng):
+    """
+    Write a .gitignore with about depth patterns per package and create matching ignored files
+    """
+    patterns = ['build', 'dist', '*.egg-info', '__pycache__', '*.pyc']
+    for p in range(packages):
+        package = 'pkg' + str(p)
+        for d in range(depth):
+            ignored = join(package, *['level' + str(i) for i in range(d + 1)], 'generated')
+            patterns.append(ignored)
+            for f in range(3):
+                _write(join(location, ignored, 'blob' + str(f) + '.dat'), 'x' * rng.randint(100, 4000))
+    _write(join(location, '.gitignore'), '\n'.join(patterns) + '\n')
+
+
+def generate_history(location, commits, rng):
+    """
+    Create a git history of commits commits with git fast-import, tagging every tenth one
+    The history only touches a CHANGELOG file so the working tree is unchanged
+    """
+    subprocess.run(['git', 'init', '-q'], cwd=location, check=True)
+    stream = []
+    content = ''
+    for c in range(commits):
+        content += 'change ' + str(c) + ' ' + str(rng.random()) + '\n'
+        data = content.encode()
+        message = ('Commit ' + str(c)).encode()
+        stream.append(b'commit refs/heads/master\n')
+        stream.append(b'mark :' + str(c + 1).encode() + b'\n')
+        stream.append(b'committer bench <bench@example.com> ' + str(1500000000 + c * 60).encode() + b' +0000\n')
+        stream.append(b'data ' + str(len(message)).encode() + b'\n' + message + b'\n')
+        if c > 0:
+            stream.append(b'from :' + str(c).encode() + b'\n')
+        stream.append(b'M 100644 inline CHANGELOG\ndata ' + str(len(data)).encode() + b'\n' + data + b'\n')
+        if c % 10 == 9:
+            tag = '0.0.' + str(c // 10)
+            stream.append(b'reset refs/tags/' + tag.encode() + b'\nfrom :' + str(c + 1).encode() + b'\n')
+    subprocess.run(['git', 'fast-import', '--quiet'], cwd=location, input=b''.join(stream), check=True)
+    subprocess.run(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'], cwd=location, check=True)
+    subprocess.run(['git', 'checkout', '-q', '-f', 'master'], cwd=location, check=True)
+
+
+def generate_project(location, packages=5, files=20, depth=3, commits=100, seed=0):
+    """
+    Generate a spvm project at location with packages packages of files modules each,
+    their tests, a gitignore depth levels deep per package and a git history of commits commits
+    Returns the parameters of the generated project
+    """
+    rng = random.Random(seed)
+    name = os.path.basename(os.path.abspath(location)).lower()
+    os.makedirs(location, exist_ok=True)
+
+    _write(join(location, config.metaFileName), json.dumps(generate_meta(name), indent=4))
+    with open(join(os.path.dirname(config.__file__), 'res', 'setup.py'), 'r') as fh:
+        _write(join(location, 'setup.py'), fh.read())
+    _write(join(location, name, '__init__.py'), '')
+    _write(join(location, 'README.md'), '# ' + name + '\n')
+
+    for p in range(packages):
+        package = 'pkg' + str(p)
+        _write(join(location, package, '__init__.py'), '')
+        for f in range(files):
+            sibling = (f + 1) % files
+            _write(join(location, package, 'mod' + str(f) + '.py'),
+                   MODULE_TEMPLATE.format(package=package, index=f, sibling='mod' + str(sibling), sibling_index=sibling))
+            if f % 4 == 0:
+                _write(join(location, 'test', package, 'test_mod' + str(f) + '.py'),
+                       TEST_TEMPLATE.format(package=package, module='mod' + str(f), index=f))
+
+    generate_gitignore(location, packages, depth, rng)
+    if commits > 0:
+        generate_history(location, commits, rng)
+
+    return {'packages': packages, 'files': files, 'depth': depth, 'commits': commits, 'seed': seed}
+
+
+__all__ = [
+    'generate_project',
+    'generate_meta',
+    'generate_gitignore',
+    'generate_history']
@@ -0,0 +1,107 @@
+import os
+import json
+import tempfile
+import subprocess
+from os.path import join
+
+from spvm import config
+from spvm import core
+from .generate import generate_meta
+
+NAME = 'bench_release'
+
+
+def _git(args, cwd):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE).stdout.decode().strip()
+
+
+def _write(path, content):
+    with open(path, 'w') as fh:
+        fh.write(content)
+
+
+def make_release_project(directory):
+    """
+    A committed spvm project whose code_repository is a local bare repository
+    Returns (project location, remote)
+    """
+    remote = join(directory, 'remote.git')
+    location = join(directory, 'project')
+    _git(['init', '-q', '--bare', remote], directory)
+    os.makedirs(join(location, NAME))
+
+    meta = generate_meta(NAME)
+    meta['project_vcs']['code_repository'] = remote
+    meta['project_vcs']['version'] = '1.0.0'
+    meta['project_vcs']['release']['tag_template'] = 'v%s'
+    _write(join(location, config.metaFileName), json.dumps(meta, indent=4))
+    _write(join(location, NAME, '__init__.py'), "__version__ = '1.0.0'\n")
+    _write(join(location, 'notes.txt'), 'notes\n')
+    core.make_project_object(location)  # the meta as spvm saves it, a later project finds nothing to rewrite
+
+    _git(['init', '-q'], location)
+    _git(['config', 'user.name', 'bench'], location)
+    _git(['config', 'user.email', 'bench@localhost'], location)
+    _git(['add', '-A'], location)
+    _git(['commit', '-q', '-m', 'Initial commit'], location)
+    _git(['push', '-q', remote, 'HEAD'], location)
+    return location, remote
+
+
+def _remote_state(remote, tag):
+    """ (branch commit, tag commit or None) on the remote """
+    branch = _git(['rev-parse', 'HEAD'], remote)
+    tags = _git(['tag', '--list', tag], remote)
+    return branch, (_git(['rev-parse', tag + '^{commit}'], remote) if tags != '' else None)
+
+
+def check_release():
+    """
+    Release a local project twice with _release_git alone (like spvm publish git), returns the
+    list of problems (empty when it works)
+    The first release commits the meta and the __init__ but not a stray modified file, the second has
+    nothing to commit and only tags; each time the remote gets the branch and the tag together
+    """
+    problems = []
+    with tempfile.TemporaryDirectory(prefix='spvm-release-') as directory:
+        location, remote = make_release_project(directory)
+
+        with open(join(location, config.metaFileName), 'r') as fh:
+            meta = json.loads(fh.read())
+        meta['project_vcs']['version'] = '1.0.1'
+        _write(join(location, config.metaFileName), json.dumps(meta, indent=4))
+        _write(join(location, NAME, '__init__.py'), "__version__ = '1.0.1'\n")
+        _write(join(location, 'notes.txt'), 'stray change\n')
+
+        project = core.make_project_object(location)
+        if len(project.release_files) > 0:
+            problems.append('the project wrote files, the fallback set is not checked: ' + str(project.release_files))
+        project._release_git()
+
+        committed = set(_git(['diff-tree', '--no-commit-id', '--name-only', '-r', 'HEAD'], location).split('\n'))
+        expected = {config.metaFileName, NAME + '/__init__.py'}
+        if committed != expected:
+            problems.append('the release committed ' + str(sorted(committed)) + ' instead of ' + str(sorted(expected)))
+        if 'notes.txt' not in _git(['status', '--porcelain'], location):
+            problems.append('the stray change to notes.txt did not stay in the working tree')
+        branch, tagged = _remote_state(remote, 'v1.0.1')
+        if branch != _git(['rev-parse', 'HEAD'], location) or tagged != branch:
+            problems.append('the remote did not get the branch and the tag together: ' + str((branch, tagged)))
+
+        # nothing differs from HEAD: no commit, the tag still arrives with the branch
+        head = _git(['rev-parse', 'HEAD'], location)
+        project = core.make_project_object(location)
+        project.meta['project_vcs']['version'] = '1.0.2'
+        project._release_git()
+        if _git(['rev-parse', 'HEAD'], location) != head:
+            problems.append('a release without changes made a commit')
+        branch, tagged = _remote_state(remote, 'v1.0.2')
+        if branch != head or tagged != head:
+            problems.append('the unchanged release did not push the tag on HEAD: ' + str((branch, tagged)))
+    return problems
+
+
+__all__ = [
+    'make_release_project',
+    'check_release']
@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import platform
+import tempfile
+from os.path import join
+from shutil import rmtree
+from time import perf_counter
+
+import spvm
+from spvm import config
+from spvm import core
+from spvm import ioutils
+from spvm import metautils
+from spvm import diagnostics
+from spvm import testcache
+from spvm.workspace import capture_output
+
+from .generate import generate_project
+
+RESULTS_VERSION = 1
+
+
+def _iter_paths(location):
+    for dirpath, dirnames, filenames in os.walk(location):
+        dirnames[:] = [d for d in dirnames if d != '.git']
+        yield dirpath
+        for f in filenames:
+            yield join(dirpath, f)
+
+
+def case_meta_load_validate(project):
+    metautils._meta_cache.clear()
+    meta = metautils.load_project_meta(project.projectMetaFile)
+    metautils.check_project_meta(meta)
+
+
+def case_match_gitignore(project):
+    for path in project.bench_paths:
+        project.match_gitignore(path)
+
+
+def case_get_project_size(project):
+    project.get_project_size()
+
+
+def case_file_index_refresh(project):
+    project.get_file_index().refresh()
+
+
+def case_tree_digest(project):
+    testcache.tree_digest(project.get_file_index())
+
+
+def case_call_check(project):
+    ioutils.call_check(project.location, ignore=project.meta['project_vcs']['ignored_errors'], exclude=project.gitignore)
+
+
+def case_diagnostics_cold(project):
+    cache_file = join(project.get_cache_dir(), diagnostics.CHECK_CACHE_FILE)
+    if os.path.isfile(cache_file):
+        os.remove(cache_file)
+    with open(os.devnull, 'w') as devnull:
+        project.write_diagnostics('jsonl', devnull)
+
+
+def case_diagnostics_cached(project):
+    with open(os.devnull, 'w') as devnull:
+        project.write_diagnostics('jsonl', devnull)
+
+
+def case_print_version_status(project):
+    project.print_version_status()
+
+
+def case_mock_release(project):
+    project.release('patch')
+
+
+# name -> (function, run with the output captured)
+CASES = {
+    'meta_load_validate': (case_meta_load_validate, False),
+    'match_gitignore': (case_match_gitignore, False),
+    'get_project_size': (case_get_project_size, False),
+    'file_index_refresh': (case_file_index_refresh, False),
+    'tree_digest': (case_tree_digest, False),
+    'call_check': (case_call_check, True),
+    'diagnostics_cold': (case_diagnostics_cold, False),
+    'diagnostics_cached': (case_diagnostics_cached, False),
+    'print_version_status': (case_print_version_status, True),
+    'mock_release': (case_mock_release, True)
+}
+
+
+def time_case(function, project, repeat, captured):
+    runs = []
+    for _ in range(repeat):
+        start = perf_counter()
+        if captured:
+            with capture_output():
+                function(project)
+        else:
+            function(project)
+        runs.append(perf_counter() - start)
+    return {'min': min(runs), 'mean': sum(runs) / len(runs), 'max': max(runs), 'runs': runs}
+
+
+def run_benchmarks(packages=5, files=20, depth=3, commits=100, repeat=3, cases=None, location=None, seed=0):
+    """
+    Generate a synthetic project and time the spvm hot paths on it
+    Returns the results as a JSON serializable dict
+    """
+    config.config.update({'mock': True, 'ask': False, 'check': False, 'test': False, 'update': False, 'repair': False})
+    keep = location is not None
+    if location is None:
+        location = join(tempfile.mkdtemp(prefix='spvm-bench-'), 'benchproject')
+
+    try:
+        params = generate_project(location, packages, files, depth, commits, seed)
+        project = core.make_project_object(location)
+        project.bench_paths = list(_iter_paths(location))
+        params['paths'] = len(project.bench_paths)
+
+        results = {}
+        for name in cases or CASES:
+            function, captured = CASES[name]
+            results[name] = time_case(function, project, repeat, captured)
+            print(name.ljust(24) + ' min %.4fs  mean %.4fs' % (results[name]['min'], results[name]['mean']), file=sys.stderr)
+    finally:
+        if not keep:
+            rmtree(os.path.dirname(location), True)
+
+    return {
+        'version': RESULTS_VERSION,
+        'spvm': spvm.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'repeat': repeat,
+        'results': results
+    }
+
+
+def compare_results(old, new):
+    """
+    Get [(case, old min, new min, new / old)] for the cases present in both results
+    """
+    rows = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before, after = old['results'][name]['min'], result['min']
+        rows.append((name, before, after, after / before if before > 0 else float('inf')))
+    return rows
+
+
+def load_results(path):
+    with open(path, 'r') as fh:
+        return json.loads(fh.read())
+
+
+__all__ = [
+    'CASES',
+    'run_benchmarks',
+    'compare_results',
+    'load_results']
@@ -0,0 +1,161 @@
+import os
+import email.parser
+import hashlib
+import zipfile
+import tempfile
+import threading
+from os.path import join, basename
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from spvm import upload
+
+# Fields the legacy endpoint (warehouse) refuses an upload without
+REQUIRED_FIELDS = [':action', 'protocol_version', 'name', 'version', 'filetype', 'pyversion', 'metadata_version',
+                   'md5_digest', 'sha256_digest', 'content']
+
+
+def parse_form(content_type, body):
+    """
+    {name: [value]} of a multipart/form-data body, the values of file fields are (filename, bytes)
+    """
+    message = email.parser.BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+    form = {}
+    for part in message.get_payload():
+        name = part.get_param('name', header='Content-Disposition')
+        data = part.get_payload(decode=True)
+        filename = part.get_filename()
+        form.setdefault(name, []).append(data.decode() if filename is None else (filename, data))
+    return form
+
+
+class LegacyUploadHandler(BaseHTTPRequestHandler):
+    """
+    A stand-in for the legacy upload endpoint (POST /legacy/) and its simple index (GET /simple/<name>/)
+    The multipart fields and digests are checked like the real one, a file can only be uploaded once
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, reason, body=''):
+        self.send_response(status, reason)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body.encode())))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'simple' or parts[1] not in self.server.projects:
+            return self._reply(404, 'Not Found')
+        links = ''.join('<a href="../../files/' + f + '">' + f + '</a>\n' for f in sorted(self.server.projects[parts[1]]))
+        self._reply(200, 'OK', '<html><body>\n' + links + '</body></html>\n')
+
+    def do_POST(self):
+        self.server.requests += 1
+        if self.path.rstrip('/') != '/legacy':
+            return self._reply(404, 'Not Found')
+        if self.headers.get('Authorization') is None:
+            return self._reply(401, 'Unauthorized')
+        if 'Content-Length' not in self.headers or 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            return self._reply(411, 'Length Required')
+
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        form = parse_form(self.headers['Content-Type'], body)
+        missing = [f for f in REQUIRED_FIELDS if f not in form]
+        if len(missing) > 0:
+            return self._reply(400, 'Missing fields: ' + ', '.join(missing))
+        if form[':action'][0] != 'file_upload':
+            return self._reply(400, 'Unknown action')
+
+        filename, data = form['content'][0]
+        if hashlib.md5(data).hexdigest() != form['md5_digest'][0] or \
+                hashlib.sha256(data).hexdigest() != form['sha256_digest'][0]:
+            return self._reply(400, 'Invalid digest')
+
+        files = self.server.projects.setdefault(upload.normalize_name(form['name'][0]), {})
+        if filename in files:
+            return self._reply(400, 'File already exists')
+        files[filename] = {'size': len(data), 'signed': 'gpg_signature' in form, 'classifiers': form.get('classifiers', [])}
+        self._reply(200, 'OK')
+
+
+class UploadServer(object):
+    """
+    Run the stand-in server on a free local port, with UploadServer() as server: server.repository ...
+    """
+
+    def __init__(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), LegacyUploadHandler)
+        self.httpd.projects = {}  # normalized name -> {filename: info}
+        self.httpd.requests = 0
+        self.repository = 'http://127.0.0.1:' + str(self.httpd.server_address[1]) + '/legacy/'
+
+    @property
+    def projects(self):
+        return self.httpd.projects
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def make_wheel(directory, name='bench_project', version='1.0.0'):
+    """ A minimal wheel carrying only its metadata """
+    path = join(directory, name + '-' + version + '-py3-none-any.whl')
+    info = name + '-' + version + '.dist-info/'
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr(info + 'METADATA', 'Metadata-Version: 2.1\nName: ' + name + '\nVersion: ' + version +
+                    '\nSummary: Upload check\nClassifier: Programming Language :: Python :: 3\n\nDescription\n')
+        zf.writestr(info + 'WHEEL', 'Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: py3-none-any\n')
+        zf.writestr(name + '/__init__.py', '')
+    return path
+
+
+def check_upload():
+    """
+    Upload a wheel twice to the stand-in server, returns the list of problems (empty when it works)
+    The second upload must be skipped from the index without posting the file again
+    """
+    problems = []
+    with tempfile.TemporaryDirectory(prefix='spvm-upload-') as directory, UploadServer() as server:
+        wheel = make_wheel(directory)
+        with open(wheel + '.asc', 'w') as fh:
+            fh.write('-----BEGIN PGP SIGNATURE-----\n')
+
+        uploader = upload.Uploader(server.repository, 'user', 'password', retries=0)
+        first = uploader.upload([wheel])
+        if first[wheel] != upload.UPLOADED:
+            problems.append('first upload: ' + first[wheel])
+        stored = server.projects.get('bench-project', {}).get(basename(wheel))
+        if stored is None or stored['size'] != os.path.getsize(wheel) or not stored['signed']:
+            problems.append('the server did not store the signed wheel: ' + str(stored))
+
+        posts = server.requests
+        second = uploader.upload([wheel])
+        if second[wheel] != upload.SKIPPED:
+            problems.append('second upload: ' + second[wheel])
+        if server.requests != posts:
+            problems.append('the second upload posted the file again')
+
+        uploader.index_url = None  # no index to ask, the endpoint answers "already exists"
+        third = uploader.upload([wheel])
+        if third[wheel] != upload.SKIPPED:
+            problems.append('upload without index: ' + third[wheel])
+    return problems
+
+
+__all__ = [
+    'parse_form',
+    'LegacyUploadHandler',
+    'UploadServer',
+    'make_wheel',
+    'check_upload']
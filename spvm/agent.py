@@ -0,0 +1,292 @@
+import splogger as log
+import os
+import sys
+import json
+import stat
+import struct
+import socket
+import hashlib
+import tempfile
+import socketserver
+import subprocess
+from os.path import join
+from threading import Thread, Lock
+from time import sleep, time
+
+from . import ioutils
+
+SOCKET_ENV = 'SPVM_AGENT_SOCK'
+SOCKET_NAME = 'spvm-agent.sock'
+IDLE_TIMEOUT = 900  # seconds without a request before the agent exits
+LOG_NAME = 'agent.log'
+RECORD_NAME = 'agent.path'  # where the socket is, when it lives in a temporary directory
+
+
+def get_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or join(os.path.expanduser('~'), '.cache')
+    path = join(base, 'spvm')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def is_private(path, mask=0o077):
+    """ path is owned by the user and gives no permission in mask to the others """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return st.st_uid == os.getuid() and st.st_mode & mask == 0
+
+
+def _runtime_dir():
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime) and is_private(runtime):
+        return runtime
+    return None
+
+
+def socket_path():
+    """
+    The agent socket of the user: $SPVM_AGENT_SOCK, else in the (private) runtime directory,
+    else the one recorded by the running agent. None if there is none
+    """
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    if _runtime_dir() is not None:
+        return join(_runtime_dir(), SOCKET_NAME)
+    try:
+        with open(join(get_cache_dir(), RECORD_NAME), 'r') as fh:
+            return fh.read().strip() or None
+    except OSError:
+        return None
+
+
+def new_socket_path():
+    """
+    Where a starting agent listens: like socket_path, or in a new 0700 directory (as ssh-agent does)
+    whose socket is recorded in the user cache for the clients
+    """
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    if _runtime_dir() is not None:
+        return join(_runtime_dir(), SOCKET_NAME)
+    path = join(tempfile.mkdtemp(prefix='spvm-agent-'), SOCKET_NAME)
+    ioutils.atomic_write(join(get_cache_dir(), RECORD_NAME), path + '\n')
+    return path
+
+
+def is_trusted_socket(path):
+    """ The socket and its directory belong to the user and nobody else can replace the socket """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        is_socket = stat.S_ISSOCK(os.lstat(path).st_mode)
+    except OSError:
+        return False
+    return is_socket and is_private(path, 0o022) and is_private(directory, 0o022)
+
+
+def logins_key(encrypted):
+    """ Logins are kept per encrypted content, an edited .logins is decrypted again """
+    return hashlib.sha256(encrypted.encode()).hexdigest()
+
+
+def _peer_uid(sock):
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+class Agent(object):
+    """
+    Holds decrypted logins in memory, never on disk, until stopped or idle for idle_timeout seconds
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.logins = {}  # logins_key -> decrypted logins
+        self.lock = Lock()
+        self.last_request = time()
+        self.server = None
+
+    def handle(self, message):
+        with self.lock:
+            self.last_request = time()
+            command = message.get('command')
+            if command == 'ping':
+                return {'ok': True, 'pid': os.getpid(), 'entries': len(self.logins), 'idle_timeout': self.idle_timeout}
+            if command == 'get':
+                logins = self.logins.get(message.get('key'))
+                return {'ok': logins is not None, 'logins': logins}
+            if command == 'add':
+                self.logins[message['key']] = message['logins']
+                return {'ok': True}
+            if command == 'clear':
+                self.logins.clear()
+                return {'ok': True}
+            if command == 'stop':
+                self.logins.clear()
+                Thread(target=self.server.shutdown, daemon=True).start()
+                return {'ok': True}
+            return {'ok': False, 'error': 'Unknown command ' + str(command)}
+
+    def watch_idle(self):
+        while True:
+            sleep(min(5, self.idle_timeout))
+            with self.lock:
+                idle = time() - self.last_request
+            if idle >= self.idle_timeout:
+                log.success('Idle for ' + str(int(idle)) + 's, stopping')
+                self.logins.clear()
+                self.server.shutdown()
+                return
+
+
+def _remove_socket(path):
+    if os.path.exists(path):
+        os.remove(path)
+    if not os.path.basename(os.path.dirname(path)).startswith('spvm-agent-'):
+        return
+    # the temporary directory of the socket and its record
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+    record = join(get_cache_dir(), RECORD_NAME)
+    try:
+        with open(record, 'r') as fh:
+            if fh.read().strip() == path:
+                os.remove(record)
+    except OSError:
+        pass
+
+
+def serve(idle_timeout=IDLE_TIMEOUT):
+    """
+    Run the agent until it is stopped or idle for too long
+    Only processes of the same user are answered
+    Returns False if an agent already runs
+    """
+    agent = Agent(idle_timeout)
+    current = socket_path()
+    if current is not None and os.path.exists(current):
+        if request({'command': 'ping'}) is not None:
+            log.error('An agent is already running on ' + current)
+            return False
+        if not is_trusted_socket(current):
+            log.error(current + ' does not belong to you, remove it or set ' + SOCKET_ENV)
+            return False
+        log.fine('Removing the stale socket ' + current)
+        _remove_socket(current)
+    path = new_socket_path()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            uid = _peer_uid(self.connection)
+            if uid is not None and uid != os.getuid():
+                log.warning('Refused a request from uid ' + str(uid))
+                return
+            try:
+                answer = agent.handle(json.loads(self.rfile.readline().decode()))
+            except Exception as ex:
+                answer = {'ok': False, 'error': repr(ex)}
+            self.wfile.write((json.dumps(answer) + '\n').encode())
+
+    old_umask = os.umask(0o077)
+    try:
+        agent.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    finally:
+        os.umask(old_umask)
+    agent.server.daemon_threads = True
+
+    Thread(target=agent.watch_idle, daemon=True).start()
+    log.success('spvm agent listening on ' + path)
+    try:
+        agent.server.serve_forever()
+    finally:
+        agent.server.server_close()
+        _remove_socket(path)
+        log.success('spvm agent stopped')
+    return True
+
+
+def _is_user_peer(sock):
+    uid = _peer_uid(sock)
+    return uid is None or uid == os.getuid()
+
+
+def request(message):
+    """
+    Send a request to the agent of the user, None if it is not running
+    The logins are only sent to a socket of the user, served by a process of the user
+    """
+    path = socket_path()
+    if path is None or not os.path.exists(path):
+        return None
+    if not is_trusted_socket(path):
+        log.warning('Not using ' + path + ': it or its directory is not private to you')
+        return None
+    return ioutils.unix_request(path, message, check_peer=_is_user_peer)
+
+
+def start(idle_timeout=IDLE_TIMEOUT):
+    """
+    Start the agent in the background, returns once it answers
+    """
+    if request({'command': 'ping'}) is not None:
+        log.warning('An agent is already running on ' + socket_path())
+        return True
+
+    base = get_cache_dir()
+    env = dict(os.environ)
+    # make sure this spvm is importable by the agent interpreter
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = package_parent + os.pathsep + env.get('PYTHONPATH', '')
+
+    with open(join(base, LOG_NAME), 'ab') as logfile:
+        subprocess.Popen([sys.executable, '-m', 'spvm.agent', str(idle_timeout)], env=env, start_new_session=True,
+                         stdin=subprocess.DEVNULL, stdout=logfile, stderr=logfile)
+
+    for _ in range(100):
+        sleep(0.1)
+        if request({'command': 'ping'}) is not None:
+            log.success('Agent started on ' + socket_path() + ', idle timeout ' + str(idle_timeout) + 's')
+            return True
+
+    log.error('The agent did not start, see ' + join(base, LOG_NAME))
+    return False
+
+
+def stop():
+    if request({'command': 'stop'}) is None:
+        log.warning('No agent running')
+        return False
+    log.success('Agent stopped, the logins were forgotten')
+    return True
+
+
+def get_logins(encrypted):
+    """ The logins of an encrypted .logins content the agent holds, None if there are none (or no agent) """
+    answer = request({'command': 'get', 'key': logins_key(encrypted)})
+    if answer is None or not answer['ok']:
+        return None
+    return answer['logins']
+
+
+def add_logins(encrypted, logins):
+    """ Hand decrypted logins to the agent if one runs, returns True if it took them """
+    answer = request({'command': 'add', 'key': logins_key(encrypted), 'logins': logins})
+    return answer is not None and answer['ok']
+
+
+__all__ = [
+    'serve',
+    'start',
+    'stop',
+    'request',
+    'get_logins',
+    'add_logins']
+
+
+if __name__ == '__main__':
+    sys.exit(0 if serve(float(sys.argv[1]) if len(sys.argv) > 1 else IDLE_TIMEOUT) else 1)
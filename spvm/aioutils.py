@@ -0,0 +1,193 @@
+import splogger as log
+import asyncio
+import os
+import sys
+import signal
+import weakref
+from asyncio.subprocess import PIPE, DEVNULL
+from collections import deque
+from subprocess import CalledProcessError, TimeoutExpired
+
+from time import time
+
+from . import profiling
+from .ioutils import TAIL_LINES
+
+CHUNK_SIZE = 65536
+
+# Maximum number of child processes running at once, most of them wait on I/O
+_concurrency = max(4, os.cpu_count() or 1)
+_limiters = weakref.WeakKeyDictionary()  # event loop -> semaphore
+
+
+def set_concurrency(n):
+    """ Change the maximum number of concurrent child processes """
+    global _concurrency
+    _concurrency = max(1, n)
+    _limiters.clear()
+
+
+def _get_limiter():
+    loop = asyncio.get_event_loop()
+    if loop not in _limiters:
+        _limiters[loop] = asyncio.Semaphore(_concurrency)
+    return _limiters[loop]
+
+
+async def _drain(stream, tail, captured, echo):
+    # read by chunks, readline() fails on lines longer than the stream limit (64KiB)
+    def keep(line):
+        line = line.decode(errors='replace')
+        tail.append(line)
+        if captured is not None:
+            captured.append(line)
+        if echo:
+            print(line, end='')
+
+    pending = b''
+    while True:
+        chunk = await stream.read(CHUNK_SIZE)
+        if chunk == b'':
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            keep(line + b'\n')
+    if pending != b'':
+        keep(pending)
+
+
+async def _feed(stream, inp):
+    try:
+        stream.write(inp.encode() if type(inp) == str else inp)
+        await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        stream.close()
+
+
+async def _kill(proc, group):
+    """ Kill the child, and its own children when it leads a process group """
+    if proc.returncode is None:
+        try:
+            if group:
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        log.debug('Killed child process ' + str(proc.pid))
+
+
+async def call_with_stdout_async(args, ignore_err=False, stdout=PIPE, inp=None, stderr=PIPE,
+                                 cwd=None, timeout=None, capture=True, new_session=None):
+    """
+    Asynchronous counterpart of ioutils.call_with_stdout
+    At most the configured number of processes run at once, the child process
+    is killed if the call is cancelled or times out
+    With new_session (by default when there is a timeout) the child gets its own session
+    and its whole process group is killed; it then has no controlling terminal
+    """
+    args = args.split(' ') if type(args) == str else args
+    verbose = log.get_verbose()
+    group = (timeout is not None if new_session is None else new_session) and os.name == 'posix'
+
+    async with _get_limiter():
+        started = time()
+        proc = await asyncio.create_subprocess_exec(*args, stdout=stdout, stderr=stderr,
+                                                    stdin=PIPE if inp is not None else None, cwd=cwd,
+                                                    start_new_session=group)
+        out_tail, err_tail = deque(maxlen=TAIL_LINES), deque(maxlen=TAIL_LINES)
+        captured = [] if capture and stdout == PIPE else None
+
+        io = []
+        if stdout == PIPE:
+            io.append(_drain(proc.stdout, out_tail, captured, verbose))
+        if stderr == PIPE:
+            io.append(_drain(proc.stderr, err_tail, None, verbose))
+        if inp is not None:
+            io.append(_feed(proc.stdin, inp))
+
+        code = None
+        try:
+            code = (await asyncio.wait_for(asyncio.gather(proc.wait(), *io), timeout))[0]
+        except asyncio.TimeoutError:
+            await _kill(proc, group)
+            raise TimeoutExpired(args, timeout, ''.join(out_tail), ''.join(err_tail))
+        except BaseException:
+            # cancelled
+            await _kill(proc, group)
+            raise
+        finally:
+            profiling.record_subprocess(args, cwd, started, code)
+
+    if code != 0 and not ignore_err:
+        if verbose:
+            log.error('Error from subprocess')
+        raise CalledProcessError(code, args, ''.join(out_tail), ''.join(err_tail))
+
+    return None if captured is None else ''.join(captured)
+
+
+async def call_python_async(module, args, stdout=None, stderr=None, cwd=None, capture=True):
+    mod = [] if module == '' else ['-m', module]
+    args = args.split(' ') if type(args) == str else args
+    return await call_with_stdout_async([sys.executable, *mod, *args], stdout=stdout, stderr=stderr, cwd=cwd, capture=capture)
+
+
+async def call_pip_async(args, verbose=None):
+    if verbose is None:
+        verbose = log.get_verbose()
+    fh = PIPE if verbose else DEVNULL
+    return await call_python_async('pip', args, stdout=fh, stderr=fh, capture=False)
+
+
+async def call_git_async(args, cwd=None):
+    args = 'git ' + args if type(args) == str else ['git', *args]
+    return await call_with_stdout_async(args, cwd=cwd)
+
+
+async def call_gpg_async(args, inp=None, verbose=None, cwd=None):
+    if verbose is None:
+        verbose = log.get_verbose()
+    fh = PIPE if verbose else DEVNULL
+    args = 'gpg ' + args if type(args) == str else ['gpg', *args]
+    return await call_with_stdout_async(args, inp=inp, stdout=fh, stderr=fh, cwd=cwd, capture=False)
+
+
+async def call_twine_async(args, cwd=None):
+    return await call_with_stdout_async('twine ' + args, stdout=None, cwd=cwd)
+
+
+async def gather(*aws):
+    """
+    Run the awaitables concurrently and return their results in order
+    On the first failure the others are cancelled (killing their processes) and the error is raised
+    """
+    tasks = [asyncio.ensure_future(a) for a in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def run(aw):
+    """ Run an awaitable to completion from synchronous code """
+    return asyncio.run(aw)
+
+
+__all__ = [
+    'set_concurrency',
+    'call_with_stdout_async',
+    'call_python_async',
+    'call_pip_async',
+    'call_git_async',
+    'call_gpg_async',
+    'call_twine_async',
+    'gather',
+    'run']
@@ -4,6 +4,12 @@ import os.path
 import splogger as log
 import spvm.core as core
 import spvm.config as cfg
+import spvm.workspace as workspace
+import spvm.daemon as daemon
+import spvm.agent as agent
+import spvm.ioutils as ioutils
+import spvm.diagnostics as diagnostics
+import spvm.profiling as profiling
 
 
 def get_project(projectname):
@@ -30,7 +36,20 @@ def get_project(projectname):
               help="Update dependencies before build")
 @click.option("-t", "--notest", is_flag=True, help="Skip the test part")
 @click.option("-y", "--yes", is_flag=True, help="No confirmation")
-def cli(verbose, mock, signed, repair, nocheck, update, notest, yes):
+@click.option("--force-test", is_flag=True,
+              help="Run the tests even if they already passed on the same tree")
+@click.option("--profile", is_flag=True,
+              help="Profile the command, writes a pstats file and collapsed stacks")
+@click.option("--profile-subprocesses", is_flag=True,
+              help="Time every child process of the command")
+@click.option("--profile-output", default='spvm-profile',
+              help="Path prefix of the profile files")
+@click.pass_context
+def cli(ctx, verbose, mock, signed, repair, nocheck, update, notest, yes, force_test, profile, profile_subprocesses,
+        profile_output):
+    if profile or profile_subprocesses:
+        profiling.start(functions=profile, subprocesses=profile_subprocesses)
+        ctx.call_on_close(lambda: profiling.stop(profile_output))
     log.set_verbose(verbose)
     log.debug('pwd: ' + os.getcwd())
 
@@ -41,6 +60,7 @@ def cli(verbose, mock, signed, repair, nocheck, update, notest, yes):
     cfg.config['update'] = update
     cfg.config['test'] = not notest
     cfg.config['ask'] = not yes
+    cfg.config['force_test'] = force_test
     if mock:
         log.warning('Mock Mode enabled')
     core.check_script_version()
@@ -70,24 +90,75 @@ def init(projectname):
 @cli.command()
 @click.option("-s", "--show", is_flag=True,
               help="Show the problems with the code")
+@click.option("--no-daemon", is_flag=True,
+              help="Do not ask a running spvm daemon")
+@click.option("-f", "--format", "fmt", type=click.Choice(['text', *diagnostics.WRITERS]), default='text',
+              help="jsonl or sarif stream the code diagnostics instead")
+@click.option("-o", "--output", default='-',
+              help="File the jsonl or sarif diagnostics are written to (default: stdout)")
+@click.option("-j", "--jobs", type=int, default=None,
+              help="Number of processes checking the files")
+@click.option("-t", "--timeout", type=float, default=None,
+              help="Seconds a section may take before it is shown as pending (default: wait for every section)")
 @click.argument('projectname', default=".")
-def status(projectname, show):
+def status(projectname, show, no_daemon, fmt, output, jobs, timeout):
     """ Print information about the project """
-    get_project(projectname).print_project_status(show)
+    if fmt != 'text':
+        project = get_project(projectname)
+        if project.meta is None:
+            log.error('Not a spvm project, run spvm init')
+            exit(1)
+        with diagnostics.data_output(output) as stream:
+            project.write_diagnostics(fmt, stream, jobs=jobs)
+        return
+
+    if not no_daemon:
+        output = daemon.daemon_status(projectname, show)
+        if output is not None:
+            print(output, end='')
+            return
+    get_project(projectname).print_project_status(show, timeout)
 
 
 @cli.command()
+@click.option("--dry-run", is_flag=True, help="Only tell what would be installed")
 @click.argument('projectname', default=".")
-def update(projectname):
-    """ Update the dependencies """
-    get_project(projectname).update_dependencies()
+def update(dry_run, projectname):
+    """ Install the missing and outdated dependencies """
+    get_project(projectname).update_dependencies(dry_run)
+
+
+@cli.command('lock')
+@click.argument('projectname', default=".")
+def lock_command(projectname):
+    """ Pin the dependencies with their hashes in pyp.lock """
+    get_project(projectname).lock()
 
 
 @cli.command()
+@click.option("-c", "--changed", is_flag=True,
+              help="Only run the tests affected by the changes since the last release")
+@click.option("-j", "--jobs", type=int, default=1,
+              help="Split the tests over this number of processes")
+@click.option("--matrix", is_flag=True,
+              help="Run the tests on every installed interpreter matching python_version")
 @click.argument('projectname', default=".")
-def test(projectname):
+def test(changed, jobs, matrix, projectname):
     """ Run the tests on the current project """
-    get_project(projectname).run_test()
+    if matrix:
+        get_project(projectname).run_test_matrix(changed)
+    else:
+        get_project(projectname).run_test(changed, jobs)
+
+
+@cli.command()
+@click.option("-T", "--no-test", is_flag=True, help="Only check the code")
+@click.option("-i", "--interval", type=float, default=1.0,
+              help="Polling interval in seconds when inotify is not available")
+@click.argument('projectname', default=".")
+def watch(no_test, interval, projectname):
+    """ Check the modified files and run the affected tests on every change """
+    get_project(projectname).watch(not no_test, interval)
 
 
 @cli.command()
@@ -170,6 +241,158 @@ def install(projectname):
     get_project(projectname).install_setup(True)
 
 
+@cli.command()
+@click.option("-f", "--force", is_flag=True, help="Replace an existing Dockerfile (kept as Dockerfile.backup)")
+@click.argument('projectname', default=".")
+def dockerfile(force, projectname):
+    """ Install the layer cache friendly Dockerfile template, built from the release wheel """
+    get_project(projectname).install_dockerfile(force)
+
+
+@cli.group()
+def ws():
+    """ Run a command on every spvm project of a workspace """
+    pass
+
+
+def _jobs_option(f):
+    return click.option("-j", "--jobs", type=int, default=None,
+                        help="Number of worker processes (default: cpu count)")(f)
+
+
+def _exit_on_failures(results):
+    if workspace.has_failures(results):
+        exit(1)
+
+
+@ws.command('status')
+@_jobs_option
+@click.option("-s", "--show", is_flag=True,
+              help="Show the problems with the code")
+@click.argument('root', default=".")
+def ws_status(jobs, show, root):
+    """ Print information about every project """
+    workspace.run_workspace(root, 'status', (show,), jobs=jobs)
+
+
+@ws.command('check')
+@_jobs_option
+@click.argument('root', default=".")
+def ws_check(jobs, root):
+    """ Check the code of every project """
+    _exit_on_failures(workspace.run_workspace(root, 'check', jobs=jobs))
+
+
+@ws.command('test')
+@_jobs_option
+@click.argument('root', default=".")
+def ws_test(jobs, root):
+    """ Run the tests of every project """
+    _exit_on_failures(workspace.run_workspace(root, 'test', jobs=jobs))
+
+
+@ws.command('release')
+@_jobs_option
+@click.argument('kind', default="pass")
+@click.argument('root', default=".")
+def ws_release(jobs, kind, root):
+    """
+    Release the projects changed since their last release and their dependents
+    Projects are released in dependency order, the pinned versions of the
+    dependents are updated with the new versions
+    """
+    _exit_on_failures(workspace.release_workspace(root, kind, jobs=jobs))
+
+
+@cli.group('agent')
+def agent_group():
+    """
+    Keep the decrypted logins in memory for the session, like ssh-agent
+    publish and release then ask for the passphrase once per .logins file
+    """
+    pass
+
+
+@agent_group.command('start')
+@click.option("-t", "--timeout", type=float, default=agent.IDLE_TIMEOUT,
+              help="Seconds without a request before the agent exits")
+@click.option("-f", "--foreground", is_flag=True, help="Do not detach")
+def agent_start(timeout, foreground):
+    """ Start the credential agent of the user """
+    if foreground:
+        if not agent.serve(timeout):
+            exit(1)
+    elif not agent.start(timeout):
+        exit(1)
+
+
+@agent_group.command('add')
+@click.argument('projectname', default=".")
+def agent_add(projectname):
+    """ Decrypt the .logins of a project now and hand them to the agent """
+    if agent.request({'command': 'ping'}) is None:
+        log.error('No agent running, run spvm agent start')
+        exit(1)
+    if ioutils.read_logins(os.path.abspath(projectname)) is None:
+        log.warning('No .logins file, run spvm login')
+
+
+@agent_group.command('clear')
+def agent_clear():
+    """ Make the agent forget every login """
+    if agent.request({'command': 'clear'}) is None:
+        log.warning('No agent running')
+        exit(1)
+    log.success('The agent forgot every login')
+
+
+@agent_group.command('stop')
+def agent_stop():
+    """ Stop the credential agent """
+    agent.stop()
+
+
+@cli.group('daemon')
+def daemon_group():
+    """
+    Keep the projects of a workspace loaded in a background process
+    spvm status answers from it while it runs
+    """
+    pass
+
+
+@daemon_group.command('start')
+@click.option("-f", "--foreground", is_flag=True, help="Do not detach")
+@click.argument('root', default=".")
+def daemon_start(foreground, root):
+    """ Start the daemon for the workspace at root """
+    if foreground:
+        daemon.serve(root)
+    elif not daemon.start(root):
+        exit(1)
+
+
+@daemon_group.command('stop')
+@click.argument('root', default=".")
+def daemon_stop(root):
+    """ Stop the daemon of the workspace at root """
+    daemon.stop(root)
+
+
+@daemon_group.command('status')
+@click.argument('root', default=".")
+def daemon_status(root):
+    """ Tell if a daemon serves root """
+    path = daemon.find_socket(root)
+    answer = None if path is None else daemon.request(path, {'command': 'ping'})
+    if answer is None:
+        log.warning('No daemon running')
+        exit(1)
+    log.success('Daemon ' + str(answer['pid']) + ' serving ' + answer['root'])
+    for location in answer['projects']:
+        log.fine('  ' + location)
+
+
 # @cli.command()
 # @click.argument('projectname', default=".")
 # def run():
@@ -2,6 +2,11 @@ import os
 from os.path import join
 
 metaFileName = "pyp.json"
+cacheDirName = ".spvm"  # per project caches, ignored by git
+lockFileName = "pyp.lock"  # resolved and hash pinned dependencies
+lockRequirementsName = "requirements.lock"  # the same pins, for pip -r
+dockerfileMarker = "# spvm Dockerfile"  # first line of the Dockerfiles spvm builds from build/docker
+statusTimeout = 10.0  # seconds a status section may take in the daemon before it is shown as pending
 scriptVersionCheckURL = None  # Last version
 metaFileLocation = join(os.path.dirname(__file__), 'res', metaFileName)
 
@@ -17,7 +22,9 @@ OPEN_PADLOCK = '🔓'
 
 config = {
     'mock': False,
-    'signed': False
+    'signed': False,
+    'isolated_tests': False,
+    'force_test': False
     #FIXME add other config (see cmd)
 }
 
@@ -1,36 +1,57 @@
 import splogger as log
 import os.path
+import sys
+import glob
 from os.path import join
 import json
 from colorama import Fore
 import subprocess
-from time import sleep
-from shutil import rmtree
+from time import sleep, time
+from shutil import rmtree, copyfile
 import urllib.parse
+import getpass
 import docker
 from threading import Thread
+from queue import Queue, Empty
 import re
 from subprocess import CalledProcessError
+from packaging.utils import parse_wheel_filename, canonicalize_name, InvalidWheelFilename
+from packaging.version import Version, InvalidVersion
 import spvm
 
 from . import config
 from . import ioutils
+from . import aioutils
+from . import upload
+from . import repair
 from . import metautils
+from . import testselect
+from . import testcache
+from . import watcher
+from . import diagnostics
+from . import deps
+from . import lock
+from . import matrix
+from . import fileindex
 
 
 class PYVSProject(object):
     """
-    A project object at the current cwd on which various actions are possible
+    A project object at a given location on which various actions are possible
+    The process cwd is never changed, so several projects can live in one process
     """
 
-    def __init__(self, location=os.getcwd()):
-        self.location = os.path.normpath(location)  # directory for project
-        if os.path.isdir(self.location):
-            os.chdir(self.location)
-            log.debug("cwd switched: " + self.location)
+    def __init__(self, location=None):
+        if location is None:
+            location = os.getcwd()
+        self.location = os.path.normpath(os.path.abspath(location))  # directory for project
         log.debug("New  project instance @ " + self.location)
         log.debug("Project status is: " + str(self.get_project_status()))
         self.projectMetaFile = join(self.location, config.metaFileName)
+        self.file_index = None
+        self.file_index_watched = False  # a watcher reports every change, no need to scan
+        self.release_files = set()  # files written by spvm, the release commit stages only these
+        self.code_problems = None  # check result left by repair for check_project, the tree did not change since
         self.maybe_load_meta()
         if self.meta is not None:
             metautils.check_project_meta(self.meta)
@@ -76,25 +97,55 @@ class PYVSProject(object):
             return config.STATUS_PROJECT_NOT_INITIALIZED
         return config.STATUS_PROJECT_INITIALIZED        # The spvm project is initiated
 
-    def check_code(self):
+    def check_code(self, files=None):
         """
         Run pyflakes and pycodestyle to check ode validity and pep8 conformity
         Reported problems are in the 2 returned arrays
+        With files (relative to the project), only these files are checked
         """
+        if files is not None:
+            files = [join(self.location, f) for f in files if os.path.isfile(join(self.location, f))]
 
-        flakes, pep = ioutils.call_check(self.location, ignore=self.meta['project_vcs']['ignored_errors'], exclude=self.gitignore)
+        flakes, pep = ioutils.call_check(self.location, ignore=self.meta['project_vcs']['ignored_errors'], exclude=self.gitignore, files=files)
 
         flakes = flakes.split('\n')[:-1]
         pep = pep.split('\n')[:-1]
 
         return flakes, pep
 
-    def run_test(self):
+    def write_diagnostics(self, fmt, stream, files=None, jobs=None):
+        """
+        Stream the pyflakes and pycodestyle diagnostics of the project to stream
+        fmt is jsonl or sarif, the summary holds the timings and the check cache hits
+        """
+        return diagnostics.write_diagnostics(self.location, self.meta['project_vcs']['ignored_errors'], self.get_file_index(),
+                                             self.get_cache_dir(), fmt, stream, files=files, jobs=jobs)
+
+    def run_test(self, changed=False, jobs=1, files=None):
         """
         Run the tests with pytest
+        With changed, only the tests importing code changed since the last release are run
+        With files (relative to the project), only the tests importing these files are run
+        With jobs > 1, the tests are split over as many pytest processes
+        A full suite that already passed on the same tree and environment is not run again,
+        unless forced with --force-test
         """
+        targets = self.get_test_targets(changed, files)
+        if targets is None:
+            return
+
+        results_key = None
+        if targets == self.location:
+            results_key = testcache.results_key(self.get_file_index())
+            if not config.config['force_test'] and testcache.has_passed(self.get_cache_dir(), results_key):
+                log.success('Tests already passed on this tree and environment, skipping (use --force-test to run them)')
+                return
+
         try:
-            ioutils.call_pytest(self.location)
+            if jobs > 1:
+                ioutils.call_pytest(targets, jobs=jobs, rootdir=self.location, cache_dir=self.get_cache_dir())
+            else:
+                ioutils.call_pytest(targets)
         except CalledProcessError as ex:
             if ex.returncode == 5:
                 log.warning('No tests were found')
@@ -105,14 +156,169 @@ class PYVSProject(object):
             log.error('Tests Failed')
             exit(1)
         log.success('Tests passed')
+        if results_key is not None:
+            testcache.record_pass(self.get_cache_dir(), results_key)
+
+    def get_test_targets(self, changed=False, files=None):
+        """
+        What to give pytest: the project, or the test modules affected by the changes
+        None if no test is affected
+        """
+        if not changed and files is None:
+            return self.location
+
+        tests = self.select_changed_tests(files)
+        if tests is None:
+            log.fine('Running the full test suite')
+            return self.location
+        if len(tests) == 0:
+            log.success('No test is affected by the changes')
+            return None
+        log.success('Running ' + str(len(tests)) + ' test module(s) affected by the changes')
+        return [join(self.location, t) for t in tests]
+
+    def run_test_matrix(self, changed=False):
+        """
+        Run the tests on every installed interpreter matching python_version, concurrently,
+        each in a venv cached per interpreter and dependency set
+        """
+        targets = self.get_test_targets(changed)
+        if targets is None:
+            return
+        targets = [targets] if type(targets) == str else targets
+
+        if not matrix.run_matrix(self.location, self.get_cache_dir(), self.meta['project_requirements']['python_version'],
+                                 self.meta['project_requirements']['python_packages'], targets):
+            log.error('Tests Failed')
+            exit(1)
+        log.success('Tests passed on every interpreter')
+
+    def select_changed_tests(self, changed=None):
+        """
+        Get the test modules affected by the changed files (since the last release by default)
+        Returns None when the full suite must be run
+        """
+        if changed is None:
+            changed = self.get_changed_files()
+        if changed is None:
+            log.warning('Cannot tell what changed since the last release')
+            return None
+        return testselect.select_tests(self.location, changed, self.get_file_index(), self.get_cache_dir())
+
+    def watch(self, test=True, interval=1.0, debounce=0.2):
+        """
+        Check the modified files and run the affected tests each time the project changes
+        Runs until interrupted
+        """
+        config.config['isolated_tests'] = True  # modules imported by a previous run would be stale
+        changes = Queue()
+        w = watcher.make_watcher(self.location, self.match_gitignore, changes.put, interval, debounce)
+        w.start()
+        self.get_file_index()
+        self.file_index_watched = True
+        log.success('Watching ' + self.location + ' (' + w.kind + '), Ctrl+C to stop')
+        try:
+            while True:
+                try:
+                    changed = changes.get(timeout=0.5)
+                except Empty:
+                    continue
+                self.on_watch_change(changed, test)
+        except KeyboardInterrupt:
+            log.fine('Stopped watching')
+        finally:
+            w.stop()
+
+    def on_watch_change(self, changed, test=True):
+        """
+        Check the changed files and run the affected tests
+        changed is None when the changes are unknown, everything is checked then
+        """
+        start = time()
+        if changed is not None:
+            changed = [c for c in changed if not c.startswith('.git' + os.sep)]
+            if len(changed) == 0:
+                return
+            log.fine(str(len(changed)) + ' file(s) changed: ' + ', '.join(changed[:5]) + (' ...' if len(changed) > 5 else ''))
+            if config.metaFileName in changed or '.gitignore' in changed:
+                self.maybe_load_meta()
+                self.load_gitignore()
+            self.get_file_index(changed)
+        else:
+            self.get_file_index().refresh()
+
+        if self.meta is None:
+            log.warning('No ' + config.metaFileName + ', nothing to check')
+            return
+
+        flakes, pep = self.check_code(changed)
+        for problem in flakes + pep:
+            print('> ' + Fore.RED + problem + Fore.RESET)
+        if len(flakes) + len(pep) == 0:
+            log.success('No problem found')
+
+        if test:
+            try:
+                self.run_test(files=changed)
+            except SystemExit:
+                pass  # the failure was reported, keep watching
+        log.success('Done in %.2fs' % (time() - start))
+
+    def get_cache_dir(self):
+        """
+        Get the spvm cache directory of the project, created on first use
+        """
+        return ioutils.get_cache_dir(self.location)
+
+    def track_release_file(self, path):
+        """ Remember a file written by spvm so the release commit includes it """
+        self.release_files.add(os.path.relpath(path, self.location))
+
+    def get_release_files(self):
+        """
+        The tracked files the release commit can stage: the ones that exist and are not git ignored
+        When spvm wrote nothing in this process (spvm publish git alone), the files a release updates
+        """
+        release_files = self.release_files
+        if len(release_files) == 0:
+            release_files = {config.metaFileName, join(self.get_name().lower(), '__init__.py'), 'setup.py'}
+        files = sorted(f for f in release_files if os.path.isfile(join(self.location, f)))
+        if len(files) == 0:
+            return files
+        # exit 1 when none is ignored
+        ignored = ioutils.call_with_stdout(['git', 'check-ignore', '--', *files], ignore_err=True, cwd=self.location)
+        ignored = set((ignored or '').split('\n'))
+        for f in files:
+            if f in ignored:
+                log.debug('Not staging the ignored ' + f)
+        return [f for f in files if f not in ignored]
+
+    def get_file_index(self, changed=None):
+        """
+        Get the persistent file index of the project, brought up to date
+        With changed (relative to the project), only these files are looked at
+        """
+        if self.file_index is None:
+            self.file_index = fileindex.FileIndex(self.location, self.match_gitignore, self.get_cache_dir())
+            self.file_index.refresh()
+        elif changed is None and self.file_index_watched:
+            pass
+        elif changed is None or '.gitignore' in changed:
+            self.file_index.refresh()
+        else:
+            self.file_index.refresh(changed)
+        return self.file_index
 
     def save_project_info(self):
         """
         Write the current project info to the metaFile
+        The file is only rewritten when the meta actually changed
         """
-        with open(self.projectMetaFile, 'w+') as fh:
-            fh.write(json.dumps(self.meta, indent=4))
-        log.debug('Saved project meta')
+        if metautils.save_project_meta(self.projectMetaFile, self.meta):
+            self.track_release_file(self.projectMetaFile)
+            log.debug('Saved project meta')
+        else:
+            log.debug('Project meta unchanged, not saved')
 
     @log.auto()
     def add_dependency(self, dep):
@@ -146,6 +352,8 @@ class PYVSProject(object):
 
         self.meta['project_requirements']['python_packages'].append(dep)
         self.save_project_info()
+        if os.path.isfile(join(self.location, config.lockFileName)):
+            log.warning(config.lockFileName + ' is now out of date, run spvm lock')
 
     def maybe_load_meta(self):
         """
@@ -154,9 +362,8 @@ class PYVSProject(object):
         self.meta = None
         if os.path.isfile(self.projectMetaFile):
             try:
-                with open(self.projectMetaFile, 'r') as fh:
-                    self.meta = json.loads(fh.read())
-                    log.debug('Loaded project meta')
+                self.meta = metautils.load_project_meta(self.projectMetaFile)
+                log.debug('Loaded project meta')
             except json.JSONDecodeError as e:
                 log.error(repr(e))
                 log.error(config.metaFileName + " is invalid")
@@ -186,20 +393,161 @@ class PYVSProject(object):
 
         log.success('Copying seyup.py from template')
         ioutils.copy(join(os.path.dirname(__file__), 'res', 'setup.py'), join(self.location, 'setup.py'))
+        self.track_release_file(join(self.location, 'setup.py'))
+
+    def install_dockerfile(self, force=False):
+        """
+        Install the template Dockerfile: dependency layer from the requirements,
+        application layer from the built wheel
+        """
+        path = join(self.location, 'Dockerfile')
+        already_present = os.path.isfile(path)
+        if already_present and not force:
+            log.warning('Dockerfile already present, it will not be replaced')
+            log.warning('Run spvm dockerfile -f to force Dockerfile replacement')
+            return
+
+        if already_present:
+            log.fine('Creating Dockerfile.backup')
+            ioutils.copy(path, join(self.location, 'Dockerfile.backup'))
+
+        with open(join(os.path.dirname(__file__), 'res', 'Dockerfile'), 'r') as fh:
+            template = fh.read()
+        with open(path, 'w') as fh:
+            # the module run by the image, a project name may hold dashes
+            fh.write(template.replace('%s', self.get_name().lower().replace('-', '_')))
+        log.success('Copied Dockerfile from template')
+
+    def is_managed_dockerfile(self):
+        """ The Dockerfile comes from the spvm template, the image is built from build/docker """
+        path = join(self.location, 'Dockerfile')
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'r') as fh:
+            return fh.readline().strip() == config.dockerfileMarker
+
+    def get_release_wheels(self):
+        """ The wheels of build/dist built for the current name and version of the project """
+        wheels = []
+        for path in sorted(glob.glob(join(self.location, 'build', 'dist', '*.whl'))):
+            try:
+                name, version, _, _ = parse_wheel_filename(os.path.basename(path))
+                current = Version(self.get_version())
+            except (InvalidWheelFilename, InvalidVersion) as ex:
+                log.debug('Not a wheel of this release: ' + repr(ex))
+                continue
+            if name == canonicalize_name(self.get_name()) and version == current:
+                wheels.append(path)
+        return wheels
+
+    def prepare_docker_context(self):
+        """
+        Fill build/docker with the Dockerfile, the requirements and the wheel of the release
+        (built again if build/dist does not hold it)
+        Only these files are sent to docker, the requirements alone key the dependency layer
+        Returns (context path, build args)
+        """
+        wheels = self.get_release_wheels()
+        if len(wheels) == 0:
+            self.clear_build()
+            self.build()
+            wheels = self.get_release_wheels()
+        if len(wheels) == 0:
+            log.error('No wheel was built for ' + self.get_name() + ' ' + self.get_version() + ', cannot build the image')
+            exit(1)
+
+        specs = self.meta['project_requirements']['python_packages']
+        python = '%d.%d' % sys.version_info[:2]
+        locked = lock.load_lock(self.location)
+        if lock.is_fresh(locked, specs):
+            requirements = lock.requirements_text(locked)
+            python = locked['python']
+            log.fine('Image dependencies from ' + config.lockFileName)
+        else:
+            requirements = ''.join(s + '\n' for s in sorted(specs))
+
+        context = join(self.location, 'build', 'docker')
+        rmtree(context, True)
+        os.makedirs(join(context, 'dist'))
+        ioutils.copy(join(self.location, 'Dockerfile'), join(context, 'Dockerfile'))
+        with open(join(context, 'requirements.txt'), 'w') as fh:
+            fh.write(requirements)
+        for wheel in wheels:
+            copyfile(wheel, join(context, 'dist', os.path.basename(wheel)))
+
+        return context, {'PYTHON_VERSION': python}
 
     @log.no_spinner()
     @log.element('Update project dependencies', log_entry=True)
-    def update_dependencies(self):
+    def update_dependencies(self, dry_run=False):
         """
-        Run a pip upgrade of the dependency list
+        Install the dependencies that are missing, do not match their specifier
+        or have a newer allowed version on the index, in a single pip call
         """
-        # ioutils.call_pip(
-        #     'install ' +
-        #     " ".join(
-        #         self.meta['project_requirements']['python_packages']) +
-        #     " --upgrade")
+        specs = self.meta['project_requirements']['python_packages']
+        locked = lock.load_lock(self.location)
+        if lock.is_fresh(locked, specs):
+            self.install_locked(locked, dry_run)
+            return
+        if locked is not None:
+            log.warning(config.lockFileName + ' does not match the dependencies, run spvm lock')
 
-        ioutils.install_packages(" ".join(self.meta['project_requirements']['python_packages']))
+        updates, unmanaged = deps.plan_updates(specs, self.get_cache_dir())
+        if len(updates) + len(unmanaged) == 0:
+            log.success('Every dependency is up to date')
+            return
+
+        for req, current, target, reason in updates:
+            log.fine(req.name + ': ' + reason + ' (' + str(current) + ' -> ' + ('?' if target is None else str(target)) + ')')
+        for spec in unmanaged:
+            log.fine(spec + ': not installed from this url, left to pip')
+        if dry_run:
+            return
+
+        before = deps.environment_versions()
+        ioutils.install_packages(deps.install_args(updates, unmanaged))
+        log.success('Installed ' + str(len(updates) + len(unmanaged)) + ' dependency(ies), changes:')
+        if deps.print_diff(before, deps.environment_versions()) == 0:
+            log.success('Nothing changed')
+
+    def install_locked(self, locked, dry_run=False):
+        """
+        Install the packages whose installed version is not the locked one, without resolution
+        """
+        names = lock.outdated_packages(locked)
+        if len(names) == 0:
+            log.success('Every dependency matches ' + config.lockFileName)
+            return
+        for name in names:
+            log.fine(name + ': ' + locked['packages'][name]['version'] + ' from ' + config.lockFileName)
+        if dry_run:
+            return
+
+        before = deps.environment_versions()
+        if lock.install_locked(self.location, locked, names):
+            # the verification results were written back
+            self.track_release_file(join(self.location, config.lockFileName))
+            self.track_release_file(join(self.location, config.lockRequirementsName))
+        log.success('Installed ' + str(len(names)) + ' locked package(s), changes:')
+        if deps.print_diff(before, deps.environment_versions()) == 0:
+            log.success('Nothing changed')
+
+    @log.element('Locking dependencies', log_entry=True)
+    def lock(self):
+        """
+        Resolve the dependencies once and pin them with the hashes of their files
+        in pyp.lock (and requirements.lock for pip)
+        """
+        specs = self.meta['project_requirements']['python_packages']
+        previous = lock.load_lock(self.location)
+        try:
+            locked = lock.make_lock(specs, previous)
+        except CalledProcessError as ex:
+            log.error('Could not resolve the dependencies')
+            log.error(repr(ex))
+            exit(1)
+        lock.save_lock(self.location, locked)
+        log.success('Locked ' + str(len(locked['packages'])) + ' package(s) in ' + config.lockFileName)
 
     def up_version(self, kind):  # FIXME other to 0
         """
@@ -245,12 +593,41 @@ class PYVSProject(object):
 
     @log.element('🔧 Code repair', log_entry=True)
     def repair(self):
-        ioutils.call_python('autopep8', '-ra --in-place .')
+        """
+        Run autopep8 on the files reported by the code check and the files changed
+        since the last release. Only the files whose content changes are written
+        Returns the list of the rewritten files
+        """
+        flakes, pep = self.check_code()
+        files = repair.flagged_files(flakes + pep)
+
+        changed = self.get_changed_files()
+        if changed is not None:
+            files.update(join(self.location, f) for f in changed if f.endswith('.py') and os.path.isfile(join(self.location, f)))
+
+        if len(files) == 0:
+            log.success('Nothing to repair')
+            self.code_problems = flakes, pep
+            return []
+
+        log.fine('Repairing ' + str(len(files)) + ' file(s)')
+        fixed = repair.fix_files(files)
+        for f in fixed:
+            self.track_release_file(f)
+        log.success(str(len(fixed)) + ' file(s) repaired')
+
+        # only the rewritten files need to be checked again
+        if len(fixed) > 0:
+            kept = [[l for l in problems if os.path.abspath(l.split(':')[0]) not in fixed] for problems in (flakes, pep)]
+            again = self.check_code(fixed)
+            flakes, pep = kept[0] + again[0], kept[1] + again[1]
+        self.code_problems = flakes, pep
+        return fixed
 
     def populate_init(self):
         """ Populate the <proj>/__init__.py with meta info """
         log.debug('Populating the __init__')
-        init_path = join(self.get_name().lower(), '__init__.py')
+        init_path = join(self.location, self.get_name().lower(), '__init__.py')
 
         with open(init_path, 'r') as fh:
             init_file = fh.read()
@@ -276,6 +653,7 @@ class PYVSProject(object):
         os.remove(init_path)
         with open(init_path, 'w+') as fh:
             fh.write(init_file)
+        self.track_release_file(init_path)
 
         log.success('Populated __init__.py')
 
@@ -373,8 +751,12 @@ class PYVSProject(object):
                 f.__call__()
 
     def check_project(self):
-        """ Check code and exit if not conform """
-        pf, pe = self.check_code()
+        """ Check code and exit if not conform, reuses the check of the repair that just ran """
+        if self.code_problems is not None:
+            pf, pe = self.code_problems
+            self.code_problems = None
+        else:
+            pf, pe = self.check_code()
 
         if len(pf) + len(pe) > 0:
             log.error('Project is not conform or has errors, run spvm status -s')
@@ -388,7 +770,7 @@ class PYVSProject(object):
     def build(self):
         log.success('Building package in ./build')
         try:
-            ioutils.call_python('', 'setup.py sdist -d build/dist bdist_wheel -d build/dist', stdout=subprocess.PIPE)
+            ioutils.call_python('', 'setup.py sdist -d build/dist bdist_wheel -d build/dist', stdout=subprocess.PIPE, cwd=self.location)
         except CalledProcessError as ex:
             log.error('Unable to build the package')
             log.error(repr(ex))
@@ -397,8 +779,8 @@ class PYVSProject(object):
     @log.element('Cleaning up', log_entry=True)
     def clear_build(self):
         # remove ./build ./<name>.egg-info
-        rmtree('./build', True)
-        rmtree('./' + self.get_name() + '.egg-info', True)
+        rmtree(join(self.location, 'build'), True)
+        rmtree(join(self.location, self.get_name() + '.egg-info'), True)
 
     @log.element('Publishing', log_entry=True)
     def publish(self, git=True, pypi=True, docker=True):
@@ -407,36 +789,48 @@ class PYVSProject(object):
         pypi = pypi and context[1]
         docker = docker and context[2]
 
-        logins = ioutils.read_logins()
+        logins = ioutils.read_logins(self.location)
+        if logins is None:
+            # no .logins: every publisher falls back to its own credentials (env, ~/.pypirc, prompt)
+            logins = config.NoFailReadOnlyDict({}, default=None)
 
         if git and not config.config['mock']:
             self._release_git(credentials = logins['git'])
         if pypi:
-            self._release_pypi(credentials = logins['pypi'])
+            # the docker image installs the wheel built for pypi
+            self._release_pypi(credentials = logins['pypi'], clean=not docker)
         if docker:
             self._release_docker(credentials = logins['docker'])
+            self.clear_build()
 
     @log.element('Git Publishing', log_entry=True)
     def _release_git(self, credentials = None):
-        if os.path.isfile('.git-credentials'):
-            os.remove('.git-credentials')
+        credentials_file = join(self.location, '.git-credentials')
+        if os.path.isfile(credentials_file):
+            os.remove(credentials_file)
             log.success('Removed dangling credential file')
 
 
         # Commit version
         commit_message = self.meta['project_vcs']['release']['commit_template'].replace('%s', self.meta['project_vcs']['version']).replace('"', '\\"').strip()
         log.debug('Commit message: ' + commit_message)
-        ioutils.call_git('add .')
-
+        files = self.get_release_files()
         key = self.meta['project_vcs']['release']['git_signing_key']
-        if key != '':
-            log.success(Fore.GREEN + config.PADLOCK + 'Commit will be signed with ' + key)
-
-        ioutils.call_commit(commit_message, key=key)
+        staged = ''
+        if len(files) > 0:
+            log.debug('Staging ' + ', '.join(files))
+            ioutils.call_git(['add', '--', *files], cwd=self.location)
+            staged = ioutils.call_git(['diff', '--cached', '--name-only', '--', *files], cwd=self.location) or ''
+        if staged.strip() == '':
+            log.warning('Nothing to commit for the release, tagging the current HEAD')
+        else:
+            if key != '':
+                log.success(Fore.GREEN + config.PADLOCK + 'Commit will be signed with ' + key)
+            ioutils.call_commit(commit_message, key=key, cwd=self.location, files=files)
 
         # Tag version
         tag = self.meta['project_vcs']['release']['tag_template'].replace('%s', self.meta['project_vcs']['version'])
-        ioutils.call_git('tag ' + ('' if key == '' else '-u ' + key + ' ') + '-m ' + tag + ' ' + tag)
+        ioutils.call_git('tag ' + ('' if key == '' else '-u ' + key + ' ') + '-m ' + tag + ' ' + tag, cwd=self.location)
         log.success('Tagged: ' + tag)
 
         try:
@@ -445,26 +839,24 @@ class PYVSProject(object):
             if credentials != None:
                 log.fine('Setting git credentials to temporary file')    
                 u = urllib.parse.urlparse(self.meta['project_vcs']['code_repository'])
-                with open('.git-credentials', 'w+') as fh:
+                with open(credentials_file, 'w+') as fh:
                     fh.write(u.scheme+'://'+credentials['login']+':'+credentials['password']+'@'+u.hostname+'\n')
-                ioutils.call_git(['config', 'credential.helper', 'store --file .git-credentials', '--replace-all'])
+                ioutils.call_git(['config', 'credential.helper', 'store --file .git-credentials', '--replace-all'], cwd=self.location)
                 log.success('Credentials are set')
 
-            # Push
+            # Push the branch and the tag at once, the remote gets both or none
             repo = self.meta['project_vcs']['code_repository']
             log.success('Pushing to ' + repo)
-            ioutils.call_git('push ' + repo + ' --signed=if-asked')
-            log.success('Pushing tags')
-            ioutils.call_git('push ' + repo + ' --tags --signed=if-asked')
+            ioutils.call_git(['push', '--atomic', '--signed=if-asked', repo, 'HEAD', 'refs/tags/' + tag], cwd=self.location)
 
         finally:
             if credentials != None:
-                os.remove('.git-credentials')
+                os.remove(credentials_file)
                 log.success('Removed temporary credential file')
 
     
     @log.element('Package Release', log_entry=True)
-    def _release_pypi(self, sign=True, credentials = None):
+    def _release_pypi(self, sign=True, credentials = None, clean=True):
         # 🔒 🔐 🔏 🔓
         if self.meta['project_vcs']['pypi_repository'] == '':
             log.success('Nothing to push to pypi')
@@ -474,7 +866,8 @@ class PYVSProject(object):
         if sign:
             self._sign_package()
         self._pypi_upload(credentials)
-        self.clear_build()
+        if clean:
+            self.clear_build()
 
     @log.clear()
     def _pypi_upload(self, credentials = None):
@@ -486,7 +879,31 @@ class PYVSProject(object):
         else:
             rep = self.meta['project_vcs']['pypi_repository']
         log.success('Uploading to ' + rep)
-        ioutils.call_twine('upload --repository-url ' + rep + ' ./build/dist/*' + ('' if credentials == None else ' -u '+credentials['login']+ ' -p '+credentials['password']))
+
+        if credentials == None:
+            credentials = {'login': os.environ.get('TWINE_USERNAME'), 'password': os.environ.get('TWINE_PASSWORD')}
+            pypirc = upload.read_pypirc(rep)
+            if pypirc is not None:
+                credentials['login'] = credentials['login'] or pypirc[0]
+                credentials['password'] = credentials['password'] or pypirc[1]
+            if (credentials['login'] is None or credentials['password'] is None) and not (sys.stdin.isatty() and os.isatty(1)):
+                # nobody to answer a prompt (ws release workers, CI), it would hang
+                log.error(Fore.RED + 'No credentials for ' + rep + ', set TWINE_USERNAME and TWINE_PASSWORD, '
+                          'add them to ~/.pypirc or the .logins file' + Fore.RESET)
+                exit(1)
+            if credentials['login'] is None:
+                credentials['login'] = input('Username for ' + rep + ': ')
+            if credentials['password'] is None:
+                credentials['password'] = getpass.getpass('Password for ' + credentials['login'] + ': ')
+
+        dist = join(self.location, 'build', 'dist')
+        files = [join(dist, f) for f in sorted(os.listdir(dist)) if not f.endswith('.asc')]
+        try:
+            upload.Uploader(rep, credentials['login'], credentials['password']).upload(files)
+        except upload.UploadError as ex:
+            log.error(Fore.RED + str(ex) + Fore.RESET)
+            log.error('You can resume with: spvm publish pypi, files already on the index are skipped')
+            exit(1)
 
     @log.element('Package Signing')
     def _sign_package(self):
@@ -500,11 +917,24 @@ class PYVSProject(object):
 
         log.success('Signing the package with the key: ' + meta_key)
 
+        dist = join(self.location, 'build', 'dist')
+        files = sorted(os.path.relpath(join(place[0], f), self.location)
+                       for place in os.walk(dist) for f in place[2] if not f.endswith('.asc'))
+
         try:
-            for place in os.walk(join('.', 'build', 'dist')):
-                for f in place[2]:
-                    self._sign_file(join(place[0], f), meta_key)
-        except CalledProcessError as ex:
+            self._write_checksums(files)
+            files.append(join('build', 'SHA256SUMS'))
+
+            # The first signature unlocks the key in the agent, the others reuse it concurrently
+            try:
+                ioutils.call_with_stdout(['gpg-connect-agent', '/bye'], ignore_err=True)
+            except OSError as ex:
+                log.debug('Could not start the gpg agent up front: ' + repr(ex))
+            start = time()
+            self._sign_file(files[0], meta_key)
+            log.success('Signed ' + files[0] + ' (%.2fs)' % (time() - start))
+            aioutils.run(aioutils.gather(*[self._sign_file_async(f, meta_key) for f in files[1:]]))
+        except (CalledProcessError, OSError) as ex:
             log.error(Fore.RED + config.OPEN_PADLOCK + ' Could not sign the package' + Fore.RESET)
             log.error('The program will now stop, you can resume with: spvm publish pypi')
             log.error('When the issues are fixed')
@@ -514,9 +944,24 @@ class PYVSProject(object):
 
         log.success(Fore.GREEN + config.PADLOCK + ' Package Signed with key: ' + meta_key + Fore.RESET)
 
+    def _write_checksums(self, files):
+        """ Write build/SHA256SUMS for the given files (relative to the project) """
+        lines = [ioutils.sha256(join(self.location, f)) + '  ' + os.path.basename(f) for f in files]
+        with open(join(self.location, 'build', 'SHA256SUMS'), 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+        log.success('Wrote checksums of ' + str(len(files)) + ' file(s) to build/SHA256SUMS')
+
+    def _sign_args(self, file, meta_key):
+        return ('-u ' + meta_key + ' ' if meta_key != '' else '') + '-b --yes -a -o ' + file + '.asc ' + file
+
     def _sign_file(self, file, meta_key):
-        ioutils.call_gpg(('-u ' + meta_key + ' ' if meta_key != '' else '') + '-b --yes -a -o ' + file + '.asc ' + file)
-    
+        ioutils.call_gpg(self._sign_args(file, meta_key), cwd=self.location)
+
+    async def _sign_file_async(self, file, meta_key):
+        start = time()
+        await aioutils.call_gpg_async(self._sign_args(file, meta_key), cwd=self.location)
+        log.success('Signed ' + file + ' (%.2fs)' % (time() - start))
+
     @log.element('Docker Publishing', log_entry=True)
     def _release_docker(self, credentials = None):
         log.success('Building Docker Image')
@@ -563,13 +1008,21 @@ class PYVSProject(object):
                     print('\033[K' + status[e]['str'])
                 # print('\n'*i, end = '')
 
-        # FIXME choose dockerfile
+        locked = lock.load_lock(self.location)
+        if locked is not None and not lock.is_fresh(locked, self.meta['project_requirements']['python_packages']):
+            log.warning(config.lockRequirementsName + ' does not match the dependencies, run spvm lock')
+
         rep = self.meta['project_vcs']['docker_repository']
         log.success('Image repo: ' + rep)
         if hasattr(client, 'api'):
             client = client.api
 
-        g = client.build(tag=rep, path='.', dockerfile='Dockerfile')
+        if self.is_managed_dockerfile():
+            context, buildargs = self.prepare_docker_context()
+            log.fine('Building from ' + context)
+            g = client.build(tag=rep, path=context, dockerfile='Dockerfile', buildargs=buildargs)
+        else:
+            g = client.build(tag=rep, path=self.location, dockerfile='Dockerfile')
 
         for line in g:
             _show_docker_progress(json.loads(line.decode()))
@@ -609,94 +1062,112 @@ class PYVSProject(object):
     def _run(self, name):
         log.success('Running script: '+name)
         script = self.meta['scripts'][name]
-        ioutils.call_with_stdout(['/bin/sh', '-c', script], stdout=None, stderr=None)
+        ioutils.call_with_stdout(['/bin/sh', '-c', script], stdout=None, stderr=None, cwd=self.location)
 
 
     def login(self):
-        ioutils.ask_logins()
+        ioutils.ask_logins(self.location)
 
         
 
     # PRINT INFOS #
 
-    def print_version_status(self):
+    def collect_version_status(self):
         """
-        Print information about the version of the project
-        And code versioning related
+        Get the versioning information of the project, None without a git repo
+        The git calls run concurrently
         """
-        p = nice_print_value
+        if not os.path.isdir(join(self.location, '.git')):
+            return None
 
-        p('     Version Info', kc=Fore.GREEN)
-        if not os.path.isdir(join(self.location, '.git')) or ioutils.call_git('branch') == '':
-            print(Fore.RED + 'No git repo initialized, versioning info not available' + Fore.RESET)
-            p('')
-            return
-
-        tags = ioutils.call_git('tag --sort=-creatordate') + '\n' + 'None'
+        async def collect():
+            return await aioutils.gather(*[aioutils.call_git_async(args, cwd=self.location) for args in
+                                           ['branch --no-color', 'tag --sort=-creatordate', 'rev-parse --short HEAD',
+                                            'rev-list --all --count']])
 
-        p('Current Version:', self.get_version())
-        p('Current branch:', ioutils.call_git('branch --no-color').split()[1])
-        p('Current commit:', ioutils.call_git('rev-parse --short HEAD').strip())
-        p('Commit count:', ioutils.call_git('rev-list --all --count').strip())
-        p('Last Tag:', tags.split()[0])
-        p('')
+        try:
+            branch, tags, commit, count = aioutils.run(collect())
+        except CalledProcessError:
+            return None  # no commit yet
+        if branch == '':
+            return None
+
+        return {
+            'branch': branch.split()[1],
+            'commit': commit.strip(),
+            'count': count.strip(),
+            'tag': (tags + '\n' + 'None').split()[0]
+        }
+
+    def render_version_status(self, info):
+        p = format_value
+        lines = [p('     Version Info', kc=Fore.GREEN)]
+        if info is None:
+            return lines + [Fore.RED + 'No git repo initialized, versioning info not available' + Fore.RESET, p('')]
+
+        return lines + [
+            p('Current Version:', self.get_version()),
+            p('Current branch:', info['branch']),
+            p('Current commit:', info['commit']),
+            p('Commit count:', info['count']),
+            p('Last Tag:', info['tag']),
+            p('')]
 
-    def print_code_status(self, show=False):
-        flakes, pep = self.check_code()
-        p = nice_print_value
+    def print_version_status(self):
+        """
+        Print information about the version of the project
+        And code versioning related
+        """
+        print_lines(self.render_version_status(self.collect_version_status()))
 
-        p('\r     Code Status   ', kc=Fore.GREEN)
+    def render_code_status(self, problems, show=False):
+        flakes, pep = problems
+        p = format_value
 
         vcf = Fore.LIGHTGREEN_EX if len(flakes) == 0 else Fore.LIGHTRED_EX
         vcp = Fore.LIGHTGREEN_EX if len(pep) == 0 else Fore.LIGHTRED_EX
 
-        p('Errors & Warnings:', str(len(flakes)), vc=vcf)
-        p('Conformity Problems:', str(len(pep)), vc=vcp)
-        p('')
+        lines = [
+            p('     Code Status   ', kc=Fore.GREEN),
+            p('Errors & Warnings:', str(len(flakes)), vc=vcf),
+            p('Conformity Problems:', str(len(pep)), vc=vcp),
+            p('')]
 
         if show:
-            p('Errors & Warnings', kc=Fore.LIGHTYELLOW_EX)
+            lines.append(p('Errors & Warnings', kc=Fore.LIGHTYELLOW_EX))
             if len(flakes) == 0:
-                print(Fore.GREEN + ' Nothing to display')
-            for ew in flakes:
-                print('> ' + Fore.RED + ew + Fore.RESET)
-            p('')
-            p('Conformity issues', kc=Fore.LIGHTYELLOW_EX)
+                lines.append(Fore.GREEN + ' Nothing to display')
+            lines += ['> ' + Fore.RED + ew + Fore.RESET for ew in flakes]
+            lines.append(p(''))
+            lines.append(p('Conformity issues', kc=Fore.LIGHTYELLOW_EX))
             if len(pep) == 0:
-                print(Fore.GREEN + ' Nothing to display')
-            for ew in pep:
-                print('> ' + Fore.RED + ew + Fore.RESET)
+                lines.append(Fore.GREEN + ' Nothing to display')
+            lines += ['> ' + Fore.RED + ew + Fore.RESET for ew in pep]
+        return lines
 
-    def print_dependencies(self):
-        p = nice_print_value
+    def print_code_status(self, show=False):
+        print_lines(['\r'] + self.render_code_status(self.check_code(), show))
 
-        p('     Project Dependencies', '(' + str(len(self.meta['project_requirements']['python_packages'])) + ')', kc=Fore.GREEN)
-        for name in self.meta['project_requirements']['python_packages']:
-            print(name)
+    def render_dependencies(self):
+        p = format_value
+        packages = self.meta['project_requirements']['python_packages']
+        return [p('     Project Dependencies', '(' + str(len(packages)) + ')', kc=Fore.GREEN)] + list(packages) + [p('')]
 
-        p('')
+    def print_dependencies(self):
+        print_lines(self.render_dependencies())
 
     @log.element(action='Calculating size...')
     def get_project_size(self):
-        total_size = 0
-        for dirpath, _, filenames in os.walk(self.location):
-
-            if self.match_gitignore(dirpath):
-                log.debug('Ignored ' + dirpath)
-                continue
-
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                total_size += os.path.getsize(fp)
-
-        return sizeof_fmt(total_size)
+        return sizeof_fmt(self.get_file_index().total_size())
 
     def match_gitignore(self, name):
         return ioutils.match_gitignore(name, self.gitignore)
 
     def load_gitignore(self):
+        # the spvm cache holds whole venvs, ignored by its own .gitignore
+        cache = join(self.location, config.cacheDirName) + ',' + join(self.location, config.cacheDirName, '*')
         if not os.path.isfile(join(self.location, '.gitignore')):
-            self.gitignore = ''
+            self.gitignore = cache
             return
 
         with open(join(self.location, '.gitignore'), 'r') as fh:
@@ -704,39 +1175,56 @@ class PYVSProject(object):
             gi = gi.replace('\n\n', '\n').strip().split('\n')
             gi = [join(self.location, e) for e in gi]
             gi.append(join(self.location, '.git'))
+            gi.append(cache)
             self.gitignore = ','.join(gi)
             log.debug('Ignoring: ' + self.gitignore)
 
-    @log.clear()
-    def print_project_status(self, show=False):
+    def print_project_status(self, show=False, timeout=None, stream=None, running=None):
         """
-        Print information about the project
+        Print information about the project, to stream (stdout by default)
+        The sections are collected concurrently and the report is written at once,
+        a section still running after timeout seconds (if given) is shown as pending
+        running is passed to collect_concurrently
+        Returns False if a section was pending
         """
-        p = nice_print_value
         sts = self.get_project_status()
 
         if sts != config.STATUS_PROJECT_INITIALIZED:
-            print(Fore.RED + 'Enable SPVM to print project status\nspvm init' + Fore.RESET)
-            return
-
-        nice_print_value('      Project Info', kc=Fore.GREEN)
-        p('~~~~~~~~~~~~~~~~~~~~~~~~~~')
-        p('Project Name:', self.get_name())
-        p('Project Version:', self.get_version())
-        p('Project Size:', self.get_project_size())
-        p('Project SPVM Status:', sts)
-        p('')
-        p('~~~~~~~~~~~~~~~~~~~~~~~~~~')
-
-        self.print_version_status()
-        p('~~~~~~~~~~~~~~~~~~~~~~~~~~')
-        self.print_code_status(show)
-        p('~~~~~~~~~~~~~~~~~~~~~~~~~~')
-        self.print_dependencies()
-        p('~~~~~~~~~~~~~~~~~~~~~~~~~~')
-        # self.print_project_meta()
-        # print_docker_status()
-        # print_
+            print_lines([Fore.RED + 'Enable SPVM to print project status\nspvm init' + Fore.RESET], stream)
+            return True
+
+        # (title, collector, renderer of the collected value)
+        sections = [
+            ('      Project Info', lambda: sizeof_fmt(self.get_file_index().total_size()), lambda size: [
+                format_value('      Project Info', kc=Fore.GREEN),
+                format_value('~~~~~~~~~~~~~~~~~~~~~~~~~~'),
+                format_value('Project Name:', self.get_name()),
+                format_value('Project Version:', self.get_version()),
+                format_value('Project Size:', size),
+                format_value('Project SPVM Status:', sts),
+                format_value('')]),
+            ('     Version Info', self.collect_version_status, self.render_version_status),
+            ('     Code Status   ', self.check_code, lambda problems: self.render_code_status(problems, show)),
+            ('     Project Dependencies', lambda: None, lambda _: self.render_dependencies())]
+
+        results = collect_concurrently([collector for _, collector, _ in sections], timeout, running)
+
+        lines = ['\r']
+        for i, ((title, _, render), result) in enumerate(zip(sections, results)):
+            if i > 0:
+                lines.append(format_value('~~~~~~~~~~~~~~~~~~~~~~~~~~'))
+            if result is PENDING:
+                lines += [format_value(title, kc=Fore.GREEN),
+                          format_value('Pending:', 'not collected after %gs' % timeout, vc=Fore.YELLOW), format_value('')]
+            elif isinstance(result, BaseException):
+                log.debug('Status section failed: ' + repr(result))
+                lines += [format_value(title, kc=Fore.GREEN),
+                          format_value('Failed:', str(result) or type(result).__name__, vc=Fore.LIGHTRED_EX), format_value('')]
+            else:
+                lines += render(result)
+        lines.append(format_value('~~~~~~~~~~~~~~~~~~~~~~~~~~'))
+        print_lines(lines, stream)
+        return PENDING not in results
 
     # Userfull getters
 
@@ -746,9 +1234,100 @@ class PYVSProject(object):
     def get_name(self):
         return self.meta['project_info']['name']
 
+    def get_release_tag(self, version=None):
+        """ Tag of a release, the current (last released) version by default """
+        if version is None:
+            version = self.get_version()
+        return self.meta['project_vcs']['release']['tag_template'].replace('%s', version)
+
+    def get_last_release_ref(self):
+        """
+        Get the git tag of the last release, None if there is no release to compare to
+        """
+        try:
+            tag = self.get_release_tag()
+            ioutils.call_git(['rev-parse', '-q', '--verify', 'refs/tags/' + tag], cwd=self.location)
+            return tag
+        except CalledProcessError:
+            pass
+
+        try:
+            return ioutils.call_git(['describe', '--tags', '--abbrev=0'], cwd=self.location).strip()
+        except CalledProcessError:
+            return None
+
+    def get_changed_files(self, since=None):
+        """
+        List the files (relative to the project location) changed since a git revision,
+        the last release by default. Untracked files are included
+        Returns None when it cannot be known (no git repo or no release yet)
+        """
+        if since is None:
+            since = self.get_last_release_ref()
+            if since is None:
+                return None
+
+        try:
+            changed = ioutils.call_git(['diff', '--name-only', '--relative', since, '--', '.'], cwd=self.location).split('\n')
+            changed += ioutils.call_git(['ls-files', '--others', '--exclude-standard'], cwd=self.location).split('\n')
+        except CalledProcessError:
+            return None
+
+        return sorted(set(f for f in changed if f != ''))
+
+
+def format_value(key, value='', kc=Fore.WHITE, vc=Fore.LIGHTBLUE_EX):
+    return f'{kc}{key} {vc}{value}{Fore.RESET}\033[K'
+
 
 def nice_print_value(key, value='', kc=Fore.WHITE, vc=Fore.LIGHTBLUE_EX):
-    print(f'{kc}{key} {vc}{value}{Fore.RESET}\033[K')
+    print(format_value(key, value, kc, vc))
+
+
+def print_lines(lines, stream=None):
+    """ Write the lines to stream (stdout by default) with a single write """
+    stream = stream or sys.stdout
+    stream.write(''.join(line if line == '\r' else line + '\n' for line in lines))
+    stream.flush()
+
+
+PENDING = object()  # result of a collector that did not finish in time
+
+
+def collect_concurrently(collectors, timeout=None, running=None):
+    """
+    Run the collector functions in parallel (daemon) threads
+    Returns their results in order: the returned value, the raised exception,
+    or PENDING for the ones still running after timeout seconds (None waits for all)
+    running is a dict kept by the caller between calls: a collector still running from a
+    previous call (same position) is waited for again instead of being started twice
+    """
+    running = {} if running is None else running
+
+    def run(slot, collector):
+        try:
+            slot['result'] = collector()
+        except BaseException as ex:  # exit() included
+            slot['result'] = ex
+
+    slots = []
+    for i, collector in enumerate(collectors):
+        if i not in running:
+            slot = {'result': PENDING}
+            slot['thread'] = Thread(target=run, args=(slot, collector), daemon=True)
+            slot['thread'].start()
+            running[i] = slot
+        slots.append(running[i])
+
+    deadline = None if timeout is None else time() + timeout
+    for slot in slots:
+        slot['thread'].join(None if deadline is None else max(0, deadline - time()))
+
+    results = [slot['result'] for slot in slots]
+    for i, result in enumerate(results):
+        if result is not PENDING:
+            del running[i]
+    return results
 
 
 def make_project_object(location):
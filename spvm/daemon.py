@@ -0,0 +1,241 @@
+import splogger as log
+import io
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import socketserver
+import subprocess
+from os.path import join
+from threading import Thread, Lock
+from time import sleep, time
+
+from . import config
+from . import core
+from . import ioutils
+from . import watcher
+from . import workspace
+
+SOCKET_NAME = 'daemon.sock'
+LOG_NAME = 'daemon.log'
+POLL_INTERVAL = 0.5  # when inotify is not available
+# AF_UNIX paths are limited to about 108 bytes
+MAX_SOCKET_PATH = 100
+
+
+def socket_path(root):
+    path = join(os.path.abspath(root), config.cacheDirName, SOCKET_NAME)
+    if len(path) > MAX_SOCKET_PATH:
+        digest = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+        path = join(tempfile.gettempdir(), 'spvm-' + digest + '.sock')
+    return path
+
+
+def find_socket(location):
+    """
+    Find the socket of a daemon serving location, looking in location and its parents
+    """
+    location = os.path.abspath(location)
+    while True:
+        path = socket_path(location)
+        if os.path.exists(path):
+            return path
+        parent = os.path.dirname(location)
+        if parent == location:
+            return None
+        location = parent
+
+
+def request(path, message, timeout=10):
+    """
+    Send a request to the daemon listening on path
+    Returns the decoded answer, None if the daemon cannot be reached
+    """
+    return ioutils.unix_request(path, message, timeout)
+
+
+class ProjectState(object):
+    """
+    A warm project: the project object, its file snapshot and its rendered status
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self.lock = Lock()
+        self.project = self.load_project()
+        self.outputs = {}  # show flag -> rendered status
+        self.running = {}  # status collectors still running, reused by the next render
+        self.rendered_at = None
+        self.watcher = watcher.make_watcher(location, lambda p: self.project.match_gitignore(p), self.on_change, POLL_INTERVAL)
+
+    def load_project(self):
+        project = core.make_project_object(self.location)
+        project.get_file_index()
+        project.file_index_watched = True
+        return project
+
+    def on_change(self, changed):
+        log.debug(self.location + ': ' + ('unknown' if changed is None else str(len(changed))) + ' change(s)')
+        with self.lock:
+            # None: the watcher lost track of the changes
+            if changed is None or any(os.path.basename(p) in (config.metaFileName, '.gitignore') for p in changed):
+                self.project = self.load_project()
+            else:
+                self.project.get_file_index(changed)
+            self.outputs = {}
+            self.running = {}  # collecting the old tree, let them finish unused
+        self.warm()
+
+    def warm(self):
+        Thread(target=self.get_status, daemon=True).start()
+
+    def get_status(self, show=False):
+        with self.lock:
+            if show not in self.outputs:
+                buffer = io.StringIO()
+                complete = self.project.print_project_status(show, config.statusTimeout, buffer, self.running)
+                if not complete:
+                    return buffer.getvalue()  # rendered again on the next request
+                self.outputs[show] = buffer.getvalue()
+                self.rendered_at = time()
+            return self.outputs[show]
+
+
+class Daemon(object):
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.projects = {}
+        for location in workspace.discover_projects(self.root):
+            self.projects[location] = ProjectState(location)
+        self.server = None
+
+    def start(self):
+        for state in self.projects.values():
+            state.watcher.start()
+            state.warm()
+
+    def find_project(self, location):
+        location = os.path.abspath(location)
+        while location not in self.projects:
+            parent = os.path.dirname(location)
+            if parent == location:
+                return None
+            location = parent
+        return self.projects[location]
+
+    def handle(self, message):
+        command = message.get('command')
+        if command == 'ping':
+            return {'ok': True, 'root': self.root, 'pid': os.getpid(), 'projects': sorted(self.projects)}
+        if command == 'stop':
+            Thread(target=self.server.shutdown, daemon=True).start()
+            return {'ok': True}
+        if command == 'status':
+            state = self.find_project(message.get('project', self.root))
+            if state is None:
+                return {'ok': False, 'error': 'Unknown project'}
+            return {'ok': True, 'output': state.get_status(bool(message.get('show')))}
+        return {'ok': False, 'error': 'Unknown command ' + str(command)}
+
+
+def serve(root):
+    """
+    Run the daemon for the workspace at root until it is asked to stop
+    """
+    daemon = Daemon(root)
+    path = socket_path(root)
+    if os.path.exists(path):
+        os.remove(path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                answer = daemon.handle(json.loads(self.rfile.readline().decode()))
+            except Exception as ex:
+                answer = {'ok': False, 'error': repr(ex)}
+            self.wfile.write((json.dumps(answer) + '\n').encode())
+
+    old_umask = os.umask(0o077)
+    try:
+        daemon.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    finally:
+        os.umask(old_umask)
+    daemon.server.daemon_threads = True
+
+    daemon.start()
+    log.success('spvm daemon serving ' + daemon.root + ' on ' + path)
+    try:
+        daemon.server.serve_forever()
+    finally:
+        daemon.server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+        log.success('spvm daemon stopped')
+
+
+def start(root):
+    """
+    Start a daemon for root in the background, returns once it answers
+    """
+    root = os.path.abspath(root)
+    path = socket_path(root)
+    if os.path.exists(path) and request(path, {'command': 'ping'}) is not None:
+        log.warning('A daemon is already running for ' + root)
+        return True
+
+    cache_dir = ioutils.get_cache_dir(root)
+    env = dict(os.environ)
+    # make sure this spvm is importable by the daemon interpreter
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = package_parent + os.pathsep + env.get('PYTHONPATH', '')
+
+    with open(join(cache_dir, LOG_NAME), 'ab') as logfile:
+        subprocess.Popen([sys.executable, '-m', 'spvm.daemon', root], cwd=root, env=env, start_new_session=True,
+                         stdin=subprocess.DEVNULL, stdout=logfile, stderr=logfile)
+
+    for _ in range(100):
+        sleep(0.1)
+        if os.path.exists(path) and request(path, {'command': 'ping'}) is not None:
+            log.success('Daemon started for ' + root)
+            return True
+
+    log.error('The daemon did not start, see ' + join(cache_dir, LOG_NAME))
+    return False
+
+
+def stop(root):
+    path = socket_path(root)
+    if not os.path.exists(path) or request(path, {'command': 'stop'}) is None:
+        log.warning('No daemon running for ' + os.path.abspath(root))
+        return False
+    log.success('Daemon stopped')
+    return True
+
+
+def daemon_status(location, show=False):
+    """
+    Ask a running daemon for the status output of the project at location
+    Returns None when no daemon serves it
+    """
+    path = find_socket(location)
+    if path is None:
+        return None
+    answer = request(path, {'command': 'status', 'project': os.path.abspath(location), 'show': show},
+                     config.statusTimeout + 10)
+    if answer is None or not answer['ok']:
+        return None
+    return answer['output']
+
+
+__all__ = [
+    'serve',
+    'start',
+    'stop',
+    'request',
+    'find_socket',
+    'daemon_status']
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
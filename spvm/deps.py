@@ -0,0 +1,209 @@
+import splogger as log
+import os
+import json
+import importlib
+import importlib.metadata
+from os.path import join
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+from colorama import Fore
+from packaging.requirements import Requirement, InvalidRequirement
+from packaging.version import Version, InvalidVersion
+from packaging.utils import canonicalize_name
+
+from . import ioutils
+from .ioutils import query_get, atomic_write
+
+INDEX_URL = ioutils.PYPI_JSON_URL
+INDEX_CACHE_FILE = 'index.json'
+INDEX_CACHE_TTL = 3600  # seconds
+INDEX_JOBS = 8
+
+MISSING = 'missing'
+UNSATISFIED = 'unsatisfied'
+OUTDATED = 'outdated'
+
+
+def parse_requirement(spec):
+    """ The packaging Requirement of a dependency, None for urls, paths and other pip-only forms """
+    try:
+        return Requirement(spec)
+    except InvalidRequirement:
+        return None
+
+
+def installed_version(name):
+    try:
+        return Version(importlib.metadata.version(name))
+    except (importlib.metadata.PackageNotFoundError, InvalidVersion):
+        return None
+
+
+def installed_versions(names):
+    importlib.invalidate_caches()
+    return {canonicalize_name(n): installed_version(n) for n in names}
+
+
+def environment_versions():
+    """ {canonical name: version string} of every installed distribution """
+    importlib.invalidate_caches()
+    return {canonicalize_name(d.metadata['Name']): d.version for d in importlib.metadata.distributions()
+            if d.metadata['Name'] is not None}
+
+
+def direct_url(name):
+    """
+    The url an installed distribution was installed from (PEP 610 direct_url.json), in requirement form:
+    vcs+url@revision for vcs checkouts. None if it is not installed or came from an index
+    """
+    try:
+        content = importlib.metadata.distribution(name).read_text('direct_url.json')
+    except importlib.metadata.PackageNotFoundError:
+        return None
+    if content is None:
+        return None
+    try:
+        info = json.loads(content)
+    except ValueError:
+        return None
+    url = info.get('url')
+    vcs = info.get('vcs_info')
+    if url is not None and vcs is not None:
+        url = vcs['vcs'] + '+' + url + ('@' + vcs['requested_revision'] if vcs.get('requested_revision') else '')
+    return url
+
+
+def _release_versions(info):
+    """ Versions of an index JSON document having at least one file that is not yanked """
+    versions = []
+    for version, files in info.get('releases', {}).items():
+        if len(files) == 0 or all(f.get('yanked', False) for f in files):
+            continue
+        try:
+            versions.append(Version(version))
+        except InvalidVersion:
+            continue
+    return versions
+
+
+def load_index(names, cache_dir, base_url=INDEX_URL, ttl=INDEX_CACHE_TTL):
+    """
+    Get {canonical name: [available versions]} from the index JSON API
+    Answers are cached in the project cache for ttl seconds, the missing ones are fetched concurrently
+    A name the index could not tell about maps to None
+    """
+    cache_file = join(cache_dir, INDEX_CACHE_FILE)
+    cache = {}
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'r') as fh:
+                cache = json.loads(fh.read())
+        except ValueError:
+            log.debug('Invalid index cache, ignoring it')
+
+    now = time()
+    names = sorted(set(canonicalize_name(n) for n in names))
+    stale = [n for n in names if n not in cache or now - cache[n]['time'] > ttl]
+
+    def fetch(name):
+        try:
+            return name, [str(v) for v in _release_versions(query_get(base_url + name + '/json'))]
+        except Exception as ex:
+            log.debug('Index lookup failed for ' + name + ': ' + repr(ex))
+            return name, None
+
+    if len(stale) > 0:
+        log.fine('Querying the index for ' + str(len(stale)) + ' package(s)')
+        with ThreadPoolExecutor(max_workers=INDEX_JOBS) as pool:
+            for name, versions in pool.map(fetch, stale):
+                if versions is not None:
+                    cache[name] = {'time': now, 'versions': versions}
+        atomic_write(cache_file, json.dumps(cache))
+
+    return {n: [Version(v) for v in cache[n]['versions']] if n in cache else None for n in names}
+
+
+def latest_allowed(req, versions):
+    """ The newest version satisfying the requirement specifier, prereleases only if asked for """
+    allowed = list(req.specifier.filter(versions))
+    return max(allowed) if len(allowed) > 0 else None
+
+
+def plan_updates(specs, cache_dir, base_url=INDEX_URL):
+    """
+    Compare the installed distributions with the declared requirements and the index
+    Returns (updates, unmanaged): updates is a list of (requirement, installed, target, reason)
+    for the packages to install, unmanaged the url dependencies (name @ url) to install with pip,
+    the ones not installed from that url. Dependencies without a name (paths, bare urls) can not
+    be checked and are left out
+    """
+    reqs, unmanaged = [], []
+    for spec in specs:
+        req = parse_requirement(spec)
+        if req is None:
+            log.warning(spec + ': can not be checked, write it as name @ url to have it installed')
+        elif req.marker is not None and not req.marker.evaluate():
+            continue
+        elif req.url is not None:
+            if direct_url(req.name) != req.url.split('#')[0]:
+                unmanaged.append(spec)
+        else:
+            reqs.append(req)
+
+    installed = installed_versions([r.name for r in reqs])
+    index = load_index([r.name for r in reqs], cache_dir, base_url)
+
+    updates = []
+    for req in reqs:
+        name = canonicalize_name(req.name)
+        current = installed[name]
+        versions = index[name]
+        target = None if versions is None else latest_allowed(req, versions)
+
+        if current is None:
+            updates.append((req, current, target, MISSING))
+        elif not req.specifier.contains(current, prereleases=True):
+            updates.append((req, current, target, UNSATISFIED))
+        elif target is not None and target > current:
+            updates.append((req, current, target, OUTDATED))
+        elif versions is None:
+            log.debug('No index information for ' + req.name + ', kept at ' + str(current))
+
+    return updates, unmanaged
+
+
+def install_args(updates, unmanaged):
+    """ pip install arguments: exact pins when the target is known, the declared requirement otherwise """
+    args = []
+    for req, _, target, _ in updates:
+        # the markers were already evaluated
+        extras = '[' + ','.join(sorted(req.extras)) + ']' if len(req.extras) > 0 else ''
+        args.append(req.name + extras + (str(req.specifier) if target is None else '==' + str(target)))
+    return args + unmanaged
+
+
+def print_diff(before, after):
+    """ Print the version changes between two {name: version} dicts, returns the number of changes """
+    changes = 0
+    for name in sorted(set(before) | set(after)):
+        old, new = before.get(name), after.get(name)
+        if old == new:
+            continue
+        changes += 1
+        if old is None:
+            print(Fore.GREEN + '  + ' + name + ' ' + str(new) + Fore.RESET)
+        elif new is None:
+            print(Fore.RED + '  - ' + name + ' ' + str(old) + Fore.RESET)
+        else:
+            print(Fore.LIGHTBLUE_EX + '  ~ ' + name + ' ' + str(old) + ' -> ' + str(new) + Fore.RESET)
+    return changes
+
+
+__all__ = [
+    'plan_updates',
+    'install_args',
+    'installed_versions',
+    'direct_url',
+    'environment_versions',
+    'load_index',
+    'print_diff']
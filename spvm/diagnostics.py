@@ -0,0 +1,320 @@
+import splogger as log
+import os
+import sys
+import ast
+import json
+import hashlib
+import contextlib
+from os.path import join
+from time import time
+from concurrent.futures import ProcessPoolExecutor
+
+import spvm
+from .ioutils import atomic_write
+from .testselect import iter_python_files
+
+CHECK_CACHE_FILE = 'check-cache.json'
+CHECK_CACHE_VERSION = 1
+SARIF_SCHEMA = 'https://json.schemastore.org/sarif-2.1.0.json'
+
+# pyflakes messages reported as errors, the others are warnings
+PYFLAKES_ERRORS = ['SyntaxError', 'UndefinedName', 'UndefinedExport', 'UndefinedLocal']
+# Below this number of files to check, a process pool costs more than it saves
+MIN_PARALLEL_FILES = 16
+
+_style_guides = {}  # (location, ignored errors) -> pycodestyle.StyleGuide
+
+
+def diagnostic(tool, path, line, column, code, message, level='warning'):
+    return {'tool': tool, 'path': path, 'line': line, 'column': column, 'code': code,
+            'message': message, 'level': level}
+
+
+def run_pyflakes(path, source):
+    import pyflakes.checker
+
+    try:
+        tree = ast.parse(source, filename=path)
+    except (SyntaxError, ValueError) as ex:
+        return [diagnostic('pyflakes', path, getattr(ex, 'lineno', None) or 1, getattr(ex, 'offset', None) or 1,
+                           'SyntaxError', getattr(ex, 'msg', str(ex)), 'error')]
+
+    checker = pyflakes.checker.Checker(tree, filename=path)
+    found = []
+    for m in sorted(checker.messages, key=lambda m: (m.lineno, m.col)):
+        code = m.__class__.__name__
+        found.append(diagnostic('pyflakes', path, m.lineno, m.col + 1, code, m.message % m.message_args,
+                                'error' if code in PYFLAKES_ERRORS else 'warning'))
+    return found
+
+
+def _style_config_files(location):
+    """
+    The configuration files pycodestyle reads for the project: the user one, then the first
+    directory from location upwards holding a setup.cfg or tox.ini
+    """
+    import pycodestyle
+
+    found = [pycodestyle.USER_CONFIG] if pycodestyle.USER_CONFIG and os.path.isfile(pycodestyle.USER_CONFIG) else []
+    parent = os.path.abspath(location)
+    while True:
+        local = [join(parent, f) for f in pycodestyle.PROJECT_CONFIG if os.path.isfile(join(parent, f))]
+        if len(local) > 0:
+            return found + local
+        parent, tail = os.path.split(parent)
+        if tail == '':
+            return found
+
+
+def _get_style_guide(location, ignore):
+    import pycodestyle
+
+    if (location, ignore) not in _style_guides:
+        class Report(pycodestyle.BaseReport):
+            def __init__(self, options):
+                super().__init__(options)
+                self.found = []
+
+            def error(self, line_number, offset, text, check):
+                code = super().error(line_number, offset, text, check)
+                if code:
+                    self.found.append((line_number, offset + 1, code, text[len(code) + 1:]))
+                return code
+
+        ignored = [e for e in ignore.split(',') if e != '']
+        # the configuration is loaded like python -m pycodestyle in the project, --ignore still wins
+        guide = pycodestyle.StyleGuide(parse_argv=False, config_file=True, paths=[location],
+                                       ignore=ignored, quiet=True, reporter=Report)
+        _style_guides[(location, ignore)] = (guide, Report)
+    return _style_guides[(location, ignore)]
+
+
+def run_pycodestyle(location, path, lines, ignore):
+    import pycodestyle
+
+    guide, report_class = _get_style_guide(location, ignore)
+    report = report_class(guide.options)
+    pycodestyle.Checker(path, lines=lines, options=guide.options, report=report).check_all()
+    return [diagnostic('pycodestyle', path, line, column, code, message) for line, column, code, message in report.found]
+
+
+def check_file(job):
+    """
+    Run pyflakes and pycodestyle in process on one file
+    job is (location, path relative to location, ignored errors)
+    Returns (path, diagnostics, duration)
+    """
+    location, path, ignore = job
+    start = time()
+    with open(join(location, path), 'r', encoding='utf-8', errors='replace') as fh:
+        source = fh.read()
+    found = run_pyflakes(path, source) + run_pycodestyle(location, path, source.splitlines(True), ignore)
+    return path, found, time() - start
+
+
+def _cache_key(location, ignore):
+    import pyflakes
+    import pycodestyle
+
+    config = hashlib.sha256()
+    for f in _style_config_files(location):
+        with open(f, 'rb') as fh:
+            config.update(f.encode() + b'\0' + fh.read() + b'\0')
+    return '|'.join([str(CHECK_CACHE_VERSION), ignore, pyflakes.__version__, pycodestyle.__version__,
+                     config.hexdigest()])
+
+
+def load_check_cache(cache_dir, location, ignore):
+    """ Get {path: {mtime_ns, size, diagnostics}} of the files checked with the same settings """
+    cache_file = join(cache_dir, CHECK_CACHE_FILE)
+    if not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r') as fh:
+            data = json.loads(fh.read())
+        if data['key'] == _cache_key(location, ignore):
+            return data['files']
+    except (ValueError, KeyError):
+        log.debug('Invalid check cache, ignoring it')
+    return {}
+
+
+def save_check_cache(cache_dir, location, ignore, files):
+    atomic_write(join(cache_dir, CHECK_CACHE_FILE), json.dumps({'key': _cache_key(location, ignore), 'files': files}))
+
+
+def iter_diagnostics(location, ignore, index, cache_dir, files=None, jobs=None, stats=None):
+    """
+    Yield (path, diagnostics, cached) for every python file of the project as soon as it is checked
+    Files unchanged since they were last checked with the same settings come from the cache
+    stats (a dict) receives the counters and timings
+    """
+    stats = {} if stats is None else stats
+    start = time()
+    partial = files is not None
+    if files is None:
+        files = iter_python_files(index)
+
+    cache = load_check_cache(cache_dir, location, ignore)
+    entries = {}
+    to_check = []
+    stats.update({'files': 0, 'cache_hits': 0, 'checked': 0, 'diagnostics': 0, 'check_time': 0.0})
+
+    for path in files:
+        try:
+            st = os.stat(join(location, path))
+        except OSError:
+            continue
+        stats['files'] += 1
+        entry = cache.get(path)
+        if entry is not None and entry['mtime_ns'] == st.st_mtime_ns and entry['size'] == st.st_size:
+            entries[path] = entry
+            stats['cache_hits'] += 1
+            stats['diagnostics'] += len(entry['diagnostics'])
+            yield path, entry['diagnostics'], True
+        else:
+            entries[path] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'diagnostics': []}
+            to_check.append(path)
+
+    jobs_list = [(location, path, ignore) for path in to_check]
+    pool = None
+    try:
+        if len(jobs_list) < MIN_PARALLEL_FILES or jobs == 1:
+            results = map(check_file, jobs_list)
+        else:
+            pool = ProcessPoolExecutor(max_workers=jobs)
+            results = pool.map(check_file, jobs_list, chunksize=8)
+
+        for path, found, duration in results:
+            entries[path]['diagnostics'] = found
+            stats['checked'] += 1
+            stats['diagnostics'] += len(found)
+            stats['check_time'] += duration
+            yield path, found, False
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    # a complete run drops the deleted files from the cache, a partial one adds to it
+    if partial:
+        cache.update(entries)
+        entries = cache
+    if stats['checked'] > 0 or len(entries) != len(cache):
+        save_check_cache(cache_dir, location, ignore, entries)
+    stats['duration'] = time() - start
+
+
+class JsonLinesWriter(object):
+    """
+    One JSON object per line: a diagnostic, or the final summary
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def _write(self, obj):
+        self.stream.write(json.dumps(obj) + '\n')
+        self.stream.flush()
+
+    def begin(self, location):
+        pass
+
+    def add(self, path, found, cached):
+        for d in found:
+            self._write(dict(type='diagnostic', **d))
+
+    def end(self, stats):
+        self._write(dict(type='summary', **stats))
+
+
+class SarifWriter(object):
+    """
+    A SARIF 2.1.0 log, the results are written as they come
+    The run statistics are stored in the invocation properties
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.first = True
+
+    def begin(self, location):
+        tool = {'driver': {'name': 'spvm', 'version': spvm.__version__, 'informationUri': 'https://github.com/win32gg/spvm'}}
+        base = {'SRCROOT': {'uri': 'file://' + location.rstrip('/') + '/'}}
+        self.stream.write('{"$schema": ' + json.dumps(SARIF_SCHEMA) + ', "version": "2.1.0", "runs": [{"tool": ' +
+                          json.dumps(tool) + ', "originalUriBaseIds": ' + json.dumps(base) + ', "results": [')
+        self.stream.flush()
+
+    def add(self, path, found, cached):
+        for d in found:
+            result = {
+                'ruleId': d['tool'] + '/' + d['code'],
+                'level': d['level'],
+                'message': {'text': d['message']},
+                'locations': [{'physicalLocation': {
+                    'artifactLocation': {'uri': d['path'].replace(os.sep, '/'), 'uriBaseId': 'SRCROOT'},
+                    'region': {'startLine': d['line'], 'startColumn': d['column']}
+                }}]
+            }
+            self.stream.write(('' if self.first else ',') + '\n' + json.dumps(result))
+            self.first = False
+        if len(found) > 0:
+            self.stream.flush()
+
+    def end(self, stats):
+        invocation = {'executionSuccessful': True, 'properties': stats}
+        self.stream.write('\n], "invocations": [' + json.dumps(invocation) + ']}]}\n')
+        self.stream.flush()
+
+
+WRITERS = {
+    'jsonl': JsonLinesWriter,
+    'sarif': SarifWriter
+}
+
+
+@contextlib.contextmanager
+def data_output(path=None):
+    """
+    Get the stream the diagnostics are written to: the file at path, or stdout
+    While writing to stdout, everything else printed goes to stderr
+    """
+    if path is not None and path != '-':
+        with open(path, 'w') as fh:
+            yield fh
+        return
+
+    sys.stdout.flush()
+    saved = os.dup(1)
+    out = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    try:
+        yield out
+    finally:
+        out.close()
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def write_diagnostics(location, ignore, index, cache_dir, fmt, stream, files=None, jobs=None):
+    """
+    Check the project and stream the diagnostics to stream in the given format
+    Returns the stats of the run
+    """
+    writer = WRITERS[fmt](stream)
+    stats = {}
+    writer.begin(location)
+    for path, found, cached in iter_diagnostics(location, ignore, index, cache_dir, files, jobs, stats):
+        writer.add(path, found, cached)
+    writer.end(stats)
+    return stats
+
+
+__all__ = [
+    'WRITERS',
+    'check_file',
+    'iter_diagnostics',
+    'write_diagnostics',
+    'data_output',
+    'JsonLinesWriter',
+    'SarifWriter']
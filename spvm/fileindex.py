@@ -0,0 +1,230 @@
+import splogger as log
+import os
+import hashlib
+import sqlite3
+from os.path import join
+
+from . import config
+
+INDEX_DIR = 'index'
+INDEX_FILE = 'files.db'
+SCHEMA_VERSION = 1
+CHUNK_SIZE = 65536
+
+# Never indexed: the vcs, spvm's own caches and the interpreter/pytest droppings
+IGNORED_NAMES = ['.git', config.cacheDirName, '__pycache__', '.pytest_cache']
+
+DELETED = -1  # size of a deleted file, kept so deletions show in changed_since
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT,
+    changed INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_changed ON files (changed);
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, digest TEXT NOT NULL);
+'''
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _parents(path):
+    """ 'a/b/c.py' -> ['a/b', 'a', ''] """
+    parents = []
+    while path != '':
+        path = path.rpartition('/')[0]
+        parents.append(path)
+    return parents
+
+
+class FileIndex(object):
+    """
+    Persistent index of the project files: path (relative, / separated), size, mtime_ns
+    and a content hash computed on demand. Every refresh that finds a change starts a new
+    generation, changed_since(generation) lists what changed after it.
+    Directory digests are Merkle hashes of their content, cached until something below changes.
+    """
+
+    def __init__(self, location, ignore_match, cache_dir):
+        self.location = location
+        self.ignore_match = ignore_match
+        directory = join(cache_dir, INDEX_DIR)
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(join(directory, INDEX_FILE), timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        if self._get_meta('schema') != str(SCHEMA_VERSION):
+            with self.db:
+                self.db.execute('DELETE FROM files')
+                self.db.execute('DELETE FROM dirs')
+                self._set_meta('schema', str(SCHEMA_VERSION))
+                self._set_meta('generation', '0')
+
+    def close(self):
+        self.db.close()
+
+    def _get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    @property
+    def generation(self):
+        return int(self._get_meta('generation') or 0)
+
+    def _skip(self, path):
+        return os.path.basename(path) in IGNORED_NAMES or self.ignore_match(path)
+
+    def _scan(self):
+        """ {relative path: (size, mtime_ns)} of the files of the project, stat only """
+        found = []
+        stack = [self.location]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if self._skip(entry.path):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        found.append((os.path.relpath(entry.path, self.location).replace(os.sep, '/'), st.st_size, st.st_mtime_ns))
+        return {p: (size, mtime) for p, size, mtime in found}
+
+    def _stat(self, relpath):
+        """ (size, mtime_ns) of a file, None if it does not exist or is not indexed """
+        parts = relpath.split('/')
+        if any(self._skip(join(self.location, *parts[:i])) for i in range(1, len(parts) + 1)):
+            return None
+        path = join(self.location, relpath)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns) if os.path.isfile(path) else None
+
+    def refresh(self, paths=None):
+        """
+        Bring the index up to date and return the paths that changed
+        With paths (relative to the project, e.g. from a watcher) only these are looked at,
+        otherwise every file is stat'ed (nothing is read)
+        """
+        if paths is None:
+            current = self._scan()
+            known = {p: (s, m) for p, s, m in self.db.execute('SELECT path, size, mtime_ns FROM files WHERE size != ?', (DELETED,))}
+            candidates = set(current) | set(known)
+        else:
+            candidates = set(p.replace(os.sep, '/') for p in paths)
+            current = {}
+            for p in candidates:
+                st = self._stat(p)
+                if st is not None:
+                    current[p] = st
+            known = {}
+            for p in candidates:
+                row = self.db.execute('SELECT size, mtime_ns FROM files WHERE path = ? AND size != ?', (p, DELETED)).fetchone()
+                if row is not None:
+                    known[p] = tuple(row)
+
+        changed = sorted(p for p in candidates if current.get(p) != known.get(p))
+        if len(changed) == 0:
+            return []
+
+        generation = self.generation + 1
+        dirty = set()
+        with self.db:
+            for p in changed:
+                if p in current:
+                    size, mtime = current[p]
+                    self.db.execute('INSERT OR REPLACE INTO files (path, size, mtime_ns, hash, changed) VALUES (?, ?, ?, NULL, ?)',
+                                    (p, size, mtime, generation))
+                else:
+                    self.db.execute('UPDATE files SET size = ?, mtime_ns = 0, hash = NULL, changed = ? WHERE path = ?',
+                                    (DELETED, generation, p))
+                dirty.update(_parents(p))
+            self.db.executemany('DELETE FROM dirs WHERE path = ?', [(d,) for d in dirty])
+            self._set_meta('generation', str(generation))
+        log.debug('File index: ' + str(len(changed)) + ' change(s), generation ' + str(generation))
+        return changed
+
+    def files(self, prefix=''):
+        """ [(path, size, mtime_ns)] of the indexed files, under prefix if given """
+        rows = self.db.execute('SELECT path, size, mtime_ns FROM files WHERE size != ? ORDER BY path', (DELETED,))
+        return [tuple(r) for r in rows if prefix == '' or r[0].startswith(prefix.rstrip('/') + '/')]
+
+    def total_size(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM files WHERE size != ?', (DELETED,)).fetchone()[0]
+
+    def changed_since(self, generation):
+        """ Paths added, modified or deleted after the generation, in O(changes) """
+        return [r[0] for r in self.db.execute('SELECT path FROM files WHERE changed > ? ORDER BY path', (generation,))]
+
+    def hashes(self, paths=None):
+        """
+        {path: sha256} of the files (all of them by default), the missing hashes are computed and stored
+        """
+        rows = self.db.execute('SELECT path, hash FROM files WHERE size != ?', (DELETED,)).fetchall()
+        if paths is not None:
+            paths = set(paths)
+            rows = [r for r in rows if r[0] in paths]
+
+        result, computed = {}, []
+        for path, digest in rows:
+            if digest is None:
+                try:
+                    digest = file_hash(join(self.location, path))
+                except OSError:
+                    continue
+                computed.append((digest, path))
+            result[path] = digest
+        if len(computed) > 0:
+            with self.db:
+                self.db.executemany('UPDATE files SET hash = ? WHERE path = ?', computed)
+        return result
+
+    def dir_digest(self, directory=''):
+        """
+        Merkle digest of a directory (relative, '' for the project): hash of the names and digests of its children
+        """
+        directory = directory.replace(os.sep, '/').strip('/')
+        row = self.db.execute('SELECT digest FROM dirs WHERE path = ?', (directory,)).fetchone()
+        if row is not None:
+            return row[0]
+
+        prefix = '' if directory == '' else directory + '/'
+        hashes = self.hashes([p for p, _, _ in self.files(directory)])
+        children = {}
+        for path in hashes:
+            name = path[len(prefix):].split('/')[0]
+            children.setdefault(name, path[len(prefix):].count('/') > 0)
+
+        digest = hashlib.sha256()
+        for name in sorted(children):
+            child = self.dir_digest(prefix + name) if children[name] else hashes[prefix + name]
+            digest.update(('d ' if children[name] else 'f ').encode() + name.encode() + b'\0' + child.encode() + b'\n')
+        digest = digest.hexdigest()
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO dirs (path, digest) VALUES (?, ?)', (directory, digest))
+        return digest
+
+
+__all__ = [
+    'FileIndex',
+    'file_hash']
@@ -1,7 +1,10 @@
 import splogger as log
-from subprocess import Popen, PIPE, CalledProcessError
+from subprocess import Popen, PIPE, CalledProcessError, TimeoutExpired
+from threading import Thread
+from collections import deque
 import sys
 import os
+import signal
 import shutil
 import pytest
 import requests
@@ -12,46 +15,140 @@ import fnmatch
 import gnupg
 import json
 import getpass
+import socket
+import tempfile
 from .config import NoFailReadOnlyDict
 from datetime import datetime
+from time import time
 
 from . import config
+from . import profiling
 
 FNULL = open(os.devnull, 'w')
 
 
+# Number of output lines of each stream kept for error reports
+TAIL_LINES = 50
+DRAIN_TIMEOUT = 5  # seconds the output of a killed process is still read
+
+
+def _drain(pipe, callback, tail, captured):
+    for line in iter(pipe.readline, b''):
+        line = line.decode(errors='replace')
+        tail.append(line)
+        if captured is not None:
+            captured.append(line)
+        if callback is not None:
+            callback(line)
+    pipe.close()
+
+
+def _feed(pipe, inp):
+    try:
+        pipe.write(inp.encode() if type(inp) == str else inp)
+    except BrokenPipeError:
+        pass
+    finally:
+        pipe.close()
+
+
+def _kill_group(proc):
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except OSError:
+        proc.kill()
+
+
+def stream_process(args, on_stdout=None, on_stderr=None, stdout=PIPE, stderr=PIPE,
+                   inp=None, cwd=None, timeout=None, capture=False, tail=TAIL_LINES):
+    """
+    Run a process and hand its output to the callbacks line by line while it runs
+    Both pipes are drained concurrently so the process never blocks on a full pipe,
+    only the last tail lines of each stream are kept unless capture is set
+    Returns (return code, captured stdout or None, stdout tail, stderr tail)
+    Raises subprocess.TimeoutExpired after killing the process on timeout
+    """
+    args = args.split(' ') if type(args) == str else args
+    out_tail, err_tail = deque(maxlen=tail), deque(maxlen=tail)
+    captured = [] if capture and stdout == PIPE else None
+
+    # with a timeout the process gets its own group, so its children are killed with it
+    with Popen(args, stdout=stdout, stderr=stderr, stdin=PIPE if inp is not None else None, cwd=cwd,
+               start_new_session=timeout is not None and os.name == 'posix') as proc:
+        threads = []
+        if stdout == PIPE:
+            threads.append(Thread(target=_drain, args=(proc.stdout, on_stdout, out_tail, captured), daemon=True))
+        if stderr == PIPE:
+            threads.append(Thread(target=_drain, args=(proc.stderr, on_stderr, err_tail, None), daemon=True))
+        if inp is not None:
+            threads.append(Thread(target=_feed, args=(proc.stdin, inp), daemon=True))
+        for t in threads:
+            t.start()
+
+        try:
+            code = proc.wait(timeout=timeout)
+        except TimeoutExpired:
+            _kill_group(proc)
+            proc.wait()
+            # a child that escaped the group may still hold the pipes, do not wait for it
+            for t in threads:
+                t.join(DRAIN_TIMEOUT)
+            raise TimeoutExpired(args, timeout, ''.join(out_tail), ''.join(err_tail))
+        for t in threads:
+            t.join()
+
+    return code, None if captured is None else ''.join(captured), ''.join(out_tail), ''.join(err_tail)
+
+
 def call_with_stdout(args, ignore_err=False,
-                     stdout=PIPE, inp=None, stderr=PIPE):
-    with Popen(args.split(' ') if type(args) == str else args, stdout=stdout, stdin=PIPE if inp is not None else None, stderr=stderr) as proc:
-        out, err = proc.communicate(input=inp)
-        if proc.poll() != 0 and not ignore_err:
-            if log.get_verbose():
-                log.error('Error from subprocess')
-                if err is not None and err != '':
-                    print('err: ' + str(err), file=sys.stderr)
-                if out is not None and out != '':
-                    print('out: ' + str(out), file=sys.stderr)
-            raise CalledProcessError(proc.poll(), args, out, err)
-
-        if log.get_verbose():
-            log.debug('Output of '+repr(args))
-            if out is not None:
-                print(out.decode())
-            if err is not None:
-                print(err.decode())
-
-        if out is not None:
-            return out.decode()
+                     stdout=PIPE, inp=None, stderr=PIPE, cwd=None, timeout=None, capture=True):
+    """
+    Run a process, returning its stdout (when piped and captured)
+    In verbose mode the output is printed live
+    """
+    verbose = log.get_verbose()
+    if verbose:
+        log.debug('Output of ' + repr(args))
+    echo = (lambda line: print(line, end='')) if verbose else None
+
+    started = time()
+    code = None
+    try:
+        code, out, out_tail, err_tail = stream_process(args, on_stdout=echo, on_stderr=echo, stdout=stdout, stderr=stderr,
+                                                       inp=inp, cwd=cwd, timeout=timeout, capture=capture)
+    finally:
+        profiling.record_subprocess(args, cwd, started, code)
+    if code != 0 and not ignore_err:
+        if verbose:
+            log.error('Error from subprocess')
+        # the tails are kept for the error reports
+        raise CalledProcessError(code, args, out_tail, err_tail)
+
+    return out
+
+
 @log.clear()
-def read_logins():
-    if os.path.isfile('.logins'):
+def read_logins(location='.'):
+    logins_file = join(location, '.logins')
+    if os.path.isfile(logins_file):
         log.success(Fore.GREEN+config.PADLOCK+" Found crypted logins file"+Fore.RESET)
-        gpg = gnupg.GPG()
+        from . import agent
 
         cr = None
-        with open('.logins', 'r') as fh:
+        with open(logins_file, 'r') as fh:
             cr = fh.read()
-        
+        encrypted = cr
+
+        # already decrypted in this session
+        held = agent.get_logins(encrypted)
+        if held is not None:
+            log.success(Fore.GREEN+config.OPEN_PADLOCK+' Got logins for '+', '.join(held['data'])+' from the spvm agent'+Fore.RESET)
+            return NoFailReadOnlyDict(held['data'], default = None)
+
+        gpg = gnupg.GPG()
         crypt = None
         while True:
             passphrase = getpass.getpass('Passphrase for login file: ')
@@ -66,15 +163,18 @@ def read_logins():
         cr = json.loads(crypt.data)
         log.success('Logins creation time: '+cr['creation_date'])
         log.success(Fore.GREEN+config.OPEN_PADLOCK+' Got logins for '+', '.join(cr['data'])+Fore.RESET)
-        
+        if agent.add_logins(encrypted, cr):
+            log.fine('Logins handed to the spvm agent')
+
         return NoFailReadOnlyDict(cr['data'], default = None)
     return None
 
 def get_date(): 
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-def ask_logins():
-    if os.path.isfile('.logins'):
+def ask_logins(location='.'):
+    logins_file = join(location, '.logins')
+    if os.path.isfile(logins_file):
         log.warning(Fore.YELLOW+'The logins file already exist, overwrite it ?'+Fore.RESET)
         yes = input('Enter \'yes\' to overwrite: ')
         if yes != 'yes':
@@ -120,19 +220,84 @@ def ask_logins():
     ask_login(cr['data'], 'docker')
 
     gpg = gnupg.GPG()
-    gpg.encrypt(json.dumps(cr), (), symmetric=True, output='.logins')
+    gpg.encrypt(json.dumps(cr), (), symmetric=True, output=logins_file)
 
     try:
-        call_git('check-ignore .logins')
+        call_git('check-ignore .logins', cwd=location)
     except CalledProcessError:
-        with open('.gitignore', 'a') as fh:
+        with open(join(location, '.gitignore'), 'a') as fh:
             fh.write('\.logins')
         log.success('Appened .logins to .gitignore')
 
-def call_python(module, args, stdout=None, stderr=None):
+def call_python(module, args, stdout=None, stderr=None, cwd=None, capture=True):
+    """ args is a list, or a string split on spaces """
     mod = [] if module == '' else ['-m', module]
+    args = args.split(' ') if type(args) == str else args
     return call_with_stdout(
-        [sys.executable, *mod, *args.split(' ')], stdout=stdout, stderr=stderr)
+        [sys.executable, *mod, *args], stdout=stdout, stderr=stderr, cwd=cwd, capture=capture)
+
+
+def atomic_write(path, content, encoding=None, newline=None):
+    """
+    Write content to path through a temporary file and os.replace
+    Readers never see a partially written file
+    encoding and newline are those of open(), newline='' writes the line endings as they are
+    """
+    path = os.path.abspath(path)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding=encoding, newline=newline) as fh:
+            fh.write(content)
+        if os.path.isfile(path):
+            shutil.copymode(path, tmp)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+
+
+def get_cache_dir(location):
+    """
+    Get the spvm cache directory under location, created (and git ignored) on first use
+    """
+    cache_dir = join(location, config.cacheDirName)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(join(cache_dir, '.gitignore'), 'w') as fh:
+            fh.write('# Created by spvm\n*\n')
+        log.debug('Created cache directory ' + cache_dir)
+    return cache_dir
+
+
+def unix_request(path, message, timeout=10, check_peer=None):
+    """
+    Send a JSON line to the server listening on the unix socket path and read its JSON line answer
+    check_peer(connected socket) can refuse the server before anything is sent
+    Returns None if the server cannot be reached or was refused
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            if check_peer is not None and not check_peer(sock):
+                log.warning('Refused the server listening on ' + path)
+                return None
+            sock.sendall((json.dumps(message) + '\n').encode())
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = sock.recv(65536)
+                if chunk == b'':
+                    break
+                data += chunk
+        return json.loads(data.decode())
+    except (OSError, ValueError) as ex:
+        log.debug(path + ' unreachable: ' + repr(ex))
+        return None
 
 
 def copy(a, b):
@@ -142,6 +307,14 @@ def copy(a, b):
             tfh.write(ffh.read())
 
 
+PYPI_JSON_URL = 'https://pypi.org/pypi/'
+
+# Results of the verification of a downloaded package
+VERIFIED = 'verified'
+UNSIGNED = 'unsigned'
+UNCHECKED = 'unchecked'
+
+
 def query_get(url, make_json=True):
     req = requests.get(url)
     if not req.ok:
@@ -151,76 +324,109 @@ def query_get(url, make_json=True):
     return req.content
 
 
+def verify_package_file(path, base_url=PYPI_JSON_URL):
+    """
+    Check a downloaded distribution against the index: its md5 and, when published, its signature
+    Exits on a hash mismatch or an invalid signature
+    Returns VERIFIED, UNSIGNED or UNCHECKED (the check could not be done)
+    """
+    f = os.path.basename(path)
+    try:
+        splited = f.split('-')
+        log.debug('Checking ' + splited[0])
+        package_info = query_get(base_url + splited[0] + '/' + splited[1] + '/json')
+
+        for f_info in package_info['releases'][splited[1]]:
+            if f_info['filename'] != f:
+                continue
+
+            if md5(path) != f_info['md5_digest']:
+                log.error('Hash do not match')
+                exit(1)
+            # log.success(Fore.GREEN+'Hash checked for '+f)
+
+            if not f_info['has_sig']:
+                log.debug(Fore.YELLOW + 'No signature provided for ' + f_info['filename'])  # FIXME throw?
+                return UNSIGNED
+
+            sig = query_get(f_info['url'] + '.asc', False)
+            log.debug('File: ' + f_info['filename'] + ' has signature:\n ' + sig.decode())
+
+            # Check
+            q = '' if log.get_verbose() else ' --quiet'
+            try:
+                call_gpg('--no-default-keyring --keyring tmp.gpg' + q + ' --auto-key-retrieve --verify - ' + path, inp=sig)  # FIXME Only use known keys?
+            except CalledProcessError as er:
+                if er.returncode == 1:
+                    log.error(Fore.RED + config.OPEN_PADLOCK + ' Invalid signature for ' + f)
+                    exit(1)
+
+                log.error('Could not check signature for ' + f + ' (' + repr(er) + ')')
+                return UNCHECKED
+
+            log.success(Fore.GREEN + config.PADLOCK + ' File ' + f + ' is verified')
+            return VERIFIED
+
+        log.error('Could not find ' + f + ' on the index')
+        return UNCHECKED
+
+    except KeyboardInterrupt:
+        exit(2)
+    except SystemExit as e:
+        raise e
+    except BaseException as be:
+        log.error(Fore.RED + config.OPEN_PADLOCK + ' Failed to check ' + f + Fore.RESET)
+        log.error(repr(be))
+        return UNCHECKED
+
+
 def install_packages(args, check_signatures=None):
+    """
+    Install the requirements in args, a list or a string split on spaces
+    A list keeps requirements holding spaces (name @ url) whole
+    """
     if check_signatures is None:
         check_signatures = config.config['signed']
+    args = args.split(' ') if type(args) == str else args
 
     if not check_signatures:
-        call_pip('install ' + args, verbose=True)
+        call_pip(['install', *args], verbose=True)
         return
 
-    piptmp = 'piptmp'
+    piptmp = tempfile.mkdtemp(prefix='spvm-piptmp-')
 
     @log.element('Download Packages', log_entry=True)
     def download():
-        for pack in args.split(' '):
-            log.set_additional_info(pack)
-            call_pip('download -d ' + piptmp + ' ' + pack)
+        from . import aioutils  # aioutils needs this module
+
+        packs = [p for p in args if p != '']
+
+        async def download_one(i, pack):
+            # one directory per download, concurrent downloads of a shared dependency must not clash
+            dest = join(piptmp, 'dl-' + str(i))
+            await aioutils.call_pip_async(['download', '-d', dest, pack])
+            log.success('Downloaded ' + pack)
+
+        aioutils.run(aioutils.gather(*[download_one(i, pack) for i, pack in enumerate(packs)]))
+
+        for i in range(len(packs)):
+            dest = join(piptmp, 'dl-' + str(i))
+            for f in os.listdir(dest):
+                if not os.path.isfile(join(piptmp, f)):
+                    os.rename(join(dest, f), join(piptmp, f))
+            shutil.rmtree(dest, True)
 
     @log.element('Checking Packages')
-    def check_packages(base_url='https://pypi.python.org/pypi/'):
+    def check_packages(base_url=PYPI_JSON_URL):
         log.fine('Checking packages in: ' + piptmp)
         unchecked = 0
         for f in os.listdir(piptmp):
-            try:
-                log.set_additional_info(f)
-                f_ = piptmp + os.sep + f
-                if not os.path.isfile(f_):
-                    continue
-
-                splited = f.split('-')
-                log.debug('Checking ' + splited[0])
-                package_info = query_get(base_url + splited[0] + '/' + splited[1] + '/json')
-
-                for f_info in package_info['releases'][splited[1]]:
-                    if not os.path.isfile(os.path.join(piptmp, f_info['filename'])):
-                        continue
-
-                    if md5(f_) != f_info['md5_digest']:
-                        log.error('Hash do not match')
-                        exit(1)
-                    # log.success(Fore.GREEN+'Hash checked for '+f)
-
-                    if not f_info['has_sig']:
-                        log.debug(Fore.YELLOW + 'No signature provided for ' + f_info['filename'])  # FIXME throw?
-                        unchecked += 1
-                        continue
-
-                    sig = query_get(f_info['url'] + '.asc', False)
-                    log.debug('File: ' + f_info['filename'] + ' has signature:\n ' + sig.decode())
-
-                    # Check
-                    q = '' if log.get_verbose() else ' --quiet'
-                    try:
-                        call_gpg('--no-default-keyring --keyring tmp.gpg' + q + ' --auto-key-retrieve --verify - ' + f_, inp=sig)  # FIXME Only use known keys?
-                    except CalledProcessError as er:
-                        if er.returncode == 1:
-                            log.error(Fore.RED + config.OPEN_PADLOCK + ' Invalid signature for ' + f)
-                            exit(1)
-
-                        log.error('Could not check signature for ' + f + ' (' + repr(er) + ')')
-                        unchecked += 1
-                        continue
-
-                    log.success(Fore.GREEN + config.PADLOCK + ' File ' + f + ' is verified')
-
-            except KeyboardInterrupt:
-                exit(2)
-            except SystemExit as e:
-                raise e
-            except BaseException as be:
-                log.error(Fore.RED + config.OPEN_PADLOCK + ' Failed to check ' + f + Fore.RESET)
-                log.error(repr(be))
+            log.set_additional_info(f)
+            f_ = piptmp + os.sep + f
+            if not os.path.isfile(f_):
+                continue
+            if verify_package_file(f_, base_url) != VERIFIED:
+                unchecked += 1
         log.warning(Fore.YELLOW + str(unchecked) + ' file(s) could not be verified')
 
     def clearup():
@@ -232,7 +438,7 @@ def install_packages(args, check_signatures=None):
         for f in os.listdir(piptmp):
             if f.endswith('.whl'):
                 log.set_additional_info(f)
-                call_pip('install ' + piptmp + os.path.sep + f)
+                call_pip(['install', piptmp + os.path.sep + f])
                 # log.success('Installed ' + f.split('-')[0])
 
     clearup()
@@ -249,35 +455,52 @@ def match_gitignore(name, ignore):
 
 def call_pip(args, verbose=log.get_verbose()):
     fh = PIPE if verbose else FNULL
-    return call_python('pip', args, stdout=fh, stderr=fh)
+    return call_python('pip', args, stdout=fh, stderr=fh, capture=False)
 
 
 @log.clear()
-def call_pytest(args):
-    o = pytest.main(args.split(' '))
+def call_pytest(args, jobs=1, rootdir=None, cache_dir=None):
+    args = args.split(' ') if type(args) == str else args
+    if jobs > 1:
+        from . import testshard  # testshard needs this module
+        o = testshard.run_sharded(args, jobs, rootdir, cache_dir)
+        if o != 0:
+            raise CalledProcessError(o, 'pytest ' + ' '.join(args))
+        return
+
+    if config.config['isolated_tests']:
+        # pytest keeps imported test modules around, a fresh interpreter avoids clashes
+        # between projects run by the same process
+        call_with_stdout([sys.executable, '-m', 'pytest', *args], stdout=None, stderr=None)
+        return
+
+    o = pytest.main(args)
     if o != 0:
-        raise CalledProcessError(o, 'pytest ' + args)
+        raise CalledProcessError(o, 'pytest ' + ' '.join(args))
 
 
 @log.clear()
-def call_git(args):
+def call_git(args, cwd=None):
     if type(args) == str:
         args = 'git '+args
     else: # array
         args = ['git', *args]
 
-    return call_with_stdout(args)
+    return call_with_stdout(args, cwd=cwd)
 
 
 @log.element('Commiting', log_entry=True)
-def call_commit(message, key=''):
+def call_commit(message, key='', cwd=None, files=None):
+    """ Commit the index, or only the given files when files is a non empty list """
     args = ['git', 'commit', '--no-edit']
     if key != '':
         args.append('-S' + key)
     args.append('-m')
     args.append(message)
+    if files is not None and len(files) > 0:
+        args += ['--', *files]
 
-    return call_with_stdout(args)
+    return call_with_stdout(args, cwd=cwd)
 
 
 def md5(fname):
@@ -288,19 +511,43 @@ def md5(fname):
     return hash_md5.hexdigest()
 
 
-def call_gpg(args, inp=None, verbose=log.get_verbose()):
+def sha256(fname):
+    hash_sha256 = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            hash_sha256.update(chunk)
+    return hash_sha256.hexdigest()
+
+
+def call_gpg(args, inp=None, verbose=log.get_verbose(), cwd=None):
     # log.error('Call to gpg deprecated')
     fh = PIPE if verbose else FNULL
-    return call_with_stdout('gpg ' + args, inp=inp, stdout=fh, stderr=fh)
+    return call_with_stdout('gpg ' + args, inp=inp, stdout=fh, stderr=fh, cwd=cwd, capture=False)
 
 
-def call_twine(args):
-    return call_with_stdout('twine ' + args, stdout=None) # FIXME import and use
+def call_twine(args, cwd=None):
+    return call_with_stdout('twine ' + args, stdout=None, cwd=cwd) # FIXME import and use
 
 
 @log.element('Checking code', log_entry=False)
-def call_check(args, ignore="", exclude=''):
+def call_check(args, ignore="", exclude='', files=None):
+    """
+    Run pyflakes and pycodestyle on the python files under args
+    With files, only these files are checked
+    """
     flakes = ''
+    if files is not None:
+        files = [f for f in files if f.endswith('.py') and not match_gitignore(f, exclude)]
+        for f in files:
+            log.debug('Check: '+f)
+            flak = call_with_stdout(['python', '-m', 'pyflakes', f], ignore_err=True)
+            if flak is not None:
+                flakes += flak
+        if len(files) == 0:
+            return flakes, ''
+        pep8 = call_with_stdout(['python', '-m', 'pycodestyle', '--ignore=' + ignore, *files], ignore_err=True)
+        return flakes, pep8 or ''
+
     for dirname, _, files in os.walk(args):
         if os.path.ismount(dirname) or os.path.islink(dirname):
             log.warning('Ignored mounted/link directory: '+dirname)
@@ -359,5 +606,10 @@ __all__ = [
     'call_pytest',
     'call_pip',
     'copy',
+    'atomic_write',
+    'verify_package_file',
+    'get_cache_dir',
+    'unix_request',
     'call_python',
-    'call_with_stdout']
+    'call_with_stdout',
+    'stream_process']
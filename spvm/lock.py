@@ -0,0 +1,200 @@
+import splogger as log
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import shutil
+import urllib.parse
+from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+from packaging.utils import canonicalize_name
+
+from . import config
+from . import ioutils
+
+LOCK_VERSION = 1
+
+
+def requirements_digest(specs):
+    """ Identifies the declared dependency list a lock was resolved from """
+    return hashlib.sha256('\n'.join(sorted(specs)).encode()).hexdigest()
+
+
+def resolve(specs):
+    """
+    Resolve the requirements once with pip, without installing anything
+    Returns [{name, version, requested, filename, sha256}]
+    """
+    with tempfile.TemporaryDirectory(prefix='spvm-lock-') as tmp:
+        report = join(tmp, 'report.json')
+        ioutils.call_with_stdout([sys.executable, '-m', 'pip', 'install', '--dry-run', '--ignore-installed', '--quiet',
+                                  '--report', report, *specs], capture=False)
+        with open(report, 'r') as fh:
+            data = json.loads(fh.read())
+
+    resolved = []
+    for item in data['install']:
+        info = item['download_info']
+        hashes = info.get('archive_info', {}).get('hashes', {})
+        if 'sha256' not in hashes:
+            log.error('No sha256 for ' + item['metadata']['name'] + ' (' + info['url'] + '), it cannot be locked')
+            exit(1)
+        resolved.append({
+            'name': canonicalize_name(item['metadata']['name']),
+            'version': item['metadata']['version'],
+            'requested': item.get('requested', False),
+            'filename': urllib.parse.unquote(info['url'].rsplit('/', 1)[-1].split('#')[0]),
+            'sha256': hashes['sha256']
+        })
+    return sorted(resolved, key=lambda r: r['name'])
+
+
+def index_artifacts(name, version, base_url=ioutils.PYPI_JSON_URL):
+    """ {filename: sha256} of every file of a release on the index, empty if the index cannot tell """
+    try:
+        info = ioutils.query_get(base_url + name + '/json')
+        return {f['filename']: f['digests']['sha256'] for f in info['releases'].get(version, [])}
+    except Exception as ex:
+        log.debug('Could not list the files of ' + name + ' ' + version + ': ' + repr(ex))
+        return {}
+
+
+def make_lock(specs, previous=None):
+    """
+    Build the lock of the declared dependencies
+    Every file of a pinned release is hashed so the lock installs on other platforms too,
+    the verification results of the previous lock are kept for the files that did not change
+    """
+    resolved = resolve(specs)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        artifacts = list(pool.map(lambda r: index_artifacts(r['name'], r['version']), resolved))
+
+    old = {} if previous is None else previous['packages']
+    packages = {}
+    for r, files in zip(resolved, artifacts):
+        files[r['filename']] = r['sha256']
+        kept = old.get(r['name'], {}).get('artifacts', {}) if old.get(r['name'], {}).get('version') == r['version'] else {}
+        packages[r['name']] = {
+            'version': r['version'],
+            'requested': r['requested'],
+            'artifacts': {f: {'sha256': h, 'verified': kept[f]['verified'] if kept.get(f, {}).get('sha256') == h else None}
+                          for f, h in sorted(files.items())}
+        }
+
+    return {
+        'version': LOCK_VERSION,
+        'requirements': requirements_digest(specs),
+        'python': '%d.%d' % sys.version_info[:2],
+        'packages': packages
+    }
+
+
+def load_lock(location):
+    path = join(location, config.lockFileName)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as fh:
+        lock = json.loads(fh.read())
+    if lock.get('version') != LOCK_VERSION:
+        log.warning(config.lockFileName + ' has an unknown format, ignoring it')
+        return None
+    return lock
+
+
+def is_fresh(lock, specs):
+    return lock is not None and lock['requirements'] == requirements_digest(specs)
+
+
+def requirements_text(lock, names=None):
+    """ The lock in the pip requirements format, with every hash, for --require-hashes """
+    lines = ['# Generated by spvm from ' + config.lockFileName + ', do not edit']
+    for name, package in sorted(lock['packages'].items()):
+        if names is not None and name not in names:
+            continue
+        hashes = sorted(set(a['sha256'] for a in package['artifacts'].values()))
+        lines.append(name + '==' + package['version'] + ''.join(' \\\n    --hash=sha256:' + h for h in hashes))
+    return '\n'.join(lines) + '\n'
+
+
+def save_lock(location, lock):
+    ioutils.atomic_write(join(location, config.lockFileName), json.dumps(lock, indent=4, sort_keys=True) + '\n')
+    ioutils.atomic_write(join(location, config.lockRequirementsName), requirements_text(lock))
+
+
+def outdated_packages(lock):
+    """ Names of the locked packages whose installed version differs from the pin """
+    from . import deps
+
+    installed = deps.installed_versions(list(lock['packages']))
+    return sorted(n for n, p in lock['packages'].items() if installed[n] is None or str(installed[n]) != p['version'])
+
+
+def install_locked(location, lock, names=None, check_signatures=None):
+    """
+    Install the pinned packages (all of them by default) with --require-hashes --no-deps, no resolution happens
+    In signed mode the files are downloaded and verified first, except the ones the lock records as
+    already verified, the results are written back to the lock
+    Returns True if the lock files were written
+    """
+    if check_signatures is None:
+        check_signatures = config.config['signed']
+
+    tmp = tempfile.mkdtemp(prefix='spvm-lockinstall-')
+    try:
+        requirements = join(tmp, 'requirements.txt')
+        with open(requirements, 'w') as fh:
+            fh.write(requirements_text(lock, names))
+
+        if not check_signatures:
+            ioutils.call_pip('install --require-hashes --no-deps -r ' + requirements, verbose=True)
+            return False
+
+        dist = join(tmp, 'dist')
+        ioutils.call_pip('download --require-hashes --no-deps -d ' + dist + ' -r ' + requirements, verbose=True)
+
+        # pip saves the files under their unquoted name (older locks kept %2B... from the url)
+        artifacts, owners = {}, {}
+        for name, package in lock['packages'].items():
+            for f, artifact in package['artifacts'].items():
+                artifacts[urllib.parse.unquote(f)] = artifact
+                owners[urllib.parse.unquote(f)] = name
+
+        downloaded = sorted(os.listdir(dist))
+        unknown = [f for f in downloaded if f not in artifacts]
+        if len(unknown) > 0:
+            log.error('The lock does not match the downloaded file(s): ' + ', '.join(unknown) +
+                      ', run spvm lock again')
+            exit(1)
+
+        changed = False
+        for f in downloaded:
+            artifact = artifacts[f]
+            if artifact['verified'] in (ioutils.VERIFIED, ioutils.UNSIGNED):
+                log.debug(f + ' already ' + artifact['verified'] + ', not checked again')
+                continue
+            result = ioutils.verify_package_file(join(dist, f))
+            if artifact['verified'] != result:
+                artifact['verified'] = result
+                changed = True
+        if changed:
+            save_lock(location, lock)
+
+        # install exactly the verified files (build dependencies of sdists still come from the index)
+        with open(requirements, 'w') as fh:
+            for f in downloaded:
+                fh.write(owners[f] + ' @ file://' + join(dist, f) + ' --hash=sha256:' + artifacts[f]['sha256'] + '\n')
+        ioutils.call_pip('install --require-hashes --no-deps -r ' + requirements, verbose=True)
+        return changed
+    finally:
+        shutil.rmtree(tmp, True)
+
+
+__all__ = [
+    'make_lock',
+    'load_lock',
+    'save_lock',
+    'is_fresh',
+    'requirements_text',
+    'outdated_packages',
+    'install_locked']
@@ -0,0 +1,316 @@
+import splogger as log
+import os
+import re
+import glob
+import sys
+import shutil
+import hashlib
+import asyncio
+from os.path import join
+from time import time
+from subprocess import CalledProcessError, TimeoutExpired
+from colorama import Fore
+from packaging.specifiers import SpecifierSet, InvalidSpecifier
+
+from . import aioutils
+from . import lock
+
+VENVS_DIR = 'venvs'
+READY_FILE = 'spvm-ready'
+FAILED_SUFFIX = '.failed'
+SETUP_RETRY = 24 * 3600  # seconds before the setup of a venv that failed is tried again
+INTERPRETER_NAME = re.compile(r'^python3(\.\d+)?$')
+PROBE = 'import sys, platform; print(platform.python_version()); print(sys.base_prefix); print(sys.executable)'
+
+
+def get_wheelhouse():
+    """
+    The wheelhouse shared by every project of the user, venvs are installed from it offline
+    Each python major.minor fills its own subdirectory, the versions an older python can install differ
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or join(os.path.expanduser('~'), '.cache')
+    path = join(base, 'spvm', 'wheelhouse')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def candidate_interpreters():
+    """ Python executables found on the PATH and in the pyenv versions """
+    found = []
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        if directory == '' or os.path.basename(directory) == 'shims' or not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            path = join(directory, name)
+            if INTERPRETER_NAME.match(name) and os.access(path, os.X_OK) and not os.path.isdir(path):
+                found.append(path)
+    pyenv_root = os.environ.get('PYENV_ROOT') or join(os.path.expanduser('~'), '.pyenv')
+    found += sorted(glob.glob(join(pyenv_root, 'versions', '*', 'bin', 'python3')))
+
+    unique, seen = [], set()
+    for path in found:
+        real = os.path.realpath(path)
+        if real not in seen:
+            seen.add(real)
+            unique.append(path)
+    return unique
+
+
+async def _probe(path):
+    try:
+        out = await aioutils.call_with_stdout_async([path, '-c', PROBE], timeout=30)
+    except (CalledProcessError, TimeoutExpired, OSError) as ex:
+        log.debug('Cannot run ' + path + ': ' + repr(ex))
+        return None
+    version, prefix, executable = out.split('\n')[:3]
+    return {'version': version, 'prefix': prefix, 'executable': executable}
+
+
+def find_interpreters(python_version):
+    """
+    The installed interpreters matching the python_version specifier of the meta, one per install
+    Returns [{version, prefix, executable}] sorted by version
+    """
+    try:
+        spec = SpecifierSet(python_version)
+    except InvalidSpecifier:
+        log.warning('Invalid python_version "' + python_version + '", every interpreter is used')
+        spec = SpecifierSet()
+
+    async def probe_all(paths):
+        return await asyncio.gather(*[_probe(p) for p in paths])
+
+    interpreters, seen = [], set()
+    for info in aioutils.run(probe_all(candidate_interpreters())):
+        if info is None or info['prefix'] in seen:
+            continue
+        seen.add(info['prefix'])
+        if spec.contains(info['version'], prereleases=True):
+            interpreters.append(info)
+        else:
+            log.debug('Python ' + info['version'] + ' does not match ' + python_version)
+    return sorted(interpreters, key=lambda i: [int(p) if p.isdigit() else 0 for p in re.split(r'[.+]', i['version'])])
+
+
+def dependency_set(location, specs, interpreter):
+    """
+    What the test venv of an interpreter gets installed: (requirements file content, hash-pinned)
+    The lock is used when it matches the declared dependencies and was resolved for the same
+    python major.minor, another python may need other versions or wheels
+    """
+    locked = lock.load_lock(location)
+    python = '.'.join(interpreter['version'].split('.')[:2])
+    if lock.is_fresh(locked, specs):
+        if locked.get('python') == python:
+            return ('' if len(locked['packages']) == 0 else lock.requirements_text(locked)), True
+        log.fine('The lock is for Python ' + str(locked.get('python')) + ', Python ' + python + ' gets the declared dependencies')
+    return ''.join(s + '\n' for s in sorted(specs)), False
+
+
+def venv_key(interpreter, requirements):
+    data = '\n'.join([os.path.realpath(interpreter['executable']), interpreter['version'], requirements])
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+def venv_python(venv):
+    return join(venv, 'Scripts', 'python.exe') if os.name == 'nt' else join(venv, 'bin', 'python')
+
+
+async def _pip(python, args):
+    await aioutils.call_with_stdout_async([python, '-m', 'pip', '--disable-pip-version-check', *args], capture=False,
+                                          new_session=True)
+
+
+async def _install_offline_first(python, install_args, fill_args, wheelhouse, fill_lock):
+    """
+    Install from the wheelhouse only, fill the wheelhouse (online) and retry if something is missing
+    The venvs are filling the shared wheelhouse one at a time
+    """
+    offline = ['install', '--no-index', '--find-links', wheelhouse, *install_args]
+    try:
+        await _pip(python, offline)
+    except CalledProcessError:
+        async with fill_lock:
+            log.fine('Filling the wheelhouse for ' + python)
+            await _pip(python, fill_args)
+        await _pip(python, offline)
+
+
+async def _upgrade_pip(python, version, wheelhouse, fill_lock):
+    """
+    Upgrade the pip of a new venv from the wheelhouse, offline
+    The wheel is picked by the pip running spvm for this python version: the pip bundled with an old
+    python trusts the newest files of an index without requires-python data and cannot install them
+    """
+    async with fill_lock:
+        if len(glob.glob(join(wheelhouse, 'pip-*.whl'))) == 0:
+            log.fine('Getting pip for Python ' + version)
+            await _pip(sys.executable, ['download', '--only-binary=:all:', '--no-deps', '--python-version', version,
+                                        '-d', wheelhouse, 'pip'])
+    await _pip(python, ['install', '--no-index', '--find-links', wheelhouse, '--upgrade', 'pip'])
+
+
+async def ensure_venv(cache_dir, interpreter, requirements, pinned, wheelhouse, fill_lock=None):
+    """
+    Get the test venv of the interpreter for this dependency set, built if it does not exist yet
+    fill_lock (an asyncio.Lock) is shared by the venvs built concurrently
+    Returns (venv path, reused)
+    """
+    fill_lock = fill_lock or asyncio.Lock()
+    version = '.'.join(interpreter['version'].split('.')[:2])
+    wheelhouse = join(wheelhouse, 'py' + version)
+    os.makedirs(wheelhouse, exist_ok=True)
+    key = venv_key(interpreter, requirements)
+    venv = join(cache_dir, VENVS_DIR, key)
+    if os.path.isfile(join(venv, READY_FILE)):
+        return venv, True
+
+    tmp = venv + '.tmp-' + str(os.getpid())
+    shutil.rmtree(tmp, True)
+    os.makedirs(os.path.dirname(venv), exist_ok=True)
+    try:
+        await aioutils.call_with_stdout_async([interpreter['executable'], '-m', 'venv', tmp], capture=False, new_session=True)
+        python = venv_python(tmp)
+        await _upgrade_pip(python, version, wheelhouse, fill_lock)
+
+        requirements_file = join(tmp, 'spvm-requirements.txt')
+        with open(requirements_file, 'w') as fh:
+            fh.write(requirements)
+        if requirements != '':
+            if pinned:
+                args = ['--require-hashes', '--no-deps', '-r', requirements_file]
+                fill = ['download', '--require-hashes', '--no-deps', '-d', wheelhouse, '-r', requirements_file]
+            else:
+                args = ['-r', requirements_file]
+                fill = ['wheel', '-w', wheelhouse, '-r', requirements_file]
+            await _install_offline_first(python, args, fill, wheelhouse, fill_lock)
+        await _install_offline_first(python, ['pytest'], ['wheel', '-w', wheelhouse, 'pytest'], wheelhouse, fill_lock)
+
+        with open(join(tmp, READY_FILE), 'w') as fh:
+            fh.write(interpreter['executable'] + '\n')
+        try:
+            os.rename(tmp, venv)
+        except OSError:
+            # built concurrently by another spvm
+            shutil.rmtree(tmp, True)
+    except BaseException:
+        shutil.rmtree(tmp, True)
+        raise
+
+    prune_venvs(cache_dir, interpreter, key)
+    return venv, False
+
+
+def failure_file(cache_dir, key):
+    return join(cache_dir, VENVS_DIR, key + FAILED_SUFFIX)
+
+
+def failed_setup(cache_dir, key):
+    """ The output of the setup of this venv if it failed less than SETUP_RETRY ago, None otherwise """
+    path = failure_file(cache_dir, key)
+    try:
+        if time() - os.path.getmtime(path) < SETUP_RETRY:
+            with open(path, 'r') as fh:
+                return fh.read()
+    except OSError:
+        pass
+    return None
+
+
+def prune_venvs(cache_dir, interpreter, keep):
+    """ Remove the venvs of the interpreter built for another dependency set """
+    for ready in glob.glob(join(cache_dir, VENVS_DIR, '*', READY_FILE)):
+        venv = os.path.dirname(ready)
+        if os.path.basename(venv) == keep:
+            continue
+        with open(ready, 'r') as fh:
+            if fh.read().strip() != interpreter['executable']:
+                continue
+        log.debug('Removing outdated venv ' + venv)
+        shutil.rmtree(venv, True)
+
+
+async def run_on_interpreter(location, cache_dir, interpreter, specs, wheelhouse, fill_lock, targets):
+    """
+    Run the tests in the cached venv of one interpreter
+    Returns (interpreter, passed, detail, duration, output)
+    """
+    start = time()
+    requirements, pinned = dependency_set(location, specs, interpreter)
+    key = venv_key(interpreter, requirements)
+    failed = failed_setup(cache_dir, key)
+    if failed is not None:
+        # not rebuilt on every run, delete the file to retry now
+        return interpreter, False, 'venv setup failed (cached: ' + failure_file(cache_dir, key) + ')', \
+            time() - start, failed
+    try:
+        venv, reused = await ensure_venv(cache_dir, interpreter, requirements, pinned, wheelhouse, fill_lock)
+    except (CalledProcessError, OSError) as ex:
+        output = (getattr(ex, 'output', None) or '') + (getattr(ex, 'stderr', None) or '') or repr(ex)
+        os.makedirs(join(cache_dir, VENVS_DIR), exist_ok=True)
+        with open(failure_file(cache_dir, key), 'w') as fh:
+            fh.write(output)
+        return interpreter, False, 'venv setup failed', time() - start, output
+    if os.path.isfile(failure_file(cache_dir, key)):
+        os.remove(failure_file(cache_dir, key))
+
+    detail = 'cached venv' if reused else 'new venv'
+    try:
+        output = await aioutils.call_with_stdout_async([venv_python(venv), '-m', 'pytest', *targets], cwd=location,
+                                                       stderr=asyncio.subprocess.STDOUT, new_session=True)
+        return interpreter, True, detail, time() - start, output
+    except CalledProcessError as ex:
+        if ex.returncode == 5:
+            return interpreter, True, detail + ', no tests', time() - start, ex.output
+        return interpreter, False, detail + ', exit ' + str(ex.returncode), time() - start, ex.output
+
+
+def print_matrix_summary(results):
+    rows = [('Python ' + i['version'], 'passed' if ok else 'FAILED', detail, '%.1fs' % duration)
+            for i, ok, detail, duration, _ in results]
+    header = ('Interpreter', 'Result', 'Detail', 'Time')
+    widths = [max(len(r[i]) for r in rows + [header]) for i in range(len(header))]
+
+    def line(row, color=Fore.WHITE):
+        return color + '  '.join(row[i].ljust(widths[i]) for i in range(len(row))) + Fore.RESET
+
+    print(Fore.GREEN + '      Test Matrix' + Fore.RESET)
+    print(line(header, Fore.CYAN))
+    for row, result in zip(rows, results):
+        print(line(row, Fore.LIGHTGREEN_EX if result[1] else Fore.LIGHTRED_EX))
+
+
+def run_matrix(location, cache_dir, python_version, specs, targets):
+    """
+    Run the tests on every local interpreter matching python_version, concurrently
+    Returns True if every run passed
+    """
+    interpreters = find_interpreters(python_version)
+    if len(interpreters) == 0:
+        log.error('No installed interpreter matches ' + python_version)
+        return False
+    log.success('Testing on ' + ', '.join('Python ' + i['version'] for i in interpreters))
+
+    wheelhouse = get_wheelhouse()
+
+    async def run_all():
+        fill_lock = asyncio.Lock()
+        return await asyncio.gather(*[run_on_interpreter(location, cache_dir, i, specs, wheelhouse, fill_lock, targets)
+                                      for i in interpreters])
+
+    results = aioutils.run(run_all())
+    for interpreter, ok, _, _, output in results:
+        color = Fore.GREEN if ok else Fore.RED
+        print(color + '~~~~ Python ' + interpreter['version'] + ' (' + interpreter['executable'] + ') ~~~~' + Fore.RESET)
+        if output.strip() != '':
+            print(output.rstrip('\n'))
+        print('')
+    print_matrix_summary(results)
+    return all(r[1] for r in results)
+
+
+__all__ = [
+    'find_interpreters',
+    'get_wheelhouse',
+    'ensure_venv',
+    'run_matrix']
@@ -1,45 +1,129 @@
 import splogger as log
 from .config import metaFileName, NoFailReadOnlyDict, metaFileLocation
-from .ioutils import input_with_default, call_git
+from .ioutils import input_with_default, call_git, atomic_write
 from colorama import Fore
 import getpass
+import copy
+import functools
 import os
 import json
 from os.path import join
 
 
-def get_default_template():
+# path -> ((mtime_ns, size), meta) as last read or written by this process
+_meta_cache = {}
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def load_project_meta(path):
     """
-    Get the default metaFile to be used
+    Load a project metaFile, the parsed meta is cached for the process lifetime
+    and only parsed again if the file changed on disk
+    """
+    path = os.path.abspath(path)
+    key = _stat_key(path)
+    cached = _meta_cache.get(path)
+    if cached is None or cached[0] != key:
+        with open(path, 'r') as f:
+            cached = (key, json.loads(f.read()))
+        _meta_cache[path] = cached
+        log.debug('Parsed ' + path)
+    return copy.deepcopy(cached[1])
+
+
+def save_project_meta(path, meta):
+    """
+    Write the meta to the metaFile only if it differs from the file content
+    Returns True if the file was written
+    """
+    path = os.path.abspath(path)
+    cached = _meta_cache.get(path)
+    if cached is not None and os.path.isfile(path) and _stat_key(path) == cached[0] and cached[1] == meta:
+        return False
+
+    atomic_write(path, json.dumps(meta, indent=4))
+    _meta_cache[path] = (_stat_key(path), copy.deepcopy(meta))
+    return True
+
+
+# Marks a path step iterating over the elements of a list in a meta plan
+_EACH = object()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_template():
+    """
+    Read and parse the template once, it must never be handed out directly
     """
     with open(metaFileLocation, 'r') as f:
         template = f.read()
     return json.loads(template)
 
 
+def get_default_template():
+    """
+    Get the default metaFile to be used
+    """
+    return copy.deepcopy(_load_template())
+
+
+def _compile_meta_plan(template, path=()):
+    """
+    Flatten the template into a list of (key path, default value)
+    Parents always come before their children
+    """
+    plan = []
+    for key, default in template.items():
+        plan.append((path + (key,), default))
+        if isinstance(default, dict):
+            plan.extend(_compile_meta_plan(default, path + (key,)))
+        elif isinstance(default, list) and len(default) > 0 and isinstance(default[0], dict):
+            plan.extend(_compile_meta_plan(default[0], path + (key, _EACH)))
+    return plan
+
+
+@functools.lru_cache(maxsize=None)
+def get_meta_plan():
+    """
+    Get the validation plan compiled from the default template
+    """
+    return tuple(_compile_meta_plan(_load_template()))
+
+
+def _resolve_containers(meta, path):
+    nodes = [meta]
+    for key in path:
+        found = []
+        for node in nodes:
+            if key is _EACH:
+                if isinstance(node, list):
+                    found.extend(node)
+            elif isinstance(node, dict) and key in node:
+                found.append(node[key])
+        nodes = found
+    return [node for node in nodes if isinstance(node, dict)]
+
+
 @log.element('Check meta')
 def check_project_meta(meta):
     """
     Check the given meta so it matchs the template, adding  elements
+    Returns the number of added elements
     """
+    added = 0
+    for path, default in get_meta_plan():
+        for container in _resolve_containers(meta, path[:-1]):
+            if path[-1] not in container:
+                container[path[-1]] = copy.deepcopy(default)
+                added += 1
+                log.warning('Added ' + path[-1] + ' to your project meta with default value')
 
-    def rec_check_meta(meta_elem, template_elem):
-        if type(meta_elem) not in [dict, list]:
-            return
-        for t_elem in template_elem:
-            if t_elem not in meta_elem:
-                meta_elem[t_elem] = template_elem[t_elem]
-                log.warning('Added ' + t_elem + ' to your project meta with default value')
-            else:
-                if isinstance(template_elem[t_elem], type({})):
-                    rec_check_meta(meta_elem[t_elem], template_elem[t_elem])
-                if isinstance(template_elem[t_elem], type([])):
-                    if len(template_elem[t_elem]) > 0:
-                        for e in meta_elem[t_elem]:
-                            rec_check_meta(e, template_elem[t_elem][0])
-
-    rec_check_meta(meta, get_default_template())
     log.debug('Checked project meta')
+    return added
 
 
 @log.auto()
@@ -50,9 +134,7 @@ def detect_project_meta(location):
     # detect metaFile
     if os.path.isfile(join(location, metaFileName)):
         log.success('Found ' + metaFileName)
-        with open(join(location, metaFileName), 'r') as f:
-            lines = f.read()
-        return json.loads(lines)
+        return load_project_meta(join(location, metaFileName))
 
     # detect setup.py
     if os.path.isfile(join(location, 'setup.py')):
@@ -76,16 +158,16 @@ def detect_project_meta(location):
     # detect .git
     if os.path.isdir(join(location, '.git')):
         log.success("Found git structure")
-        remote = call_git('remote').split(' ')[0].strip()
+        remote = call_git('remote', cwd=location).split(' ')[0].strip()
         if remote != '':
             log.fine("Found remote " + remote)
             meta['project_vcs']['code_repository'] = call_git(
-                'remote get-url ' + remote).strip()
+                'remote get-url ' + remote, cwd=location).strip()
 
         if meta['project_authors'][0]['email'] == '':
             log.fine('Using git to detect email')
             meta['project_authors'][0]['email'] = call_git(
-                'config user.email').split()[0]
+                'config user.email', cwd=location).split()[0]
 
     # Find project name if not detected
     if meta['project_info']['name'] == '':
@@ -111,10 +193,12 @@ def detect_project_meta(location):
 
 
 @log.clear()
-def prompt_project_info(location, meta=get_default_template()):
+def prompt_project_info(location, meta=None):
     """
     Prompt the user for project information
     """
+    if meta is None:
+        meta = get_default_template()
 
     print(f'\n{Fore.GREEN}~~~~ Project Setup ~~~~{Fore.RESET}')
     print(f'{Fore.LIGHTGREEN_EX}Project Location: {location}{Fore.RESET}')
@@ -201,6 +285,8 @@ def load_version_from_file(location, project_name):
 
 
 __all__ = [
+    'load_project_meta',
+    'save_project_meta',
     'load_version_from_file',
     'detect_from_setup',
     'prompt_project_info',
@@ -0,0 +1,142 @@
+import splogger as log
+import os
+import sys
+import json
+import pstats
+import cProfile
+import threading
+from time import time
+from colorama import Fore
+
+TOP_FUNCTIONS = 25
+MAX_DEPTH = 200
+
+_profiler = None
+# Before 3.12 cProfile only sees its own thread, the threads started while profiling get their own
+# profiler. Since 3.12 it is built on sys.monitoring and already sees every thread
+PER_THREAD = sys.version_info < (3, 12)
+_thread_profilers = []
+_subprocesses = None  # [{args, cwd, start, duration, code}] while subprocesses are timed
+
+
+def _profile_thread(frame, event, arg):
+    profiler = cProfile.Profile()
+    _thread_profilers.append(profiler)
+    profiler.enable()
+
+
+def start(functions=True, subprocesses=False):
+    """ Profile the python code and/or time the child processes from now on """
+    global _profiler, _subprocesses
+    if subprocesses:
+        _subprocesses = []
+    if functions:
+        if PER_THREAD:
+            threading.setprofile(_profile_thread)
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def record_subprocess(args, cwd, started, code):
+    """ Called by call_with_stdout (and its async counterpart) once a child process ended """
+    if _subprocesses is None:
+        return
+    command = args if type(args) == str else ' '.join(str(a) for a in args)
+    _subprocesses.append({'args': command, 'cwd': cwd, 'start': started, 'duration': time() - started, 'code': code})
+
+
+def _label(func):
+    filename, line, name = func
+    label = name if filename == '~' else os.path.basename(filename) + ':' + name + ':' + str(line)  # '~' for builtins
+    return label.replace(';', ',').replace(' ', '_')
+
+
+def collapsed_stacks(stats):
+    """
+    Rebuild folded stacks ("a;b;c microseconds" lines) from the caller graph of the profile
+    A function's time is split between its callers in proportion to what each edge recorded,
+    so the stacks are an estimate: cProfile does not keep whole call paths
+    Since 3.12 the threads share one profiler and the edges between threads are unreliable:
+    a function whose own time the roots do not reach is walked as a root too
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(func)
+    roots = [f for f, (_, _, _, _, callers) in stats.stats.items() if len(callers) == 0]
+
+    folded = {}
+    accounted = {}  # function -> own time put in the stacks
+
+    def walk(func, stack, path_time):
+        _, _, tt, ct, _ = stats.stats[func]
+        if ct <= 0 or path_time <= 0:
+            return
+        ratio = path_time / ct
+        stack = stack + [_label(func)]
+        key = ';'.join(stack)
+        folded[key] = folded.get(key, 0) + tt * ratio
+        accounted[func] = accounted.get(func, 0) + tt * ratio
+        if len(stack) >= MAX_DEPTH:
+            return
+        for callee in callees.get(func, []):
+            if _label(callee) in stack:
+                continue  # recursion, its time is already in the parent
+            edge_ct = stats.stats[callee][4][func][3]
+            walk(callee, stack, edge_ct * ratio)
+
+    for root in roots:
+        walk(root, [], stats.stats[root][3])
+    for func in sorted(stats.stats, key=lambda f: -stats.stats[f][3]):
+        _, _, tt, ct, _ = stats.stats[func]
+        missing = 0 if tt <= 0 else 1 - accounted.get(func, 0) / tt
+        if missing > 0.01:
+            walk(func, [], ct * missing)
+
+    return [k + ' ' + str(int(v * 1e6)) for k, v in sorted(folded.items()) if int(v * 1e6) > 0]
+
+
+def print_subprocesses(stream):
+    total = sum(s['duration'] for s in _subprocesses)
+    stream.write(Fore.GREEN + '      Subprocesses (' + str(len(_subprocesses)) + ', %.3fs)' % total + Fore.RESET + '\n')
+    for s in sorted(_subprocesses, key=lambda s: -s['duration']):
+        color = Fore.WHITE if s['code'] == 0 else Fore.LIGHTRED_EX
+        stream.write(color + '%8.3fs  ' % s['duration'] + ('exit ' + str(s['code'])).ljust(10) + s['args'] + Fore.RESET + '\n')
+
+
+def stop(prefix='spvm-profile'):
+    """
+    Write prefix.pstats, prefix.folded (and prefix.subprocesses.json), print the summary on stderr
+    """
+    global _profiler, _subprocesses
+    stream = sys.stderr
+
+    if _profiler is not None:
+        _profiler.disable()
+        if PER_THREAD:
+            threading.setprofile(None)
+        stats = pstats.Stats(_profiler, stream=stream)
+        for profiler in _thread_profilers:
+            stats.add(profiler)
+        del _thread_profilers[:]
+        stats.dump_stats(prefix + '.pstats')
+        with open(prefix + '.folded', 'w') as fh:
+            fh.write('\n'.join(collapsed_stacks(stats)) + '\n')
+        stream.write(Fore.GREEN + '      Profile, top functions by cumulative time' + Fore.RESET + '\n')
+        stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        log.success('Profile written to ' + prefix + '.pstats and ' + prefix + '.folded (collapsed stacks)')
+        _profiler = None
+
+    if _subprocesses is not None:
+        with open(prefix + '.subprocesses.json', 'w') as fh:
+            fh.write(json.dumps(_subprocesses, indent=4) + '\n')
+        print_subprocesses(stream)
+        log.success('Subprocess timings written to ' + prefix + '.subprocesses.json')
+        _subprocesses = None
+
+
+__all__ = [
+    'start',
+    'stop',
+    'record_subprocess',
+    'collapsed_stacks']
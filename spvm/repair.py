@@ -0,0 +1,63 @@
+import splogger as log
+import os
+import tokenize
+from concurrent.futures import ProcessPoolExecutor
+
+from .ioutils import atomic_write
+
+# Same as autopep8 -a
+AUTOPEP8_OPTIONS = {'aggressive': 1}
+
+
+def fix_file(path):
+    """
+    Run autopep8 on one file, the file is only written if its content changed
+    The encoding (coding cookie or BOM) and the line endings of the file are kept
+    Returns True if the file was rewritten
+    """
+    import autopep8
+
+    with open(path, 'rb') as fh:
+        encoding = tokenize.detect_encoding(fh.readline)[0]
+    with open(path, 'r', encoding=encoding, newline='') as fh:
+        source = fh.read()
+    fixed = autopep8.fix_code(source, options=AUTOPEP8_OPTIONS)
+    if fixed == source:
+        return False
+
+    atomic_write(path, fixed, encoding=encoding, newline='')
+    return True
+
+
+def fix_files(paths, jobs=None):
+    """
+    Run autopep8 over the files with a process pool
+    Returns the list of the rewritten files
+    """
+    paths = sorted(set(paths))
+    if len(paths) <= 1:
+        results = [fix_file(p) for p in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(fix_file, paths))
+
+    fixed = [p for p, changed in zip(paths, results) if changed]
+    for p in fixed:
+        log.success('Repaired ' + p)
+    return fixed
+
+
+def flagged_files(lines):
+    """ Files reported in the check output lines (path:line:col: message) """
+    files = set()
+    for line in lines:
+        path = line.split(':')[0]
+        if path.endswith('.py') and os.path.isfile(path):
+            files.add(os.path.abspath(path))
+    return files
+
+
+__all__ = [
+    'fix_file',
+    'fix_files',
+    'flagged_files']
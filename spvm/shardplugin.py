@@ -0,0 +1,23 @@
+"""
+pytest plugin of the test shards: -p spvm.shardplugin --spvm-shard=<file>
+The shard collects like the whole run and only keeps the node ids listed in the file,
+so the command line does not grow with the size of the suite
+"""
+
+
+def pytest_addoption(parser):
+    parser.addoption('--spvm-shard', default=None, help='File of the node ids to run, one per line')
+
+
+def pytest_collection_modifyitems(config, items):
+    path = config.getoption('spvm_shard')
+    if path is None:
+        return
+    with open(path, 'r') as fh:
+        wanted = set(line.strip() for line in fh if line.strip() != '')
+
+    selected = [item for item in items if item.nodeid in wanted]
+    deselected = [item for item in items if item.nodeid not in wanted]
+    if len(deselected) > 0:
+        config.hook.pytest_deselected(items=deselected)
+    items[:] = selected
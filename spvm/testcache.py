@@ -0,0 +1,78 @@
+import splogger as log
+import os
+import sys
+import json
+import hashlib
+from os.path import join
+from importlib import metadata
+
+from .ioutils import atomic_write
+
+RESULTS_FILE = 'test-results.json'
+MAX_RESULTS = 20
+
+# Written by the test runs themselves, they must not change the key
+IGNORED_NAMES = ['build']
+
+
+def _is_input(path):
+    parts = path.split('/')
+    return not any(p in IGNORED_NAMES or p.endswith('.egg-info') for p in parts[:-1]) and not path.endswith(('.pyc', '.pyo'))
+
+
+def tree_digest(index):
+    """
+    Hash the path and content hash of every file of the project, from the file index
+    Only the files that changed since the last digest are read
+    """
+    digest = hashlib.sha256()
+    hashes = index.hashes([p for p, _, _ in index.files() if _is_input(p)])
+    for path in sorted(hashes):
+        digest.update(path.encode() + b'\0' + hashes[path].encode() + b'\n')
+    return digest.hexdigest()
+
+
+def environment_digest():
+    """
+    Hash the interpreter version and the set of installed distributions
+    """
+    installed = sorted(set((d.metadata['Name'] or '').lower() + '==' + d.version for d in metadata.distributions()))
+    digest = hashlib.sha256()
+    digest.update((sys.executable + '\n' + sys.version + '\n').encode())
+    digest.update('\n'.join(installed).encode())
+    return digest.hexdigest()
+
+
+def results_key(index):
+    return hashlib.sha256((tree_digest(index) + environment_digest()).encode()).hexdigest()
+
+
+def _load(cache_dir):
+    path = join(cache_dir, RESULTS_FILE)
+    if not os.path.isfile(path):
+        return []
+    try:
+        with open(path, 'r') as fh:
+            return json.loads(fh.read())['passed']
+    except (ValueError, KeyError):
+        return []
+
+
+def has_passed(cache_dir, key):
+    return key in _load(cache_dir)
+
+
+def record_pass(cache_dir, key):
+    """
+    Remember that the suite passed for key, only passes are ever recorded
+    """
+    passed = [k for k in _load(cache_dir) if k != key]
+    passed.append(key)
+    atomic_write(join(cache_dir, RESULTS_FILE), json.dumps({'passed': passed[-MAX_RESULTS:]}))
+    log.debug('Recorded test pass for ' + key)
+
+
+__all__ = [
+    'results_key',
+    'has_passed',
+    'record_pass']
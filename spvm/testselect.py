@@ -0,0 +1,162 @@
+import splogger as log
+import ast
+import os
+import json
+from os.path import join
+
+from . import config
+from .ioutils import atomic_write
+
+IMPORT_GRAPH_FILE = 'imports.json'
+IMPORT_GRAPH_VERSION = 1
+
+# A change to one of these can affect every test
+FULL_SUITE_TRIGGERS = [config.metaFileName, 'setup.py', 'conftest.py']
+
+
+def is_test_file(path):
+    name = os.path.basename(path)
+    return name.endswith('.py') and (name.startswith('test_') or name.endswith('_test.py'))
+
+
+def module_name(path):
+    """ Dotted module name of a python file path relative to the project """
+    parts = path[:-len('.py')].replace(os.sep, '/').split('/')
+    if parts[-1] == '__init__':
+        parts = parts[:-1]
+    return '.'.join(parts)
+
+
+def _with_parents(name):
+    # importing a.b.c also runs a and a.b
+    parts = name.split('.')
+    return ['.'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+def parse_imports(location, path):
+    """
+    List the module names a file may import, statically
+    Names are given both as absolute and relative to the file's package
+    """
+    with open(join(location, path), 'rb') as fh:
+        try:
+            tree = ast.parse(fh.read(), path)
+        except (SyntaxError, ValueError):
+            log.debug('Cannot parse ' + path)
+            return []
+
+    modname = module_name(path)
+    is_package = os.path.basename(path) == '__init__.py'
+    package = modname if is_package else modname.rpartition('.')[0]
+
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            bases = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            if node.level > 0:
+                parent = package.split('.') if package != '' else []
+                parent = parent[:len(parent) - (node.level - 1)]
+                base = '.'.join(parent + ([node.module] if node.module else []))
+            else:
+                base = node.module
+            # from x import y, y may be a module
+            bases = [base] + [base + '.' + alias.name for alias in node.names if alias.name != '*']
+        else:
+            continue
+
+        for base in bases:
+            if base is None or base == '':
+                continue
+            names.update(_with_parents(base))
+            if package != '':
+                # implicit sibling imports (e.g. test helpers on pytest's rootdir path)
+                names.update(_with_parents(package + '.' + base))
+
+    return sorted(names)
+
+
+def python_files(index):
+    """ [(path, size, mtime_ns)] of the python files in the file index, paths use os.sep """
+    return [(p.replace('/', os.sep), size, mtime) for p, size, mtime in index.files() if p.endswith('.py')]
+
+
+def iter_python_files(index):
+    for path, _, _ in python_files(index):
+        yield path
+
+
+def load_import_graph(location, index, cache_dir):
+    """
+    Get {file: [imported names]} for every python file of the project
+    The graph is cached, only files whose size or mtime changed are parsed again
+    """
+    cache_file = join(cache_dir, IMPORT_GRAPH_FILE)
+    cached = {}
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'r') as fh:
+                data = json.loads(fh.read())
+            if data['version'] == IMPORT_GRAPH_VERSION:
+                cached = data['files']
+        except (ValueError, KeyError):
+            log.debug('Invalid import graph cache, rebuilding it')
+
+    files = {}
+    parsed = 0
+    for path, size, mtime_ns in python_files(index):
+        entry = cached.get(path)
+        if entry is None or entry['mtime_ns'] != mtime_ns or entry['size'] != size:
+            entry = {'mtime_ns': mtime_ns, 'size': size, 'imports': parse_imports(location, path)}
+            parsed += 1
+        files[path] = entry
+
+    if parsed > 0 or len(files) != len(cached):
+        atomic_write(cache_file, json.dumps({'version': IMPORT_GRAPH_VERSION, 'files': files}))
+    log.debug('Import graph: ' + str(len(files)) + ' files, ' + str(parsed) + ' parsed')
+
+    return {path: entry['imports'] for path, entry in files.items()}
+
+
+def affected_files(graph, changed):
+    """
+    Files transitively importing one of the changed files (changed files included)
+    Deleted files still affect the files importing them
+    """
+    importers = {}
+    for path, names in graph.items():
+        for name in names:
+            importers.setdefault(name, []).append(path)
+
+    affected = set(p for p in changed if p in graph)
+    stack = [module_name(p) for p in changed if p.endswith('.py')]
+    seen = set(stack)
+    while stack:
+        for path in importers.get(stack.pop(), []):
+            affected.add(path)
+            name = module_name(path)
+            if name not in seen:
+                seen.add(name)
+                stack.append(name)
+
+    return affected
+
+
+def select_tests(location, changed, index, cache_dir):
+    """
+    Select the test files to run for a list of changed files (relative to location)
+    Returns None if the full suite must be run
+    """
+    for path in changed:
+        if os.path.basename(path) in FULL_SUITE_TRIGGERS:
+            log.fine(path + ' changed, selecting every test')
+            return None
+
+    graph = load_import_graph(location, index, cache_dir)
+    return sorted(p for p in affected_files(graph, changed) if is_test_file(p) and p in graph)
+
+
+__all__ = [
+    'select_tests',
+    'load_import_graph',
+    'affected_files']
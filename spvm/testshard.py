@@ -0,0 +1,193 @@
+import splogger as log
+import os
+import sys
+import json
+import tempfile
+import xml.etree.ElementTree as ET
+from os.path import join
+from subprocess import Popen, STDOUT
+from time import time
+from colorama import Fore
+
+from .ioutils import atomic_write, stream_process
+
+DURATIONS_FILE = 'test-durations.json'
+REPORT_FILE = 'test-report.xml'
+
+# pytest exit codes
+EXIT_OK = 0
+EXIT_NO_TESTS = 5
+
+
+def _pytest_command(rootdir, args):
+    return [sys.executable, '-m', 'pytest', '--rootdir=' + rootdir, '-p', 'no:cacheprovider', *args]
+
+
+def _shard_env():
+    """ The environment of the shards, where spvm.shardplugin is importable """
+    env = dict(os.environ)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = package_parent + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+
+def collect_items(args, rootdir):
+    """
+    Collect the test node ids in a separate interpreter
+    Returns (exit code, node ids)
+    """
+    items = []
+    listing = True
+
+    def on_line(line):
+        nonlocal listing
+        # node ids come first, up to the first blank line
+        if line.strip() == '':
+            listing = False
+        elif listing and '::' in line:
+            items.append(line.strip())
+
+    code, _, out_tail, err_tail = stream_process(_pytest_command(rootdir, ['--collect-only', '-q', *args]), on_stdout=on_line, cwd=rootdir)
+    if code not in (EXIT_OK, EXIT_NO_TESTS):
+        print(out_tail + err_tail)
+    return code, items
+
+
+def load_durations(cache_dir):
+    path = join(cache_dir, DURATIONS_FILE)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'r') as fh:
+            return json.loads(fh.read())
+    except ValueError:
+        return {}
+
+
+def save_durations(cache_dir, durations):
+    atomic_write(join(cache_dir, DURATIONS_FILE), json.dumps(durations, indent=1, sort_keys=True))
+
+
+def make_shards(items, jobs, durations):
+    """
+    Split the items in at most jobs shards of balanced total duration
+    Longest items first, each one to the currently lightest shard
+    Items never run before count as the average known duration
+    """
+    known = [durations[i] for i in items if i in durations]
+    default = sum(known) / len(known) if len(known) > 0 else 1.0
+
+    shards = [[] for _ in range(min(jobs, len(items)))]
+    loads = [0.0] * len(shards)
+    for item in sorted(items, key=lambda i: durations.get(i, default), reverse=True):
+        lightest = loads.index(min(loads))
+        shards[lightest].append(item)
+        loads[lightest] += durations.get(item, default)
+
+    return shards, loads
+
+
+def merge_exit_codes(codes):
+    failures = [c for c in codes if c not in (EXIT_OK, EXIT_NO_TESTS)]
+    if len(failures) > 0:
+        return max(failures)
+    if EXIT_OK in codes:
+        return EXIT_OK
+    return EXIT_NO_TESTS
+
+
+def _testcase_nodeid(case):
+    # xunit1 reports keep the file of each test case
+    path = case.get('file', '').replace(os.sep, '/')
+    module = path[:-len('.py')].replace('/', '.')
+    classname = case.get('classname', '')
+    inner = classname[len(module) + 1:] if classname.startswith(module + '.') else ''
+    return '::'.join(p for p in [path] + inner.split('.') + [case.get('name', '')] if p != '')
+
+
+def merge_reports(report_files, output):
+    """
+    Merge the junit reports of the shards into one
+    Returns (totals, {nodeid: duration})
+    """
+    totals = {'tests': 0, 'failures': 0, 'errors': 0, 'skipped': 0}
+    durations = {}
+    merged = ET.Element('testsuite', name='spvm')
+    for report in report_files:
+        if not os.path.isfile(report) or os.path.getsize(report) == 0:
+            continue
+        root = ET.parse(report).getroot()
+        suites = [root] if root.tag == 'testsuite' else root.findall('testsuite')
+        for suite in suites:
+            for key in totals:
+                totals[key] += int(suite.get(key, 0))
+            for case in suite.findall('testcase'):
+                merged.append(case)
+                durations[_testcase_nodeid(case)] = float(case.get('time', 0))
+
+    for key, value in totals.items():
+        merged.set(key, str(value))
+    merged.set('time', '%.3f' % sum(durations.values()))
+    testsuites = ET.Element('testsuites')
+    testsuites.append(merged)
+    ET.ElementTree(testsuites).write(output, encoding='utf-8', xml_declaration=True)
+
+    return totals, durations
+
+
+def run_sharded(args, jobs, rootdir, cache_dir):
+    """
+    Run the tests selected by args over jobs pytest processes
+    Shards are balanced with the durations recorded by the previous runs
+    Returns the merged pytest exit code
+    """
+    code, items = collect_items(args, rootdir)
+    if code != EXIT_OK:
+        return code
+    if len(items) == 0:
+        return EXIT_NO_TESTS
+
+    durations = load_durations(cache_dir)
+    shards, loads = make_shards(items, jobs, durations)
+    log.success('Running ' + str(len(items)) + ' tests over ' + str(len(shards)) + ' processes')
+
+    start = time()
+    with tempfile.TemporaryDirectory(prefix='spvm-shards-') as tmp:
+        procs = []
+        env = _shard_env()
+        for i, shard in enumerate(shards):
+            log.debug('Shard ' + str(i) + ': ' + str(len(shard)) + ' tests, ~%.1fs' % loads[i])
+            # the node ids go through a file, a large suite would exceed the command line limit
+            ids = join(tmp, 'shard-%d.ids' % i)
+            with open(ids, 'w') as fh:
+                fh.write(''.join(item + '\n' for item in shard))
+            out = open(join(tmp, 'shard-%d.out' % i), 'w+b')
+            cmd = _pytest_command(rootdir, ['-p', 'spvm.shardplugin', '--spvm-shard=' + ids, '-o', 'junit_family=xunit1',
+                                            '--junitxml=' + join(tmp, 'shard-%d.xml' % i), *args])
+            procs.append((Popen(cmd, stdout=out, stderr=STDOUT, cwd=rootdir, env=env), out))
+
+        codes = []
+        for i, (proc, out) in enumerate(procs):
+            codes.append(proc.wait())
+            out.seek(0)
+            print(Fore.CYAN + '~~~~ Shard ' + str(i + 1) + '/' + str(len(procs)) + ' ~~~~' + Fore.RESET)
+            print(out.read().decode(errors='replace'))
+            out.close()
+
+        totals, measured = merge_reports([join(tmp, 'shard-%d.xml' % i) for i in range(len(procs))], join(cache_dir, REPORT_FILE))
+
+    durations.update(measured)
+    save_durations(cache_dir, durations)
+
+    passed = totals['tests'] - totals['failures'] - totals['errors'] - totals['skipped']
+    log.success('%d passed, %d failed, %d errors, %d skipped in %.2fs (%.2fs of tests)' % (
+        passed, totals['failures'], totals['errors'], totals['skipped'], time() - start, sum(measured.values())))
+    log.fine('Merged report: ' + join(cache_dir, REPORT_FILE))
+
+    return merge_exit_codes(codes)
+
+
+__all__ = [
+    'run_sharded',
+    'make_shards',
+    'merge_exit_codes']
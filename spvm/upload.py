@@ -0,0 +1,384 @@
+import splogger as log
+import os
+import re
+import uuid
+import configparser
+import urllib.parse
+import email.parser
+import hashlib
+import tarfile
+import zipfile
+import requests
+from os.path import basename
+from time import sleep, time
+from concurrent.futures import ThreadPoolExecutor
+from colorama import Fore
+
+CHUNK_SIZE = 65536
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+DEFAULT_REPOSITORIES = {
+    'pypi': 'https://upload.pypi.org/legacy/',
+    'testpypi': 'https://test.pypi.org/legacy/'
+}
+
+UPLOADED = 'uploaded'
+SKIPPED = 'skipped'
+
+# Metadata header -> legacy upload form field, the lists are sent as repeated fields
+METADATA_FIELDS = {
+    'Metadata-Version': 'metadata_version',
+    'Name': 'name',
+    'Version': 'version',
+    'Summary': 'summary',
+    'Home-page': 'home_page',
+    'Author': 'author',
+    'Author-email': 'author_email',
+    'Maintainer': 'maintainer',
+    'Maintainer-email': 'maintainer_email',
+    'License': 'license',
+    'Keywords': 'keywords',
+    'Platform': 'platform',
+    'Description-Content-Type': 'description_content_type',
+    'Requires-Python': 'requires_python'
+}
+METADATA_LIST_FIELDS = {
+    'Classifier': 'classifiers',
+    'Requires-Dist': 'requires_dist',
+    'Provides-Extra': 'provides_extra',
+    'Project-URL': 'project_urls'
+}
+
+
+class UploadError(Exception):
+    pass
+
+
+def read_dist_metadata(path):
+    """
+    Read the core metadata of a wheel or sdist without extracting it
+    """
+    name = basename(path)
+    content = None
+    if name.endswith('.whl'):
+        with zipfile.ZipFile(path) as zf:
+            for member in zf.namelist():
+                if member.count('/') == 1 and member.endswith('.dist-info/METADATA'):
+                    content = zf.read(member)
+                    break
+    elif name.endswith(('.tar.gz', '.tgz')):
+        with tarfile.open(path) as tf:
+            for member in tf.getmembers():
+                if member.name.count('/') == 1 and member.name.endswith('/PKG-INFO'):
+                    content = tf.extractfile(member).read()
+                    break
+    elif name.endswith('.zip'):
+        with zipfile.ZipFile(path) as zf:
+            for member in zf.namelist():
+                if member.count('/') == 1 and member.endswith('/PKG-INFO'):
+                    content = zf.read(member)
+                    break
+
+    if content is None:
+        raise UploadError('No metadata found in ' + name)
+    return email.parser.Parser().parsestr(content.decode('utf-8', errors='replace'))
+
+
+def file_digests(path):
+    """ md5, sha256 and blake2b-256 of a file in one read """
+    md5, sha256, blake2 = hashlib.md5(), hashlib.sha256(), hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+            blake2.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest(), blake2.hexdigest()
+
+
+def make_upload_fields(path):
+    """
+    Build the legacy upload form fields (list of (name, value)) for a distribution file
+    """
+    meta = read_dist_metadata(path)
+    name = basename(path)
+    if name.endswith('.whl'):
+        filetype, pyversion = 'bdist_wheel', name[:-len('.whl')].split('-')[-3]
+    else:
+        filetype, pyversion = 'sdist', 'source'
+
+    md5, sha256, blake2 = file_digests(path)
+    fields = [
+        (':action', 'file_upload'),
+        ('protocol_version', '1'),
+        ('filetype', filetype),
+        ('pyversion', pyversion),
+        ('md5_digest', md5),
+        ('sha256_digest', sha256),
+        ('blake2_256_digest', blake2)
+    ]
+    for header, field in METADATA_FIELDS.items():
+        if meta[header] is not None:
+            fields.append((field, meta[header]))
+    for header, field in METADATA_LIST_FIELDS.items():
+        for value in meta.get_all(header) or []:
+            fields.append((field, value))
+
+    description = meta.get_payload() or meta['Description'] or ''
+    fields.append(('description', description))
+    return fields
+
+
+class MultipartStream(object):
+    """
+    A multipart/form-data body read lazily, files are streamed from disk
+    The length is known upfront so the upload is not chunked
+    """
+
+    def __init__(self, fields, files):
+        self.boundary = uuid.uuid4().hex
+        self.parts = []  # bytes or file paths
+        for name, value in fields:
+            self.parts.append(self._header(name) + b'\r\n' + value.encode() + b'\r\n')
+        for name, path in files:
+            self.parts.append(self._header(name, basename(path)) + b'Content-Type: application/octet-stream\r\n\r\n')
+            self.parts.append(path)
+            self.parts.append(b'\r\n')
+        self.parts.append(('--' + self.boundary + '--\r\n').encode())
+
+        self.length = sum(len(p) if type(p) == bytes else os.path.getsize(p) for p in self.parts)
+        self._index = 0
+        self._current = None
+
+    def _header(self, name, filename=None):
+        disposition = 'form-data; name="' + name + '"' + ('' if filename is None else '; filename="' + filename + '"')
+        return ('--' + self.boundary + '\r\nContent-Disposition: ' + disposition + '\r\n').encode()
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=' + self.boundary
+
+    def __len__(self):
+        return self.length
+
+    def _next_part(self):
+        part = self.parts[self._index]
+        self._index += 1
+        if type(part) == bytes:
+            return _BytesReader(part)
+        return open(part, 'rb')
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        data = b''
+        while len(data) < size:
+            if self._current is None:
+                if self._index >= len(self.parts):
+                    break
+                self._current = self._next_part()
+            chunk = self._current.read(size - len(data))
+            if chunk == b'':
+                self._current.close()
+                self._current = None
+                continue
+            data += chunk
+        return data
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+
+
+class _BytesReader(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size):
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+
+def read_pypirc(repository, path=None):
+    """
+    (username, password) of the ~/.pypirc section of a repository, None when there is none
+    A section matches by its repository option, [pypi] and [testpypi] by default
+    """
+    path = path or os.path.join(os.path.expanduser('~'), '.pypirc')
+    if not os.path.isfile(path):
+        return None
+    parser = configparser.RawConfigParser()
+    try:
+        parser.read(path)
+    except configparser.Error as ex:
+        log.warning('Could not read ' + path + ': ' + str(ex))
+        return None
+
+    for section in parser.sections():
+        url = parser.get(section, 'repository', fallback=DEFAULT_REPOSITORIES.get(section, ''))
+        if url.rstrip('/') == repository.rstrip('/'):
+            return parser.get(section, 'username', fallback=None), parser.get(section, 'password', fallback=None)
+    return None
+
+
+def simple_index_url(repository):
+    """
+    The PEP 503 index next to a legacy upload url (upload.pypi.org/legacy/ -> pypi.org/simple/), None if unknown
+    """
+    try:
+        parts = urllib.parse.urlsplit(repository)
+    except ValueError:
+        return None  # the upload reports the invalid url
+    path = parts.path.rstrip('/')
+    if not path.endswith('/legacy'):
+        return None
+    host = parts.netloc[len('upload.'):] if parts.netloc.startswith('upload.') else parts.netloc
+    return urllib.parse.urlunsplit((parts.scheme, host, path[:-len('legacy')] + 'simple/', '', ''))
+
+
+def normalize_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _already_exists(response):
+    if response.status_code == 409:
+        return True
+    return response.status_code == 400 and 'already exist' in (response.reason + response.text).lower()
+
+
+class Uploader(object):
+    """
+    Uploads distributions to a legacy (PyPI style) upload endpoint over a pooled session
+    """
+
+    def __init__(self, repository, username=None, password=None, jobs=4, retries=4, backoff=1.0, timeout=300, index_url=None):
+        self.repository = repository
+        self.index_url = index_url or simple_index_url(repository)
+        self.auth = (username, password) if username is not None else None
+        self.jobs = jobs
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=jobs)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['User-Agent'] = 'spvm'
+
+    def _wait(self, attempt, response=None):
+        delay = self.backoff * (2 ** attempt)
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            delay = max(delay, int(response.headers['Retry-After']))
+        sleep(delay)
+
+    def existing_files(self, name):
+        """
+        The file names of a project already on the index, None when the index can not tell
+        Looked up before uploading so a resumed release does not stream the files again
+        """
+        if self.index_url is None:
+            return None
+        try:
+            response = self.session.get(self.index_url + normalize_name(name) + '/', timeout=30)
+        except requests.RequestException as ex:
+            log.debug('Index lookup failed: ' + repr(ex))
+            return None
+        if response.status_code == 404:
+            return set()
+        if response.status_code != 200:
+            return None
+        return set(urllib.parse.unquote(m.split('#')[0].rsplit('/', 1)[-1])
+                   for m in re.findall(r'href=["\']([^"\']+)["\']', response.text))
+
+    def upload_file(self, path):
+        """
+        Upload one distribution, its .asc signature is attached when present
+        Returns UPLOADED or SKIPPED (already on the index), raises UploadError
+        """
+        fields = make_upload_fields(path)
+        files = [('content', path)]
+        if os.path.isfile(path + '.asc'):
+            files.append(('gpg_signature', path + '.asc'))
+
+        for attempt in range(self.retries + 1):
+            body = MultipartStream(fields, files)
+            last = attempt == self.retries
+            try:
+                response = self.session.post(self.repository, data=body, auth=self.auth, timeout=self.timeout,
+                                             headers={'Content-Type': body.content_type}, allow_redirects=False)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                if last:
+                    raise UploadError(basename(path) + ': ' + repr(ex))
+                log.warning('Upload of ' + basename(path) + ' failed (' + ex.__class__.__name__ + '), retrying')
+                self._wait(attempt)
+                continue
+            except requests.RequestException as ex:
+                # not worth a retry: invalid url, missing schema...
+                raise UploadError(basename(path) + ': ' + repr(ex))
+            finally:
+                body.close()
+
+            if response.status_code in (200, 201):
+                return UPLOADED
+            if _already_exists(response):
+                return SKIPPED
+            if response.status_code in RETRY_STATUSES and not last:
+                log.warning('Upload of ' + basename(path) + ' got ' + str(response.status_code) + ', retrying')
+                self._wait(attempt, response)
+                continue
+            if 300 <= response.status_code < 400:
+                raise UploadError(basename(path) + ': redirected to ' + response.headers.get('Location', '?') + ', is the repository url the upload url?')
+            raise UploadError(basename(path) + ': ' + str(response.status_code) + ' ' + response.reason)
+
+    def upload(self, paths):
+        """
+        Upload the distributions concurrently
+        Returns {path: result}, raises UploadError listing every failed file
+        """
+        results, errors = {}, []
+
+        existing = {}
+        for path in paths:
+            name = read_dist_metadata(path)['Name']
+            if name not in existing:
+                existing[name] = self.existing_files(name) or set()
+            if basename(path) in existing[name]:
+                results[path] = SKIPPED
+                log.warning(basename(path) + ' is already on the index, skipped')
+        paths = [p for p in paths if p not in results]
+
+        def task(path):
+            start = time()
+            try:
+                results[path] = self.upload_file(path)
+            except UploadError as ex:
+                errors.append(str(ex))
+                log.error(Fore.RED + 'Failed to upload ' + str(ex) + Fore.RESET)
+                return
+            if results[path] == SKIPPED:
+                log.warning(basename(path) + ' is already on the index, skipped')
+            else:
+                log.success('Uploaded ' + basename(path) + ' (%.2fs)' % (time() - start))
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            list(pool.map(task, paths))
+
+        if len(errors) > 0:
+            raise UploadError(str(len(errors)) + ' file(s) could not be uploaded: ' + '; '.join(errors))
+        return results
+
+
+__all__ = [
+    'Uploader',
+    'UploadError',
+    'MultipartStream',
+    'make_upload_fields',
+    'read_pypirc',
+    'simple_index_url',
+    'read_dist_metadata']
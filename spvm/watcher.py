@@ -0,0 +1,303 @@
+import splogger as log
+import os
+import select
+import struct
+import ctypes
+import ctypes.util
+from os.path import join
+from threading import Thread, Event, Lock, Timer
+
+from . import config
+
+# Never part of the watched state
+IGNORED_NAMES = ['.git', config.cacheDirName, '__pycache__', '.pytest_cache']
+# Git files telling that the branch, the commits, the tags or the index changed
+GIT_STATE = ['HEAD', 'index', 'packed-refs', 'refs']
+
+# linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def snapshot(location, ignore_match):
+    """
+    Map every file of the project (path relative to location) to (mtime_ns, size)
+    The git state files are included so commits, tags and checkouts are noticed
+    """
+    state = {}
+
+    def scan(directory, skip):
+        stack = [directory]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if skip(entry):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        state[os.path.relpath(entry.path, location)] = (st.st_mtime_ns, st.st_size)
+
+    scan(location, lambda e: e.name in IGNORED_NAMES or ignore_match(e.path))
+
+    git = join(location, '.git')
+    for name in GIT_STATE:
+        path = join(git, name)
+        if os.path.isdir(path):
+            scan(path, lambda e: False)
+        elif os.path.isfile(path):
+            st = os.stat(path)
+            state[os.path.relpath(path, location)] = (st.st_mtime_ns, st.st_size)
+
+    return state
+
+
+def diff_snapshots(old, new):
+    """ Paths added, removed or modified between two snapshots """
+    return sorted(p for p in set(old) | set(new) if old.get(p) != new.get(p))
+
+
+class PollingWatcher(object):
+    """
+    Calls callback(changed paths) from a background thread when the project changes
+    The tree is compared with its previous snapshot every interval seconds
+    """
+    kind = 'polling'
+
+    def __init__(self, location, ignore_match, callback, interval=1.0):
+        self.location = location
+        self.ignore_match = ignore_match
+        self.callback = callback
+        self.interval = interval
+        self.state = snapshot(location, ignore_match)
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                state = snapshot(self.location, self.ignore_match)
+            except OSError as ex:
+                log.debug('Snapshot failed: ' + repr(ex))
+                continue
+            changed = diff_snapshots(self.state, state)
+            self.state = state
+            if len(changed) > 0:
+                self.callback(changed)
+
+
+def _get_libc():
+    """ The C library if it provides inotify, None otherwise """
+    global _libc
+    if _libc is None:
+        _libc = False
+        name = ctypes.util.find_library('c')
+        if name is not None:
+            try:
+                libc = ctypes.CDLL(name, use_errno=True)
+                if hasattr(libc, 'inotify_init1'):
+                    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                    _libc = libc
+            except OSError:
+                pass
+    return _libc or None
+
+
+def has_inotify():
+    return _get_libc() is not None
+
+
+class Debouncer(object):
+    """
+    Collects the changes reported in a burst and calls callback(changed) once,
+    after delay seconds without a new change
+    A None change means the changes are unknown and is passed as is
+    """
+
+    def __init__(self, callback, delay):
+        self.callback = callback
+        self.delay = delay
+        self.pending = set()
+        self.unknown = False
+        self.lock = Lock()
+        self.timer = None
+
+    def __call__(self, changed):
+        with self.lock:
+            if changed is None:
+                self.unknown = True
+            else:
+                self.pending.update(changed)
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = Timer(self.delay, self._flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _flush(self):
+        with self.lock:
+            changed = None if self.unknown else sorted(self.pending)
+            self.pending = set()
+            self.unknown = False
+            self.timer = None
+        self.callback(changed)
+
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+
+
+class InotifyWatcher(object):
+    """
+    Same as PollingWatcher but woken up by the kernel (linux inotify)
+    Every directory of the project gets a watch, new directories are watched as they appear
+    callback(None) is called if the kernel queue overflowed
+    """
+    kind = 'inotify'
+
+    def __init__(self, location, ignore_match, callback):
+        self.libc = _get_libc()
+        if self.libc is None:
+            raise OSError('inotify is not available')
+        self.location = location
+        self.ignore_match = ignore_match
+        self.callback = callback
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}  # watch descriptor -> directory
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+        self._add_tree(location)
+        git = join(location, '.git')
+        if os.path.isdir(git):
+            self._add_watch(git)
+            self._add_tree(join(git, 'refs'), git_state=True)
+
+    def _skip(self, path):
+        return os.path.basename(path) in IGNORED_NAMES or self.ignore_match(path)
+
+    def _add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            log.debug('Cannot watch ' + directory + ': ' + os.strerror(ctypes.get_errno()))
+            return
+        self.watches[wd] = directory
+
+    def _add_tree(self, directory, git_state=False):
+        for dirpath, dirnames, _ in os.walk(directory):
+            if not git_state:
+                dirnames[:] = [d for d in dirnames if not self._skip(join(dirpath, d))]
+            self._add_watch(dirpath)
+
+    def _is_git_state(self, path):
+        rel = os.path.relpath(path, join(self.location, '.git'))
+        return not rel.startswith('..') and rel.split(os.sep)[0] in GIT_STATE
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                log.warning('Too many file system events, some were lost')
+                return None
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or name == b'':
+                continue
+
+            path = join(directory, os.fsdecode(name))
+            in_git = directory == join(self.location, '.git') or self._is_git_state(directory)
+            if in_git:
+                if not self._is_git_state(path):
+                    continue
+            elif self._skip(path):
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path, git_state=in_git)
+                continue
+            changed.append(os.path.relpath(path, self.location))
+        return changed
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                ready, _, _ = select.select([self.fd], [], [], 0.5)
+                if len(ready) == 0:
+                    continue
+                changed = self._read_events()
+                if changed is None or len(changed) > 0:
+                    self.callback(changed)
+        finally:
+            os.close(self.fd)
+
+
+def make_watcher(location, ignore_match, callback, interval=1.0, debounce=0.2):
+    """
+    Get a watcher calling callback(changed) once per burst of changes
+    inotify is used where available, mtime polling every interval seconds otherwise
+    """
+    callback = Debouncer(callback, debounce)
+    if has_inotify():
+        try:
+            return InotifyWatcher(location, ignore_match, callback)
+        except OSError as ex:
+            log.debug('inotify failed, polling instead: ' + repr(ex))
+    return PollingWatcher(location, ignore_match, callback, interval)
+
+
+__all__ = [
+    'snapshot',
+    'diff_snapshots',
+    'has_inotify',
+    'make_watcher',
+    'Debouncer',
+    'InotifyWatcher',
+    'PollingWatcher']
@@ -0,0 +1,381 @@
+import splogger as log
+import os
+import re
+import sys
+import tempfile
+import contextlib
+from os.path import join
+from time import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from colorama import Fore
+
+from . import config
+from . import core
+from . import metautils
+
+# Directories never searched for projects
+IGNORED_DIRECTORIES = ['.git', '.hg', '.svn', '.spvm', '.tox', '.nox', '.venv', 'venv', 'node_modules', '__pycache__', 'build', 'dist']
+
+RESULT_OK = 'OK'
+RESULT_FAILED = 'FAILED'
+RESULT_SKIPPED = 'SKIPPED'
+
+REQUIREMENT_NAME = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)')
+# name[extras] <op> version [; marker], a single version clause
+PINNED_REQUIREMENT = re.compile(r'^(\s*[A-Za-z0-9][A-Za-z0-9._-]*\s*(?:\[[^\]]*\])?\s*)(===|==|>=|~=)(\s*)([^\s,;]+)(\s*(?:;.*)?)$')
+
+
+def discover_projects(root):
+    """
+    Find every spvm project (directory holding a metaFile) under root
+    A project's own sub-directories are not searched for nested projects
+    """
+    projects = []
+    for dirpath, dirnames, filenames in os.walk(os.path.abspath(root)):
+        if config.metaFileName in filenames:
+            projects.append(dirpath)
+            dirnames[:] = []
+            continue
+        dirnames[:] = sorted(d for d in dirnames if d not in IGNORED_DIRECTORIES and not d.startswith('.'))
+
+    return sorted(projects)
+
+
+# Workspace operations, each one returns a short detail for the summary table
+
+def _op_status(project, show=False):
+    project.print_project_status(show)
+    return project.get_version()
+
+
+def _op_check(project):
+    flakes, pep = project.check_code()
+    for line in flakes + pep:
+        print('> ' + line)
+    if len(flakes) + len(pep) > 0:
+        exit(1)
+    return 'conform'
+
+
+def _op_test(project):
+    project.run_test()
+    return 'passed'
+
+
+def _op_release(project, kind='pass'):
+    project.release(kind)
+    return project.get_version()
+
+
+OPERATIONS = {
+    'status': _op_status,
+    'check': _op_check,
+    'test': _op_test,
+    'release': _op_release
+}
+
+
+@contextlib.contextmanager
+def capture_output():
+    """
+    Redirect the stdout and stderr file descriptors of this process to a buffer
+    Subprocesses and the logger (which keeps its own handle on stdout) are captured too
+    """
+    result = {'output': ''}
+    with tempfile.TemporaryFile() as tmp:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = os.dup(1), os.dup(2)
+        os.dup2(tmp.fileno(), 1)
+        os.dup2(tmp.fileno(), 2)
+        try:
+            yield result
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+            tmp.seek(0)
+            result['output'] = _clean_output(tmp.read().decode(errors='replace'))
+
+
+def _clean_output(text):
+    # only keep what would be visible after carriage returns (spinners, progress)
+    return '\n'.join(line.split('\r')[-1] for line in text.split('\n')).strip('\n')
+
+
+def run_project_operation(location, operation, args=(), cfg=None):
+    """
+    Run an operation on the project at location, meant to be called in a worker process
+    Returns (location, result, detail, duration, output)
+    """
+    if cfg is not None:
+        config.config.update(cfg)
+
+    start = time()
+    result, detail = RESULT_OK, ''
+    with capture_output() as captured:
+        try:
+            project = core.make_project_object(location)
+            detail = OPERATIONS[operation](project, *args)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                result, detail = RESULT_FAILED, 'exit code ' + str(e.code)
+        except Exception as e:
+            result, detail = RESULT_FAILED, repr(e)
+
+    return location, result, detail, time() - start, captured['output']
+
+
+def print_project_output(root, location, result, output):
+    color = Fore.GREEN if result == RESULT_OK else Fore.RED
+    print(color + '~~~~ ' + os.path.relpath(location, root) + ' ~~~~' + Fore.RESET)
+    if output != '':
+        print(output)
+    print('')
+
+
+def print_summary(root, results):
+    """
+    Print a table with one line per project
+    results is a list of (location, result, detail, duration)
+    """
+    rows = [(os.path.relpath(loc, root), res, str(detail), '%.1fs' % duration) for loc, res, detail, duration in results]
+    header = ('Project', 'Result', 'Detail', 'Time')
+    widths = [max(len(r[i]) for r in rows + [header]) for i in range(len(header))]
+
+    colors = {RESULT_OK: Fore.LIGHTGREEN_EX, RESULT_FAILED: Fore.LIGHTRED_EX, RESULT_SKIPPED: Fore.LIGHTYELLOW_EX}
+
+    def line(row, color=Fore.WHITE):
+        cells = [row[i].ljust(widths[i]) for i in range(len(row))]
+        return color + '  '.join(cells) + Fore.RESET
+
+    print(Fore.GREEN + '      Workspace Summary' + Fore.RESET)
+    print(line(header, Fore.CYAN))
+    for row in sorted(rows):
+        print(line(row, colors[row[1]]))
+
+    succeeded = len([r for r in rows if r[1] == RESULT_OK])
+    failed = len(rows) - succeeded
+    print(Fore.GREEN + str(succeeded) + ' succeeded, ' + (Fore.RED if failed else '') + str(failed) + ' failed or skipped' + Fore.RESET)
+
+
+def run_workspace(root, operation, args=(), jobs=None, projects=None):
+    """
+    Run an operation over every project of the workspace with a process pool
+    Outputs are printed as projects complete, followed by a summary table
+    Returns the list of (location, result, detail, duration)
+    """
+    if projects is None:
+        projects = discover_projects(root)
+    if len(projects) == 0:
+        log.warning('No ' + config.metaFileName + ' found under ' + os.path.abspath(root))
+        return []
+
+    log.success('Running ' + operation + ' on ' + str(len(projects)) + ' project(s)')
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        cfg = dict(config.config, isolated_tests=True)
+        futures = [pool.submit(run_project_operation, location, operation, args, cfg) for location in projects]
+        for future in as_completed(futures):
+            location, result, detail, duration, output = future.result()
+            print_project_output(root, location, result, output)
+            results.append((location, result, detail, duration))
+
+    print_summary(root, results)
+    return results
+
+
+# Dependency aware release
+
+def normalize_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def requirement_name(requirement):
+    """ Normalized project name of a requirement specifier, None for urls and paths """
+    match = REQUIREMENT_NAME.match(requirement)
+    if match is None or '/' in requirement.split(';')[0]:
+        return None
+    return normalize_name(match.group(1))
+
+
+def load_metas(projects):
+    return {location: metautils.load_project_meta(join(location, config.metaFileName)) for location in projects}
+
+
+def build_dependency_graph(metas):
+    """
+    Build the graph of dependencies between the workspace projects
+    Returns {location: set of the locations it depends on}
+    """
+    by_name = {normalize_name(meta['project_info']['name']): location for location, meta in metas.items()}
+    graph = {}
+    for location, meta in metas.items():
+        names = [requirement_name(r) for r in meta['project_requirements']['python_packages']]
+        graph[location] = set(by_name[n] for n in names if n in by_name and by_name[n] != location)
+    return graph
+
+
+def reverse_graph(graph):
+    dependents = {location: set() for location in graph}
+    for location, deps in graph.items():
+        for dep in deps:
+            dependents[dep].add(location)
+    return dependents
+
+
+def find_changed_projects(projects):
+    """
+    Projects with changes since their last release
+    A project that cannot be compared (never released, no git) is considered changed
+    """
+    def changed(location):
+        files = core.make_project_object(location).get_changed_files()
+        return files is None or len(files) > 0
+
+    with ThreadPoolExecutor() as pool:
+        flags = list(pool.map(changed, projects))
+    return set(location for location, flag in zip(projects, flags) if flag)
+
+
+def close_over(locations, edges):
+    """ All locations reachable from locations following edges, included """
+    closure = set(locations)
+    stack = list(locations)
+    while stack:
+        for nxt in edges[stack.pop()]:
+            if nxt not in closure:
+                closure.add(nxt)
+                stack.append(nxt)
+    return closure
+
+
+def release_order(graph, to_release):
+    """
+    Group the projects to release in waves, each wave only depends on the previous ones
+    Raises ValueError on dependency cycles
+    """
+    pending = {location: graph[location] & to_release for location in to_release}
+    waves = []
+    done = set()
+    while len(done) < len(to_release):
+        wave = sorted(location for location in pending if location not in done and pending[location] <= done)
+        if len(wave) == 0:
+            raise ValueError('Dependency cycle between: ' + ', '.join(sorted(to_release - done)))
+        waves.append(wave)
+        done.update(wave)
+    return waves
+
+
+def update_pinned_requirement(location, name, version):
+    """
+    Set the version of the requirement on name in the project at location
+    Only requirements carrying a single version clause are updated
+    Returns True if the project meta changed
+    """
+    meta_file = join(location, config.metaFileName)
+    meta = metautils.load_project_meta(meta_file)
+    packages = meta['project_requirements']['python_packages']
+    for i, requirement in enumerate(packages):
+        if requirement_name(requirement) != name:
+            continue
+        match = PINNED_REQUIREMENT.match(requirement)
+        if match is None:
+            log.debug('Not a pinned requirement, left as is: ' + requirement)
+            continue
+        packages[i] = match.group(1) + match.group(2) + match.group(3) + version + match.group(5)
+        log.success('Pinned ' + packages[i] + ' in ' + meta['project_info']['name'])
+
+    return metautils.save_project_meta(meta_file, meta)
+
+
+def release_workspace(root, kind='pass', jobs=None):
+    """
+    Release the changed projects of the workspace and everything depending on them
+    Projects are released in dependency order, independent ones in parallel,
+    and dependents get their pinned requirement updated to the released version
+    Returns the list of (location, result, detail, duration)
+    """
+    projects = discover_projects(root)
+    metas = load_metas(projects)
+    graph = build_dependency_graph(metas)
+    dependents = reverse_graph(graph)
+
+    changed = find_changed_projects(projects)
+    to_release = close_over(changed, dependents)
+    if len(to_release) == 0:
+        log.success('Nothing changed since the last releases')
+        return []
+
+    try:
+        waves = release_order(graph, to_release)
+    except ValueError as e:
+        log.error(str(e))
+        exit(1)
+
+    log.success('Release order is: ')
+    for i, wave in enumerate(waves):
+        log.success(' ' + str(i + 1) + ' -> ' + ', '.join(os.path.relpath(location, root) for location in wave))
+    for location in sorted(set(projects) - to_release):
+        log.fine('Unchanged: ' + os.path.relpath(location, root))
+
+    if config.config['ask']:
+        input('Press Enter to release these ' + str(len(to_release)) + ' project(s)')
+
+    # Confirmation was asked once for the whole workspace
+    cfg = dict(config.config, isolated_tests=True, ask=False)
+    pending = {location: graph[location] & to_release for location in to_release}
+    blocked = set()
+    results = []
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        running = {}
+
+        def submit_ready():
+            for location in sorted(pending):
+                if len(pending[location]) == 0:
+                    del pending[location]
+                    running[pool.submit(run_project_operation, location, 'release', (kind,), cfg)] = location
+
+        submit_ready()
+        while running:
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                location, result, detail, duration, output = future.result()
+                print_project_output(root, location, result, output)
+                results.append((location, result, detail, duration))
+
+                if result != RESULT_OK:
+                    blocked.update(close_over([location], dependents) - {location})
+                    continue
+
+                name = normalize_name(metas[location]['project_info']['name'])
+                for dependent in dependents[location] & set(pending):
+                    if dependent not in blocked:
+                        update_pinned_requirement(dependent, name, detail)
+                    pending[dependent].discard(location)
+
+            for location in blocked & set(pending):
+                del pending[location]
+                results.append((location, RESULT_SKIPPED, 'a dependency failed', 0))
+            submit_ready()
+
+    print_summary(root, results)
+    return results
+
+
+def has_failures(results):
+    return any(r[1] != RESULT_OK for r in results)
+
+
+__all__ = [
+    'discover_projects',
+    'run_project_operation',
+    'run_workspace',
+    'release_workspace',
+    'build_dependency_graph',
+    'has_failures']